@@ -0,0 +1,296 @@
+# bench_parser.py — бенчмарк и дифференциальный фаззинг разбора кнопок
+#
+#   python bench_parser.py                  # бенчмарк по всем наборам
+#   python bench_parser.py --fuzz 200000    # сравнение с эталонной реализацией
+#
+# Эталон — исходная версия parse_buttons_and_clean (до ButtonMatcher), заморожена ниже.
+# Любая оптимизированная версия должна давать ровно тот же результат.
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from urllib.parse import urlparse
+
+import config
+
+# main.py при импорте открывает базу — бенчмарку рабочая база не нужна
+config.DB_PATH = os.path.join(tempfile.mkdtemp(prefix="bench-"), "bench.sqlite3")
+
+import main  # noqa: E402
+
+BOT_UN = "testbutton_bot"
+TRIGGERS = ["/button", f"@{BOT_UN}"]
+
+# ======================== ЭТАЛОН =========================
+
+REF_QUOTE_OPEN = ['"', '«', '“']
+REF_ALLOWED_SCHEMES = {"http", "https", "tg"}
+REF_MAX_BTNS = 8
+
+def ref_is_allowed_url(url: str) -> bool:
+    try:
+        p = urlparse(url)
+    except Exception:
+        return False
+    if p.scheme not in REF_ALLOWED_SCHEMES:
+        return False
+    if p.scheme in {"http", "https"}:
+        return bool(p.netloc)
+    if p.scheme == "tg":
+        return True
+    return False
+
+def _ref_find_next(text_lower: str, start: int, triggers_lower: list[str]):
+    nxt, tlen = None, 0
+    for t in triggers_lower:
+        j = text_lower.find(t, start)
+        if j != -1 and (nxt is None or j < nxt):
+            nxt, tlen = j, len(t)
+    return nxt, tlen
+
+def ref_parse_buttons_and_clean(text: str, triggers: list[str]):
+    text_lower = text.lower()
+    triggers_lower = [t.lower() for t in triggers]
+
+    i = 0
+    buttons, spans = [], []
+
+    while True:
+        idx, tlen = _ref_find_next(text_lower, i, triggers_lower)
+        if idx is None:
+            break
+
+        j = idx + tlen
+        while j < len(text) and text[j].isspace():
+            j += 1
+
+        quote_pos, quote_char = None, None
+        k = j
+        while k < len(text):
+            ch = text[k]
+            if ch in REF_QUOTE_OPEN:
+                quote_pos, quote_char = k, ch
+                break
+            k += 1
+        if quote_pos is None:
+            i = j
+            continue
+
+        label = text[j:quote_pos].strip()
+        if not label:
+            i = quote_pos + 1
+            continue
+
+        close_char = {'«': '»', '“': '”'}.get(quote_char, '"')
+        url_start = quote_pos + 1
+        url_end = text.find(close_char, url_start)
+        if url_end == -1:
+            i = url_start
+            continue
+
+        url = text[url_start:url_end].strip()
+        if not ref_is_allowed_url(url):
+            i = url_end + 1
+            continue
+
+        buttons.append((label, url))
+        spans.append((idx, url_end + 1))
+        i = url_end + 1
+
+        if len(buttons) >= REF_MAX_BTNS:
+            break
+
+    if not buttons:
+        return text, []
+
+    out, last = [], 0
+    for s, e in sorted(spans):
+        out.append(text[last:s])
+        last = e
+    out.append(text[last:])
+    clean = " ".join("".join(out).split()) or " "
+    return clean, buttons
+
+# ======================== КОРПУС =========================
+
+WORDS_RU = ("привет", "канал", "новости", "скидка", "сегодня", "подписка", "розыгрыш",
+            "ссылка", "внутри", "читайте", "подробнее", "Москва", "ЁЛКА", "акция")
+WORDS_EN = ("hello", "channel", "news", "sale", "today", "link", "read", "more", "Promo", "BIG")
+URLS = ("https://example.com", "https://t.me/some_channel", "http://пример.рф/путь?q=1",
+        "tg://settings", "tg://resolve?domain=durov", "ftp://nope.example", "https://", "javascript:alert(1)")
+QUOTES = (('"', '"'), ('«', '»'), ('“', '”'))
+
+def _words(rnd: random.Random, n: int) -> str:
+    pool = WORDS_RU + WORDS_EN
+    return " ".join(rnd.choice(pool) for _ in range(n))
+
+def _button(rnd: random.Random) -> str:
+    trig = rnd.choice(TRIGGERS)
+    if rnd.random() < 0.3:
+        trig = trig.upper()
+    o, c = rnd.choice(QUOTES)
+    return f"{trig} {_words(rnd, rnd.randint(1, 3))} {o}{rnd.choice(URLS)}{c}"
+
+def _fit(text: str, limit: int = 4096) -> str:
+    return text[:limit]
+
+def corpus_short(rnd: random.Random) -> str:
+    return f"{_words(rnd, rnd.randint(3, 15))} {_button(rnd)}"
+
+def corpus_plain(rnd: random.Random) -> str:
+    # пост без триггеров — самый частый случай в каналах
+    return _words(rnd, rnd.randint(5, 60))
+
+def corpus_caption_4096(rnd: random.Random) -> str:
+    parts = [_words(rnd, 40)]
+    while sum(map(len, parts)) < 4200:
+        parts.append(_words(rnd, rnd.randint(10, 40)))
+        if rnd.random() < 0.2:
+            parts.append(_button(rnd))
+    return _fit("\n".join(parts))
+
+def corpus_many_triggers(rnd: random.Random) -> str:
+    parts = []
+    while sum(map(len, parts)) < 4200:
+        parts.append(rnd.choice(TRIGGERS))
+        parts.append(_words(rnd, 1))
+    parts.append(_button(rnd))
+    return _fit(" ".join(parts[-2000:]), 4096)
+
+def corpus_unclosed(rnd: random.Random) -> str:
+    o, _ = rnd.choice(QUOTES)
+    body = " ".join(f"{rnd.choice(TRIGGERS)} {_words(rnd, 2)} {o}{rnd.choice(URLS)}" for _ in range(60))
+    return _fit(body)
+
+def corpus_mixed_quotes(rnd: random.Random) -> str:
+    parts = []
+    for _ in range(rnd.randint(2, 12)):
+        trig = rnd.choice(TRIGGERS)
+        o, _c = rnd.choice(QUOTES)
+        _o, c = rnd.choice(QUOTES)
+        parts.append(f"{_words(rnd, 5)} {trig} {_words(rnd, 2)} {o}{rnd.choice(URLS)}{c}")
+    return _fit(" ".join(parts))
+
+CORPORA = {
+    "short": corpus_short,
+    "plain": corpus_plain,
+    "caption_4096": corpus_caption_4096,
+    "many_triggers": corpus_many_triggers,
+    "unclosed_quotes": corpus_unclosed,
+    "mixed_quotes": corpus_mixed_quotes,
+}
+
+def build_corpus(name: str, size: int, seed: int) -> list[str]:
+    rnd = random.Random(f"{name}:{seed}")
+    return [CORPORA[name](rnd) for _ in range(size)]
+
+# ======================== БЕНЧМАРК =========================
+
+def _percentile(sorted_vals: list[float], q: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    k = min(len(sorted_vals) - 1, max(0, round(q * (len(sorted_vals) - 1))))
+    return sorted_vals[k]
+
+def run_bench(fn, texts: list[str], rounds: int) -> dict:
+    lat = []
+    perf = time.perf_counter_ns
+    t0 = perf()
+    for _ in range(rounds):
+        for t in texts:
+            s = perf()
+            fn(t)
+            lat.append(perf() - s)
+    total = (perf() - t0) / 1e9
+    lat.sort()
+    return {
+        "ops": len(lat),
+        "ops_per_sec": len(lat) / total if total else 0.0,
+        "p50_us": _percentile(lat, 0.50) / 1000,
+        "p99_us": _percentile(lat, 0.99) / 1000,
+        "max_us": lat[-1] / 1000 if lat else 0.0,
+        "mean_us": statistics.fmean(lat) / 1000 if lat else 0.0,
+    }
+
+def _row(name: str, impl: str, r: dict) -> str:
+    return (f"{name:<16} {impl:<10} {r['ops_per_sec']:>12,.0f} {r['p50_us']:>10.1f} "
+            f"{r['p99_us']:>10.1f} {r['max_us']:>10.1f}")
+
+def bench(size: int, rounds: int, seed: int, corpora: list[str]):
+    matcher = main.ButtonMatcher(TRIGGERS)
+    impls = {
+        "reference": lambda t: ref_parse_buttons_and_clean(t, TRIGGERS),
+        "matcher": matcher.parse,
+    }
+    print(f"{'corpus':<16} {'impl':<10} {'ops/sec':>12} {'p50 µs':>10} {'p99 µs':>10} {'max µs':>10}")
+    for name in corpora:
+        texts = build_corpus(name, size, seed)
+        for impl, fn in impls.items():
+            print(_row(name, impl, run_bench(fn, texts, rounds)))
+
+    urls = [u for name in corpora for t in build_corpus(name, size, seed)
+            for _label, u in ref_parse_buttons_and_clean(t, TRIGGERS)[1]] or list(URLS)
+    urls += list(URLS)
+    print(_row("is_allowed_url", "main", run_bench(main.is_allowed_url, urls, rounds)))
+
+# ======================== ФАЗЗИНГ =========================
+
+FUZZ_ALPHABET = (
+    "/button", "/BUTTON", "/Button", f"@{BOT_UN}", f"@{BOT_UN.upper()}", "@", "/",
+    " ", "  ", "\n", "\t", " ", " ",
+    '"', "«", "»", "“", "”", "'",
+    "https://a.b", "http://", "https://", "tg://x", "tg:", "ftp://z", "://", "javascript:x",
+    "x", "Label", "Кнопка", "привет", "İ", "ẞ", "K", "ß", "ﬁ", "Σ", "😀",
+)
+
+def fuzz_text(rnd: random.Random) -> str:
+    n = rnd.choice((0, 1, 3, 8, 20, 60, 200))
+    return "".join(rnd.choice(FUZZ_ALPHABET) for _ in range(n))
+
+def fuzz(iterations: int, seed: int, candidates: dict) -> bool:
+    rnd = random.Random(seed)
+    trigger_sets = [TRIGGERS, ["/button"], [f"@{BOT_UN}", "/button"], ["/b", "/button"], []]
+    for it in range(iterations):
+        text = fuzz_text(rnd)
+        triggers = rnd.choice(trigger_sets)
+        expected = ref_parse_buttons_and_clean(text, triggers)
+        for name, fn in candidates.items():
+            got = fn(text, triggers)
+            if got != expected:
+                print(f"MISMATCH [{name}] iteration={it} seed={seed}")
+                print(f"  triggers: {triggers!r}")
+                print(f"  text:     {text!r}")
+                print(f"  expected: {expected!r}")
+                print(f"  got:      {got!r}")
+                return False
+    print(f"fuzz: {iterations} cases, {len(candidates)} implementation(s), no differences")
+    return True
+
+# ======================== CLI =========================
+
+def main_cli(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Бенчмарк и фаззинг разбора кнопок")
+    ap.add_argument("--size", type=int, default=500, help="сообщений в каждом наборе")
+    ap.add_argument("--rounds", type=int, default=3, help="проходов по набору")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--corpus", action="append", choices=sorted(CORPORA), help="только указанные наборы")
+    ap.add_argument("--fuzz", type=int, default=0, metavar="N", help="вместо бенчмарка: N случайных сравнений")
+    args = ap.parse_args(argv)
+
+    try:
+        if args.fuzz:
+            candidates = {
+                "parse_buttons_and_clean": main.parse_buttons_and_clean,
+                "ButtonMatcher": lambda text, triggers: main.ButtonMatcher(triggers).parse(text),
+            }
+            return 0 if fuzz(args.fuzz, args.seed, candidates) else 1
+        bench(args.size, args.rounds, args.seed, args.corpus or list(CORPORA))
+        return 0
+    finally:
+        main.DB.close()
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,67 @@
+# caches.py — простые процессные кэши (без внешних зависимостей)
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class ExpiringLRU:
+    # LRU с ограничением размера. У каждой записи свой срок жизни:
+    # expires_at — unix-время, после которого запись считается отсутствующей (None = бессрочно).
+
+    def __init__(self, maxsize: int = 10000, clock=time.time):
+        self.maxsize = max(1, int(maxsize))
+        self.clock = clock
+        self._data: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        item = self._data.get(key, _MISSING)
+        if item is _MISSING:
+            self.misses += 1
+            return default
+        value, expires_at = item
+        if expires_at is not None and expires_at <= self.clock():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, expires_at: float | None = None):
+        if expires_at is not None and expires_at <= self.clock():
+            # уже протухло — не засоряем кэш
+            self._data.pop(key, None)
+            return
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def set_ttl(self, key, value, ttl: float):
+        self.set(key, value, self.clock() + ttl)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, _MISSING)
+        if item is _MISSING:
+            return default
+        return item[0]
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -20,3 +20,80 @@ GIFT_DISCOUNT_PCT = 25
 
 # Путь к SQLite базе
 DB_PATH = "data/bot.sqlite3"
+
+# === НЕОБЯЗАТЕЛЬНО (значения по умолчанию указаны в комментариях) ===
+
+# Кэш подписок в памяти процесса
+# SUB_CACHE_SIZE = 50000            # максимум записей (LRU)
+# SUB_CACHE_NEGATIVE_TTL = 60       # сек. хранить ответ «подписки нет»
+
+# База данных
+# DB_READERS = 4                    # соединений-читателей (запись всегда в одном потоке)
+# DB_BATCH_MAX_OPS = 256            # максимум записей в одной транзакции
+# DB_BATCH_WINDOW_MS = 5            # сколько мс копить записи перед коммитом
+
+# Рассылка
+# BROADCAST_CONCURRENCY = 8         # одновременных отправок
+# BROADCAST_RATE = 25               # сообщений в секунду (лимит Telegram ~30)
+# BROADCAST_MAX_ATTEMPTS = 5        # попыток на получателя (429/сетевые ошибки)
+# BROADCAST_PROGRESS_SEC = 5        # как часто обновлять сообщение с прогрессом
+
+# Вебхук вместо long polling (по умолчанию — polling)
+# WEBHOOK_ENABLED = False
+# WEBHOOK_URL = "https://bot.example.com"   # публичный адрес (обычно reverse proxy с TLS)
+# WEBHOOK_PATH = "/tg/webhook"
+# WEBHOOK_SECRET = ""               # пусто — выводится из BOT_TOKEN
+# WEBHOOK_HOST = "127.0.0.1"        # где слушает локальный aiohttp-сервер
+# WEBHOOK_PORT = 8080
+# WEBHOOK_MAX_CONNECTIONS = 40
+
+# Режим воркеров: front-процесс раздаёт апдейты N процессам по chat_id (0/1 — один процесс)
+# WORKERS = 0
+
+# Свой Bot API сервер (локальный telegram-bot-api или fake_botapi.py для прогонов)
+# BOT_API_SERVER = ""               # например "http://127.0.0.1:8081"
+
+# Исходящие запросы к Bot API (outbound.py): общий лимит бота и лимиты на чат
+# OUTBOUND_RATE = 30                # сообщений/сек на бота (в режиме воркеров делится на WORKERS)
+# OUTBOUND_PRIVATE_RATE = 1         # новых сообщений/сек в один личный чат (правки — только общий лимит)
+# OUTBOUND_PRIVATE_BURST = 3
+# OUTBOUND_GROUP_PER_MIN = 20       # новых сообщений/мин в одну группу или канал
+# OUTBOUND_MAX_RETRIES = 3          # повторов после 429, дальше ошибка уходит вызывающему
+
+# Кэш Bot API: права бота в каналах, админы каналов, @username -> chat
+# CHAT_CACHE_SIZE = 2000
+# CHAT_CACHE_TTL = 300              # сек; my_chat_member сбрасывает записи чата сразу
+
+# FSM-состояния мастеров (хранятся в базе)
+# FSM_TTL = 86400                   # сек без изменений, после которых мастер считается брошенным
+# FSM_HOT_SIZE = 10000              # сколько активных разговоров держать в памяти
+
+# Авто-обновление и остановка
+# GIT_TIMEOUT_SEC = 60              # таймаут одной команды git
+# DRAIN_TIMEOUT_SEC = 30            # сколько ждать начатые обработчики и запись в базу перед выходом
+
+# Метрики в формате Prometheus (http://METRICS_HOST:METRICS_PORT/metrics)
+# METRICS_ENABLED = False
+# METRICS_HOST = "127.0.0.1"
+# METRICS_PORT = 9108               # воркер i отдаёт метрики на METRICS_PORT + 1 + i
+
+# Запись входящих апдейтов для replay.py (сжатый JSONL с ротацией)
+# RECORD_UPDATES_DIR = ""           # пусто — не писать; например "recordings"
+# RECORD_MAX_MB = 64                # размер одного файла (сжатый)
+# RECORD_KEEP_FILES = 20            # сколько последних файлов хранить
+
+# Счета Stars: payload — подписанная котировка, pre_checkout проверяет её без базы
+# INVOICE_SECRET = ""               # ключ подписи; пусто — выводится из BOT_TOKEN
+# INVOICE_QUOTE_TTL_SEC = 604800    # сколько дней счёт можно оплатить (7 дней)
+# INVOICE_LEGACY_UNTIL = 0          # до какого unix-времени принимать счета старого (JSON) формата;
+#                                   # 0 — INVOICE_QUOTE_TTL_SEC после перехода на подписанные счета
+
+# Окончание подписок: сброс кэшей в момент окончания и напоминание о продлении
+# EXPIRY_REMIND_DAYS = 3            # за сколько дней напомнить (0 — не напоминать)
+# EXPIRY_HORIZON_SEC = 21600        # окно событий в памяти; перечитывается раз в половину окна
+# EXPIRY_REMIND_BATCH = 30          # напоминаний в пачке
+# EXPIRY_REMIND_PAUSE_SEC = 1       # пауза между пачками
+
+# Поиск пользователя по @username (подарки, выдача подписки админом)
+# USERNAME_CACHE_SIZE = 20000
+# USERNAME_CACHE_TTL = 600          # сек; пользователь мог сменить username
@@ -0,0 +1,228 @@
+# dbgate.py — асинхронный доступ к SQLite для хендлеров.
+# Все записи идут через один поток-писатель (SQLite всё равно пишет последовательно),
+# чтения — через небольшой пул потоков, у каждого своё WAL-соединение.
+# Event loop больше не блокируется ни на запросах, ни на fsync.
+#
+# Писатель группирует мелкие записи: копит операции несколько миллисекунд
+# (или до N штук) и коммитит их одной транзакцией — один fsync на пачку.
+# Каждая операция выполняется в своём SAVEPOINT, так что ошибка одной не откатывает соседей.
+import asyncio
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger("dbgate")
+
+
+def _set_result(fut: asyncio.Future, result):
+    if not fut.done():
+        fut.set_result(result)
+
+
+def _set_exception(fut: asyncio.Future, exc: BaseException):
+    if not fut.done():
+        fut.set_exception(exc)
+
+
+def _noop(conn):
+    return None
+
+
+def _op_name(fn) -> str:
+    # fetchone/fetchall/execute помечают свою лямбду исходным SQL
+    return getattr(fn, "sql", None) or getattr(fn, "__name__", "?")
+
+
+class DBGateway:
+    def __init__(self, path: str, *, readers: int = 4, batch_max_ops: int = 256, batch_window_ms: float = 5):
+        self.path = path
+        self.batch_max_ops = max(1, int(batch_max_ops))
+        self.batch_window = max(0.0, float(batch_window_ms) / 1000)
+        self.batches = 0
+        self.batched_ops = 0
+        # observer(kind, op, seconds, ok) — хук для метрик; kind: read | write | commit.
+        # Вызывается из потоков шлюза, должен быть быстрым и потокобезопасным.
+        self.observer = None
+        self._local = threading.local()
+        self._reader_conns: list[sqlite3.Connection] = []
+        self._reader_lock = threading.Lock()
+        self._readers = ThreadPoolExecutor(max_workers=max(1, int(readers)), thread_name_prefix="db-read")
+        self._wq: queue.Queue = queue.Queue()
+        self._writer = threading.Thread(target=self._writer_loop, name="db-write", daemon=True)
+        self._closed = False
+        self._writer.start()
+
+    # ---------- соединения ----------
+
+    def _connect(self, **kw) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False, **kw)
+        conn.execute("PRAGMA foreign_keys=ON;")
+        conn.execute("PRAGMA busy_timeout=5000;")
+        return conn
+
+    def _reader_conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            conn.execute("PRAGMA query_only=ON;")
+            self._local.conn = conn
+            with self._reader_lock:
+                self._reader_conns.append(conn)
+        return conn
+
+    # ---------- чтение ----------
+
+    def _run_read(self, fn, args):
+        observer = self.observer
+        if observer is None:
+            return fn(self._reader_conn(), *args)
+        t0 = time.perf_counter()
+        ok = False
+        try:
+            res = fn(self._reader_conn(), *args)
+            ok = True
+            return res
+        finally:
+            observer("read", _op_name(fn), time.perf_counter() - t0, ok)
+
+    async def read(self, fn, *args):
+        # fn(conn, *args) выполняется в потоке-читателе
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, self._run_read, fn, args)
+
+    async def fetchone(self, sql: str, params: tuple = ()):
+        op = lambda conn: conn.execute(sql, params).fetchone()
+        op.sql = sql
+        return await self.read(op)
+
+    async def fetchall(self, sql: str, params: tuple = ()):
+        op = lambda conn: conn.execute(sql, params).fetchall()
+        op.sql = sql
+        return await self.read(op)
+
+    # ---------- запись ----------
+
+    def _collect_batch(self, first) -> tuple[list, bool]:
+        batch = [first]
+        stop = first is None or first[4]  # durable-запись не ждёт окна
+        deadline = time.monotonic() + self.batch_window
+        while not stop and len(batch) < self.batch_max_ops:
+            timeout = deadline - time.monotonic()
+            try:
+                item = self._wq.get(timeout=timeout) if timeout > 0 else self._wq.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(item)
+            stop = item is None or item[4]
+        shutdown = batch[-1] is None
+        if shutdown:
+            batch.pop()
+        return batch, shutdown
+
+    def _run_batch(self, conn: sqlite3.Connection, batch: list):
+        durable = any(item[4] for item in batch)
+        observer = self.observer
+        clock = time.perf_counter
+        results = []
+        conn.execute("PRAGMA synchronous=FULL;" if durable else "PRAGMA synchronous=NORMAL;")
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for fn, args, _loop, _fut, _durable in batch:
+                t0 = clock() if observer else 0.0
+                conn.execute("SAVEPOINT op")
+                try:
+                    res = fn(conn, *args)
+                except BaseException as e:
+                    conn.execute("ROLLBACK TO op")
+                    conn.execute("RELEASE op")
+                    results.append((False, e))
+                else:
+                    conn.execute("RELEASE op")
+                    results.append((True, res))
+                if observer:
+                    observer("write", _op_name(fn), clock() - t0, results[-1][0])
+            t0 = clock() if observer else 0.0
+            conn.execute("COMMIT")
+            if observer:
+                observer("commit", "durable" if durable else "batch", clock() - t0, True)
+        except BaseException as e:
+            if conn.in_transaction:
+                conn.rollback()
+            results = [(False, e)] * len(batch)
+        self.batches += 1
+        self.batched_ops += len(batch)
+        for (fn, _args, loop, fut, _durable), (ok, value) in zip(batch, results):
+            if fut is None:
+                if not ok:
+                    log.error("write-behind %s failed: %r", getattr(fn, "__name__", fn), value)
+                continue
+            try:
+                loop.call_soon_threadsafe(_set_result if ok else _set_exception, fut, value)
+            except RuntimeError:
+                pass  # loop уже закрыт
+
+    def _writer_loop(self):
+        conn = self._connect(isolation_level=None)
+        while True:
+            batch, shutdown = self._collect_batch(self._wq.get())
+            if batch:
+                self._run_batch(conn, batch)
+            if shutdown:
+                break
+        conn.close()
+
+    def _submit(self, fn, args, *, durable: bool, wait: bool):
+        if self._closed:
+            raise RuntimeError("DBGateway is closed")
+        if not wait:
+            self._wq.put((fn, args, None, None, durable))
+            return None
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._wq.put((fn, args, loop, fut, durable))
+        return fut
+
+    async def write(self, fn, *args):
+        # fn(conn, *args) выполняется в потоке-писателе; ждём коммита пачки
+        return await self._submit(fn, args, durable=False, wait=True)
+
+    async def write_durable(self, fn, *args):
+        # то же, но пачка сбрасывается сразу и коммитится с synchronous=FULL (платежи)
+        return await self._submit(fn, args, durable=True, wait=True)
+
+    def write_behind(self, fn, *args):
+        # fire-and-forget: ошибка попадёт в лог
+        self._submit(fn, args, durable=False, wait=False)
+
+    def write_soon(self, fn, *args) -> asyncio.Future:
+        # как write_behind (не ждём), но с future результата — чтобы отреагировать на итог после коммита
+        return self._submit(fn, args, durable=False, wait=True)
+
+    async def flush(self):
+        # барьер: всё, что поставлено в очередь раньше, закоммичено на диск
+        await self.write_durable(_noop)
+
+    async def execute(self, sql: str, params: tuple = ()) -> int:
+        op = lambda conn: conn.execute(sql, params).rowcount
+        op.sql = sql
+        return await self.write(op)
+
+    # ---------- служебное ----------
+
+    def queue_size(self) -> int:
+        return self._wq.qsize()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._wq.put(None)
+        self._writer.join()
+        self._readers.shutdown(wait=True)
+        with self._reader_lock:
+            for conn in self._reader_conns:
+                conn.close()
+            self._reader_conns.clear()
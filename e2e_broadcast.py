@@ -0,0 +1,97 @@
+# e2e_broadcast.py — прогон рассылки против локального фейкового Bot API
+#
+#   python e2e_broadcast.py [--users 300] [--flood-rate 0.01]
+#
+# Проверяет: все получатели обработаны, 429 переживаются, «заблокировавшие» помечаются
+# и пропускаются следующей рассылкой, прерванное задание дозавершается после «рестарта».
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+
+import config
+
+config.DB_PATH = os.path.join(tempfile.mkdtemp(prefix="e2e-bcast-"), "bot.sqlite3")
+
+import main  # noqa: E402
+from aiogram import Bot  # noqa: E402
+from aiogram.client.session.aiohttp import AiohttpSession  # noqa: E402
+from aiogram.client.telegram import TelegramAPIServer  # noqa: E402
+
+from fake_botapi import FakeBotAPI  # noqa: E402
+
+ADMIN_CHAT = 10_000_000
+
+def check(cond: bool, what: str, failures: list):
+    print(("ok   " if cond else "FAIL ") + what)
+    if not cond:
+        failures.append(what)
+
+async def run(args) -> int:
+    failures: list[str] = []
+    user_ids = list(range(1, args.users + 1))
+    blocked = set(user_ids[::max(1, args.users // 10)])
+    for uid in user_ids:
+        await main.ensure_user(uid, f"user{uid}")
+    await main.DB.flush()
+
+    api = FakeBotAPI(flood_rate=args.flood_rate, retry_after=1, blocked=blocked, seed=args.seed)
+    url = await api.start()
+    bot = Bot("42:fake", session=AiohttpSession(api=TelegramAPIServer.from_base(url)))
+    try:
+        # 1) запускаем и «роняем» процесс посреди рассылки
+        engine = main.BroadcastEngine(concurrency=8, rate=args.rate, progress_sec=0.2)
+        job = await engine.create(bot, "hello", ADMIN_CHAT)
+        while sum(1 for c in api.sent_to() if c != ADMIN_CHAT) < args.users // 3:
+            await asyncio.sleep(0.01)
+        engine._tasks[job.id].cancel()
+        await asyncio.sleep(0.05)
+        status = (await main.DB.fetchone("SELECT status FROM broadcast_jobs WHERE id=?", (job.id,)))[0]
+        check(status == "running", "interrupted job stays 'running' in the DB", failures)
+
+        # 2) «рестарт»: новый движок подхватывает задание
+        engine2 = main.BroadcastEngine(concurrency=8, rate=args.rate, progress_sec=0.2)
+        await engine2.resume_all(bot)
+        await engine2.wait(job.id)
+
+        row = await main.DB.fetchone("SELECT status FROM broadcast_jobs WHERE id=?", (job.id,))
+        check(row[0] == "done", "job finished after resume", failures)
+        pending = (await main.DB.fetchone(
+            "SELECT COUNT(*) FROM broadcast_recipients WHERE job_id=? AND state=0", (job.id,)))[0]
+        check(pending == 0, "no pending recipients left", failures)
+
+        sent = [c for c in api.sent_to() if c != ADMIN_CHAT and c not in blocked]
+        missing = set(user_ids) - blocked - set(sent)
+        check(not missing, f"every reachable user got the message (missing {len(missing)})", failures)
+        dupes = len(sent) - len(set(sent))
+        check(dupes <= 8, f"duplicates bounded by in-flight sends at crash ({dupes})", failures)
+
+        marked = {r[0] for r in await main.DB.fetchall("SELECT user_id FROM users WHERE blocked_at IS NOT NULL")}
+        check(marked == blocked, f"blocked users marked ({len(marked)}/{len(blocked)})", failures)
+        check(api.floods > 0 or args.flood_rate == 0, f"429s injected and survived ({api.floods})", failures)
+        edits = sum(1 for m, _p in api.calls if m == "editmessagetext")
+        check(edits > 0, f"progress message edited ({edits} edits)", failures)
+
+        # 3) следующая рассылка обходит заблокировавших
+        job2 = await engine2.create(bot, "second", ADMIN_CHAT)
+        await engine2.wait(job2.id)
+        n = (await main.DB.fetchone(
+            "SELECT COUNT(*) FROM broadcast_recipients WHERE job_id=?", (job2.id,)))[0]
+        check(n == len(user_ids) - len(blocked), f"second job skips blocked users ({n} recipients)", failures)
+    finally:
+        await bot.session.close()
+        await api.stop()
+        main.DB.close()
+
+    print(api.summary())
+    print("PASS" if not failures else f"FAILED: {len(failures)}")
+    return 0 if not failures else 1
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="E2E-проверка рассылки на фейковом Bot API")
+    ap.add_argument("--users", type=int, default=300)
+    ap.add_argument("--rate", type=float, default=300)
+    ap.add_argument("--flood-rate", type=float, default=0.01)
+    ap.add_argument("--seed", type=int, default=3)
+    sys.exit(asyncio.run(run(ap.parse_args())))
@@ -0,0 +1,137 @@
+# e2e_webhook.py — прогон вебхук-режима: синтетические апдейты POST-ом в локальный сервер
+#
+#   python e2e_webhook.py [--posts 200]
+#
+# Исходящие запросы бота уходят в локальный фейковый Bot API (fake_botapi.py).
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import config
+
+config.DB_PATH = os.path.join(tempfile.mkdtemp(prefix="e2e-webhook-"), "bot.sqlite3")
+
+import main  # noqa: E402
+from aiohttp import ClientSession, web  # noqa: E402
+from aiogram import Bot  # noqa: E402
+from aiogram.client.default import DefaultBotProperties  # noqa: E402
+from aiogram.client.session.aiohttp import AiohttpSession  # noqa: E402
+from aiogram.client.telegram import TelegramAPIServer  # noqa: E402
+
+from fake_botapi import FakeBotAPI  # noqa: E402
+
+SECRET = "e2e-secret_token"
+PATH = "/tg/e2e-hook"
+CHANNEL_ID = -100_123_456
+OWNER_ID = 777
+
+def check(cond: bool, what: str, failures: list):
+    print(("ok   " if cond else "FAIL ") + what)
+    if not cond:
+        failures.append(what)
+
+def channel_post(update_id: int, text: str) -> dict:
+    return {"update_id": update_id, "channel_post": {
+        "message_id": update_id, "date": int(time.time()),
+        "chat": {"id": CHANNEL_ID, "type": "channel", "title": "E2E"}, "text": text,
+    }}
+
+def private_start(update_id: int, user_id: int) -> dict:
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private", "first_name": "U"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "U", "username": f"u{user_id}"},
+        "text": "/start", "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+    }}
+
+async def wait_for(cond, timeout: float = 10.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if cond():
+            return True
+        await asyncio.sleep(0.01)
+    return cond()
+
+async def run(args) -> int:
+    failures: list[str] = []
+    api = FakeBotAPI(latency=args.api_latency, bot_username="e2e_hook_bot")
+    api_url = await api.start()
+    bot = Bot("42:fake", session=AiohttpSession(api=TelegramAPIServer.from_base(api_url)),
+              default=DefaultBotProperties(parse_mode="HTML"))
+    main.set_bot_username((await bot.get_me()).username)
+    await main.ensure_user(OWNER_ID, "owner")
+    await main.channel_add_owned(OWNER_ID, CHANNEL_ID, "E2E", None)
+
+    dp = main.build_dispatcher()
+    runner = web.AppRunner(main.build_webhook_app(dp, bot, path=PATH, secret=SECRET))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    hook = f"http://127.0.0.1:{port}{PATH}"
+    good = {"X-Telegram-Bot-Api-Secret-Token": SECRET}
+
+    try:
+        async with ClientSession() as http:
+            async with http.post(hook, json=channel_post(1, "x /button A \"https://a.b\""),
+                                 headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"}) as r:
+                check(r.status == 401, f"wrong secret rejected ({r.status})", failures)
+            async with http.post(hook, json=channel_post(2, "x /button A \"https://a.b\"")) as r:
+                check(r.status == 401, f"missing secret rejected ({r.status})", failures)
+            async with http.post(f"http://127.0.0.1:{port}/other", json=channel_post(3, "x"), headers=good) as r:
+                check(r.status in (404, 405), f"unknown path not served ({r.status})", failures)
+            check(not api.calls[1:], "rejected updates never reached handlers", failures)
+
+            lat = []
+            for i in range(args.posts):
+                text = f"пост {i} @{main.BOT_UN} Открыть «https://example.com/{i}»" if i % 2 else f"пост {i} без кнопок"
+                t0 = time.perf_counter()
+                async with http.post(hook, json=channel_post(100 + i, text), headers=good) as r:
+                    await r.read()
+                    lat.append(time.perf_counter() - t0)
+                    if r.status != 200:
+                        check(False, f"post {i} answered {r.status}", failures)
+                        break
+            async with http.post(hook, json=private_start(10_000, 555), headers=good) as r:
+                check(r.status == 200, "private /start accepted", failures)
+
+        expected_buttons = args.posts // 2
+        got = await wait_for(lambda: sum(
+            1 for m, p in api.calls if m == "editmessagetext" and "inline_keyboard" in (p.get("reply_markup") or "")
+        ) >= expected_buttons)
+        check(got, f"{expected_buttons} triggered posts edited in place with buttons", failures)
+        check(not any(m == "deletemessage" for m, _p in api.calls), "no posts deleted and re-sent", failures)
+        check(await wait_for(lambda: 555 in api.sent_to()), "/start answered via Bot API", failures)
+        lat.sort()
+        p50, p99 = lat[len(lat) // 2] * 1000, lat[int(len(lat) * 0.99) - 1] * 1000
+        # ответ не ждёт обработчик: должен быть заметно быстрее задержки Bot API
+        check(p50 < args.api_latency * 1000, f"webhook answers before handlers finish (p50 {p50:.2f} ms, p99 {p99:.2f} ms)", failures)
+        await asyncio.sleep(args.api_latency * 2)
+        await wait_for(api.idle)  # дать фоновым обработчикам доделать запросы
+        # остановка вебхука не закрывает сессию: запросы обработчиков, доделываемых в drain, не обрываются
+        in_flight = asyncio.create_task(bot.send_message(555, "drain"))
+        await asyncio.sleep(args.api_latency / 2)
+        await runner.cleanup()
+        try:
+            await in_flight
+            survived = True
+        except Exception:
+            survived = False
+        check(survived, "Bot API call in flight survives webhook shutdown", failures)
+    finally:
+        await runner.cleanup()
+        await bot.session.close()
+        await api.stop()
+        main.DB.close()
+
+    print("PASS" if not failures else f"FAILED: {len(failures)}")
+    return 0 if not failures else 1
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="E2E-проверка вебхук-режима")
+    ap.add_argument("--posts", type=int, default=200)
+    ap.add_argument("--api-latency", type=float, default=0.05, help="задержка фейкового Bot API, сек")
+    sys.exit(asyncio.run(run(ap.parse_args())))
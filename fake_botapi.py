@@ -0,0 +1,200 @@
+# fake_botapi.py — локальный фейковый Bot API сервер для проверок и нагрузочных прогонов
+#
+#   python fake_botapi.py --port 8081 --latency 0.05 --flood-rate 0.01
+#
+# Бот направляется на него через AiohttpSession(api=TelegramAPIServer.from_base(url)).
+# Все вызовы записываются в FakeBotAPI.calls; можно добавить задержку ответа,
+# случайные 429 (RetryAfter) и «заблокировавших бота» пользователей (403).
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+
+from aiohttp import web
+
+SEND_METHODS = {
+    "sendmessage", "sendphoto", "sendvideo", "senddocument", "sendanimation",
+    "sendaudio", "sendvoice", "sendinvoice", "copymessage",
+}
+EDIT_METHODS = {"editmessagetext", "editmessagecaption", "editmessagereplymarkup", "editmessagemedia"}
+
+
+class FakeBotAPI:
+    def __init__(self, *, latency: float = 0.0, flood_rate: float = 0.0, retry_after: int = 1,
+                 blocked: set[int] | None = None, bot_id: int = 4242, bot_username: str = "fake_test_bot",
+                 owner_id: int | None = None, seed: int = 0):
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.blocked = set(blocked or ())
+        self.bot_id = bot_id
+        self.bot_username = bot_username
+        self.owner_id = owner_id
+        self.rnd = random.Random(seed)
+        self.calls: list[tuple[str, dict]] = []
+        self.floods = 0
+        self.completed = 0
+        self._msg_ids = itertools.count(1000)
+        self._runner: web.AppRunner | None = None
+        self.url = ""
+
+    # ---------- ответы ----------
+
+    def _chat(self, chat_id) -> dict:
+        try:
+            cid = int(chat_id)
+        except (TypeError, ValueError):
+            cid = -100_000_000_0001  # @username канала
+        return {"id": cid, "type": "private" if cid > 0 else "channel", "title": None if cid > 0 else "chan"}
+
+    def _message(self, params: dict, message_id: int | None = None) -> dict:
+        msg = {"message_id": message_id or next(self._msg_ids), "date": int(time.time()),
+               "chat": {k: v for k, v in self._chat(params.get("chat_id")).items() if v is not None}}
+        for key in ("text", "caption"):
+            if params.get(key) is not None:
+                msg[key] = params[key]
+        if params.get("reply_markup"):
+            try:
+                markup = json.loads(params["reply_markup"])
+                if "inline_keyboard" in markup:
+                    msg["reply_markup"] = markup
+            except ValueError:
+                pass
+        return msg
+
+    def _bot_user(self) -> dict:
+        return {"id": self.bot_id, "is_bot": True, "first_name": "Fake", "username": self.bot_username}
+
+    def _result(self, method: str, params: dict):
+        if method == "getme":
+            return self._bot_user()
+        if method in SEND_METHODS:
+            return self._message(params)
+        if method in EDIT_METHODS:
+            if params.get("inline_message_id"):
+                return True
+            return self._message(params, int(params.get("message_id") or 0) or None)
+        if method == "getupdates":
+            return []
+        if method == "getchat":
+            chat = self._chat(params.get("chat_id"))
+            return {**{k: v for k, v in chat.items() if v is not None}, "accent_color_id": 0, "max_reaction_count": 11}
+        if method == "getchatmember":
+            return {"status": "administrator", "user": self._bot_user(), "can_be_edited": False,
+                    "is_anonymous": False, "can_manage_chat": True, "can_delete_messages": True,
+                    "can_manage_video_chats": False, "can_restrict_members": False, "can_promote_members": False,
+                    "can_change_info": False, "can_invite_users": False, "can_post_stories": False,
+                    "can_edit_stories": False, "can_delete_stories": False, "can_post_messages": True,
+                    "can_edit_messages": True}
+        if method == "getchatadministrators":
+            owner = self.owner_id or 1
+            return [{"status": "creator", "is_anonymous": False,
+                     "user": {"id": owner, "is_bot": False, "first_name": "Owner"}}]
+        return True
+
+    @staticmethod
+    def _error(code: int, description: str, **parameters) -> web.Response:
+        body = {"ok": False, "error_code": code, "description": description}
+        if parameters:
+            body["parameters"] = parameters
+        return web.json_response(body, status=code)
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        try:
+            return await self._respond(request)
+        finally:
+            self.completed += 1
+
+    def idle(self) -> bool:
+        # все принятые запросы уже получили ответ
+        return self.completed >= len(self.calls)
+
+    async def _respond(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        params: dict = {}
+        if request.can_read_body:
+            if request.content_type == "application/json":
+                params = await request.json()
+            else:
+                params = {k: v for k, v in (await request.post()).items() if isinstance(v, str)}
+        self.calls.append((method, params))
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method != "getme" and self.flood_rate and self.rnd.random() < self.flood_rate:
+            self.floods += 1
+            return self._error(429, f"Too Many Requests: retry after {self.retry_after}", retry_after=self.retry_after)
+        if method in SEND_METHODS:
+            try:
+                if int(params.get("chat_id")) in self.blocked:
+                    return self._error(403, "Forbidden: bot was blocked by the user")
+            except (TypeError, ValueError):
+                pass
+        return web.json_response({"ok": True, "result": self._result(method, params)})
+
+    # ---------- запуск ----------
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self._handle)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        real_port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{real_port}"
+        return self.url
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def sent_to(self, method: str = "sendmessage") -> list[int]:
+        out = []
+        for m, p in self.calls:
+            if m == method:
+                try:
+                    out.append(int(p.get("chat_id")))
+                except (TypeError, ValueError):
+                    pass
+        return out
+
+    def summary(self) -> dict:
+        by_method: dict[str, int] = {}
+        for m, _p in self.calls:
+            by_method[m] = by_method.get(m, 0) + 1
+        return {"calls": len(self.calls), "floods": self.floods, "by_method": by_method}
+
+
+async def _serve(args):
+    api = FakeBotAPI(latency=args.latency, flood_rate=args.flood_rate, retry_after=args.retry_after,
+                     blocked=set(args.blocked or ()), seed=args.seed)
+    url = await api.start(args.host, args.port)
+    print(f"fake Bot API: {url}  (Ctrl+C — остановить)")
+    try:
+        while True:
+            await asyncio.sleep(3600)
+    finally:
+        print(json.dumps(api.summary(), ensure_ascii=False, indent=2))
+        await api.stop()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Фейковый Telegram Bot API")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8081)
+    ap.add_argument("--latency", type=float, default=0.0, help="задержка ответа, сек")
+    ap.add_argument("--flood-rate", type=float, default=0.0, help="доля запросов, получающих 429")
+    ap.add_argument("--retry-after", type=int, default=1)
+    ap.add_argument("--blocked", type=int, action="append", help="chat_id, заблокировавший бота (403)")
+    ap.add_argument("--seed", type=int, default=0)
+    try:
+        asyncio.run(_serve(ap.parse_args()))
+    except KeyboardInterrupt:
+        pass
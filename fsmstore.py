@@ -0,0 +1,159 @@
+# fsmstore.py — FSM-хранилище aiogram поверх SQLite (через DBGateway)
+#
+# Состояние и данные мастера (CreateBtn, GiftBuy, AdminGrant, ...) лежат в таблице fsm_states
+# и переживают перезапуск процесса. Активные разговоры обслуживаются из горячего LRU в памяти;
+# в базу изменения уходят write-behind через писателя шлюза (порядок записей сохраняется).
+# Состояние, которое не менялось дольше ttl секунд, считается брошенным: оно не читается
+# и удаляется периодической чисткой.
+#
+# Таблица (создаётся миграцией в main.py):
+#   fsm_states(key TEXT PRIMARY KEY, state TEXT, data BLOB, touched_at INTEGER) WITHOUT ROWID
+import asyncio
+import copy
+import json
+import logging
+import time
+import zlib
+from typing import Any
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from caches import ExpiringLRU
+from dbgate import DBGateway
+
+log = logging.getLogger("fsmstore")
+
+_ZLIB_MIN = 512          # данные длиннее — сжимаем
+_RAW, _ZIPPED = b"j", b"z"
+
+
+def encode_key(key: StorageKey) -> str:
+    # "bot:chat:user" + необязательные части — короче и дешевле для индекса, чем отдельные колонки
+    parts = [str(key.bot_id), str(key.chat_id), str(key.user_id)]
+    if key.thread_id:
+        parts.append(f"t{key.thread_id}")
+    if key.business_connection_id:
+        parts.append(f"b{key.business_connection_id}")
+    if key.destiny != "default":
+        parts.append(f"d{key.destiny}")
+    return ":".join(parts)
+
+
+def encode_data(data: dict) -> bytes | None:
+    if not data:
+        return None
+    raw = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode()
+    if len(raw) >= _ZLIB_MIN:
+        return _ZIPPED + zlib.compress(raw)
+    return _RAW + raw
+
+
+def decode_data(blob: bytes | None) -> dict:
+    if not blob:
+        return {}
+    kind, body = blob[:1], blob[1:]
+    if kind == _ZIPPED:
+        body = zlib.decompress(body)
+    return json.loads(body)
+
+
+def _put_tx(conn, key: str, state: str | None, data: bytes | None, touched_at: int):
+    if state is None and data is None:
+        conn.execute("DELETE FROM fsm_states WHERE key=?", (key,))
+    else:
+        conn.execute("""
+            INSERT INTO fsm_states(key, state, data, touched_at) VALUES(?,?,?,?)
+            ON CONFLICT(key) DO UPDATE SET state=excluded.state, data=excluded.data, touched_at=excluded.touched_at
+        """, (key, state, data, touched_at))
+
+
+def _touch_tx(conn, key: str, touched_at: int):
+    conn.execute("UPDATE fsm_states SET touched_at=? WHERE key=?", (touched_at, key))
+
+
+def _purge_tx(conn, older_than: int) -> int:
+    return conn.execute("DELETE FROM fsm_states WHERE touched_at < ?", (older_than,)).rowcount
+
+
+class SQLiteStorage(BaseStorage):
+    # ttl — через сколько секунд без изменений состояние забывается;
+    # hot_size/hot_ttl — размер и время жизни записей горячего слоя.
+    # Отсутствие состояния тоже кэшируется: FSM-middleware спрашивает его на каждый апдейт.
+
+    def __init__(self, db: DBGateway, *, ttl: float = 86400, hot_size: int = 10000,
+                 hot_ttl: float = 900, clock=time.time):
+        self.db = db
+        self.ttl = ttl
+        self.hot_ttl = hot_ttl
+        self.clock = clock
+        self.hot = ExpiringLRU(hot_size, clock=clock)
+
+    async def _load(self, key: StorageKey) -> tuple[str, list]:
+        k = encode_key(key)
+        rec = self.hot.get(k)
+        if rec is not None:
+            return k, rec
+        now = self.clock()
+        row = await self.db.fetchone(
+            "SELECT state, data, touched_at FROM fsm_states WHERE key=? AND touched_at>=?",
+            (k, int(now - self.ttl)),
+        )
+        # пока шло чтение, параллельный апдейт мог загрузить или изменить это же состояние:
+        # горячая запись свежее прочитанной строки (её запись в базу может быть ещё в очереди)
+        rec = self.hot.get(k)
+        if rec is not None:
+            return k, rec
+        if row is None:
+            rec = [None, {}, now]
+        else:
+            rec = [row[0], decode_data(row[1]), row[2]]
+            if now - row[2] > self.ttl / 2:
+                # разговор ещё жив — продлеваем, не дожидаясь записи
+                rec[2] = now
+                self.db.write_behind(_touch_tx, k, int(now))
+        self._remember(k, rec)
+        return k, rec
+
+    def _remember(self, k: str, rec: list):
+        # горячая запись не переживает срок самого состояния
+        self.hot.set(k, rec, min(self.clock() + self.hot_ttl, rec[2] + self.ttl))
+
+    def _store(self, k: str, rec: list):
+        rec[2] = self.clock()
+        self._remember(k, rec)
+        self.db.write_behind(_put_tx, k, rec[0], encode_data(rec[1]), int(rec[2]))
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k, rec = await self._load(key)
+        rec[0] = state.state if isinstance(state, State) else state
+        self._store(k, rec)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        _k, rec = await self._load(key)
+        return rec[0]
+
+    async def set_data(self, key: StorageKey, data: dict[str, Any]) -> None:
+        k, rec = await self._load(key)
+        rec[1] = copy.deepcopy(data)
+        self._store(k, rec)
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        _k, rec = await self._load(key)
+        return copy.deepcopy(rec[1])
+
+    async def purge_expired(self) -> int:
+        return await self.db.write(_purge_tx, int(self.clock() - self.ttl))
+
+    async def purge_loop(self, interval: float = 3600):
+        while True:
+            try:
+                n = await self.purge_expired()
+                if n:
+                    log.info("fsm: purged %d idle states", n)
+            except Exception:
+                log.exception("fsm purge failed")
+            await asyncio.sleep(interval)
+
+    async def close(self) -> None:
+        self.hot.clear()
@@ -0,0 +1,289 @@
+# loadgen.py — синтетическая нагрузка на реальный роутер бота, без сети
+#
+#   python loadgen.py                                   # смесь по умолчанию, 20000 апдейтов
+#   python loadgen.py --mix business=5,channel_plain=3,start=1,payment=1 --updates 50000
+#   python loadgen.py --mix start=1 --concurrency 200   # «шторм» /start
+#
+# Апдейты собираются заранее (Update-объекты) и подаются в Dispatcher.feed_update с настоящим
+# main.router. Сессия бота подменена: вызовы Bot API записываются, ответы разбираются
+# так же, как ответы настоящего сервера (BaseSession.check_response), но без сети.
+# Планировщик исходящих (outbound.py) не подключается — меряем сам бот, а не лимиты Telegram.
+# Упавшие апдейты в задержки и пропускную способность не входят; если они были — предупреждение и код выхода 1.
+#
+# Смеси:
+#   business         — бизнес-сообщения подписчиков с кнопками (разбор + редактирование)
+#   business_plain   — бизнес-сообщения без триггеров
+#   channel_trigger  — посты в привязанных каналах с кнопками (редактирование на месте)
+#   channel_plain    — посты без триггеров (самый частый случай)
+#   start            — /start от новых пользователей в личке
+#   payment          — pre_checkout_query + successful_payment (запись подписки)
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import time
+
+import config
+
+config.DB_PATH = os.path.join(tempfile.mkdtemp(prefix="loadgen-"), "bot.sqlite3")
+
+import main  # noqa: E402
+from aiogram import Bot  # noqa: E402
+from aiogram.client.session.base import BaseSession  # noqa: E402
+from aiogram.types import Update  # noqa: E402
+
+from fake_botapi import FakeBotAPI  # noqa: E402
+
+BOT_USERNAME = "loadgen_bot"
+SUBSCRIBERS = 500
+CHANNELS = 50
+CHANNEL_BASE = -100_200_000_000
+USER_BASE = 1_000_000
+WORDS = ("привет", "канал", "новости", "скидка", "сегодня", "hello", "sale", "link", "read", "more")
+
+
+class RecordingSession(BaseSession):
+    # Ответы строит FakeBotAPI (те же, что отдаёт фейковый сервер), разбор — как у настоящей сессии
+    def __init__(self):
+        super().__init__()
+        self.fake = FakeBotAPI(bot_username=BOT_USERNAME, owner_id=USER_BASE)
+        self.calls: dict[str, int] = {}
+
+    async def make_request(self, bot, method, timeout=None):
+        name = type(method).__name__
+        self.calls[name] = self.calls.get(name, 0) + 1
+        params = {k: getattr(method, k, None) for k in ("chat_id", "text", "caption", "message_id")}
+        result = self.fake._result(name.lower(), params)
+        response = self.check_response(bot, method, 200, json.dumps({"ok": True, "result": result}))
+        return response.result
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+# ======================== ГЕНЕРАТОРЫ АПДЕЙТОВ =========================
+
+class Traffic:
+    def __init__(self, seed: int):
+        self.rnd = random.Random(seed)
+        self.update_id = 0
+        self.message_id = 0
+        self.new_user = USER_BASE + SUBSCRIBERS
+
+    def _ids(self) -> tuple[int, int]:
+        self.update_id += 1
+        self.message_id += 1
+        return self.update_id, self.message_id
+
+    def _words(self, n: int) -> str:
+        return " ".join(self.rnd.choice(WORDS) for _ in range(n))
+
+    def _button(self) -> str:
+        trig = self.rnd.choice(("/button", f"@{BOT_USERNAME}"))
+        return f'{trig} {self._words(2)} "https://example.com/{self.rnd.randint(1, 999)}"'
+
+    def _user(self, uid: int) -> dict:
+        return {"id": uid, "is_bot": False, "first_name": "U", "username": f"u{uid}"}
+
+    def business(self, triggered: bool = True) -> dict:
+        uid, mid = self._ids()
+        owner = USER_BASE + self.rnd.randrange(SUBSCRIBERS)
+        text = f"{self._words(8)} {self._button()}" if triggered else self._words(12)
+        return {"update_id": uid, "business_message": {
+            "message_id": mid, "date": int(time.time()), "business_connection_id": f"bc{owner}",
+            "chat": {"id": owner + 10_000_000, "type": "private", "first_name": "C"},
+            "from": self._user(owner), "text": text,
+        }}
+
+    def business_plain(self) -> dict:
+        return self.business(triggered=False)
+
+    def channel(self, triggered: bool) -> dict:
+        uid, mid = self._ids()
+        text = f"{self._words(20)} {self._button()}" if triggered else self._words(self.rnd.randint(10, 80))
+        return {"update_id": uid, "channel_post": {
+            "message_id": mid, "date": int(time.time()),
+            "chat": {"id": CHANNEL_BASE - self.rnd.randrange(CHANNELS), "type": "channel", "title": "Ch"},
+            "text": text,
+        }}
+
+    def channel_trigger(self) -> dict:
+        return self.channel(True)
+
+    def channel_plain(self) -> dict:
+        return self.channel(False)
+
+    def start(self) -> dict:
+        uid, mid = self._ids()
+        self.new_user += 1
+        return {"update_id": uid, "message": {
+            "message_id": mid, "date": int(time.time()),
+            "chat": {"id": self.new_user, "type": "private", "first_name": "U"},
+            "from": self._user(self.new_user),
+            "text": "/start", "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+        }}
+
+    def payment(self) -> dict:
+        uid, mid = self._ids()
+        buyer = USER_BASE + self.rnd.randrange(SUBSCRIBERS)
+        plan = self.rnd.choice(main.PLANS)
+        price = main.PRICE_TABLE[(plan, False, False)]
+        payload = main.make_quote(plan, price=price, discount=False)
+        if self.rnd.random() < 0.5:
+            return {"update_id": uid, "pre_checkout_query": {
+                "id": str(uid), "from": self._user(buyer), "currency": "XTR",
+                "total_amount": price, "invoice_payload": payload,
+            }}
+        return {"update_id": uid, "message": {
+            "message_id": mid, "date": int(time.time()),
+            "chat": {"id": buyer, "type": "private", "first_name": "U"}, "from": self._user(buyer),
+            "successful_payment": {"currency": "XTR", "total_amount": price,
+                                   "invoice_payload": payload, "telegram_payment_charge_id": f"ch{uid}",
+                                   "provider_payment_charge_id": ""},
+        }}
+
+
+MIXES = ("business", "business_plain", "channel_trigger", "channel_plain", "start", "payment")
+DEFAULT_MIX = "business=3,business_plain=2,channel_trigger=2,channel_plain=4,start=1,payment=1"
+
+
+def parse_mix(spec: str) -> dict[str, float]:
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in MIXES:
+            raise SystemExit(f"unknown mix {name!r}; choose from {', '.join(MIXES)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def build_updates(bot: Bot, mix: dict[str, float], n: int, seed: int) -> list[tuple[str, Update]]:
+    traffic = Traffic(seed)
+    rnd = random.Random(seed + 1)
+    names, weights = list(mix), list(mix.values())
+    out = []
+    for _ in range(n):
+        kind = rnd.choices(names, weights)[0]
+        raw = getattr(traffic, kind)()
+        out.append((kind, Update.model_validate(raw, context={"bot": bot})))
+    return out
+
+# ======================== ПРОГОН =========================
+
+
+async def prepare():
+    for i in range(SUBSCRIBERS):
+        await main.ensure_user(USER_BASE + i, f"u{USER_BASE + i}")
+    await main.DB.flush()
+    for i in range(SUBSCRIBERS):
+        await main.grant_subscription(USER_BASE + i, "forever")
+    for i in range(CHANNELS):
+        await main.channel_add_owned(USER_BASE, CHANNEL_BASE - i, f"Ch{i}", None)
+    await main.DB.flush()
+
+
+def _pct(sorted_vals: list[float], q: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    return sorted_vals[min(len(sorted_vals) - 1, max(0, round(q * (len(sorted_vals) - 1))))]
+
+
+async def run(args) -> int:
+    session = RecordingSession()
+    bot = Bot("42:loadgen", session=session)
+    main.set_bot_username(BOT_USERNAME)
+    await prepare()
+    dp = main.build_dispatcher()
+
+    mix = parse_mix(args.mix)
+    updates = build_updates(bot, mix, args.updates + args.warmup, args.seed)
+    warm, updates = updates[:args.warmup], updates[args.warmup:]
+    for _kind, u in warm:
+        try:
+            await dp.feed_update(bot, u)
+        except Exception:
+            pass  # ошибки считаются в основном прогоне
+    await main.DB.flush()
+    session.calls.clear()
+
+    lat: dict[str, list[float]] = {k: [] for k in mix}
+    errors: dict[str, int] = {k: 0 for k in mix}
+    queue: asyncio.Queue = asyncio.Queue()
+    for item in updates:
+        queue.put_nowait(item)
+
+    async def worker():
+        perf = time.perf_counter
+        while True:
+            try:
+                kind, u = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            t0 = perf()
+            try:
+                await dp.feed_update(bot, u)
+            except Exception as e:
+                # упавший апдейт не доходит до конца обработки — в задержки и пропускную способность не идёт
+                errors[kind] += 1
+                if errors[kind] == 1 and args.verbose:
+                    print(f"{kind}: {type(e).__name__}: {e}", file=sys.stderr)
+                continue
+            lat[kind].append(perf() - t0)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(max(1, args.concurrency))))
+    handled = time.perf_counter() - t0
+    await main.DB.flush()
+    total = time.perf_counter() - t0
+
+    all_lat = sorted(x for v in lat.values() for x in v)
+    ok = len(all_lat)
+    failed = sum(errors.values())
+    rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"updates: {len(updates)} (ok {ok}, failed {failed})  concurrency: {args.concurrency}  mix: {args.mix}")
+    print(f"throughput: {ok / handled:,.0f} upd/s (handlers), "
+          f"{ok / total:,.0f} upd/s (incl. final DB flush {1000 * (total - handled):.0f} ms) — only successful updates")
+    print(f"latency: p50 {_pct(all_lat, .5) * 1000:.2f} ms  p99 {_pct(all_lat, .99) * 1000:.2f} ms  "
+          f"max {all_lat[-1] * 1000 if all_lat else 0:.2f} ms")
+    print(f"peak RSS: {rss_kb / 1024:.1f} MiB")
+    print(f"\n{'mix':<16} {'count':>7} {'errors':>7} {'p50 ms':>8} {'p99 ms':>8} {'mean ms':>8}")
+    for kind, v in lat.items():
+        v.sort()
+        mean = statistics.fmean(v) * 1000 if v else 0.0
+        print(f"{kind:<16} {len(v):>7} {errors[kind]:>7} {_pct(v, .5) * 1000:>8.2f} {_pct(v, .99) * 1000:>8.2f} {mean:>8.2f}")
+    print("\nBot API calls: " + ", ".join(f"{k}={v}" for k, v in sorted(session.calls.items())))
+    if failed:
+        bad = ", ".join(f"{k}={v}" for k, v in errors.items() if v)
+        print(f"\nWARNING: {failed} updates failed ({bad}) — these mixes are not measured; "
+              f"rerun with -v to see the first error of each", file=sys.stderr)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({
+                "updates": len(updates), "ok": ok, "concurrency": args.concurrency, "mix": mix,
+                "throughput": ok / handled, "p50_ms": _pct(all_lat, .5) * 1000,
+                "p99_ms": _pct(all_lat, .99) * 1000, "peak_rss_mib": rss_kb / 1024,
+                "errors": errors, "calls": session.calls,
+            }, f, ensure_ascii=False, indent=2)
+    main.DB.close()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Синтетическая нагрузка через Dispatcher.feed_update")
+    ap.add_argument("--updates", type=int, default=20000)
+    ap.add_argument("--warmup", type=int, default=500)
+    ap.add_argument("--mix", default=DEFAULT_MIX, help=f"веса смесей, например {DEFAULT_MIX}")
+    ap.add_argument("--concurrency", type=int, default=32, help="одновременно обрабатываемых апдейтов")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--json", help="сохранить итог в файл")
+    ap.add_argument("-v", "--verbose", action="store_true", help="печатать первую ошибку каждой смеси")
+    sys.exit(asyncio.run(run(ap.parse_args())))
@@ -1,24 +1,50 @@
-# main.py — aiogram 3.7+
+# main.py — aiogram 3.8+
 import asyncio
+import base64
+import hashlib
+import heapq
+import hmac
 import json
+import logging
+import multiprocessing
 import os
+import queue
 import sqlite3
-import subprocess
+import signal
+import threading
+import time
 from datetime import datetime, timezone
+from functools import lru_cache, partial
 from urllib.parse import urlparse
 
-from aiogram import Bot, Dispatcher, Router, F
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot, Dispatcher, Router, F
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.enums import ChatType
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+)
 from aiogram.filters import CommandStart, Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.types import (
     Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, LabeledPrice,
-    BotCommand, ReplyKeyboardMarkup, KeyboardButton, PreCheckoutQuery
+    BotCommand, ReplyKeyboardMarkup, KeyboardButton, PreCheckoutQuery, Update, User, ChatMemberUpdated,
+    BufferedInputFile
 )
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
 import config
+import metrics
+from caches import ExpiringLRU
+from dbgate import DBGateway
+from fsmstore import SQLiteStorage
+from profiling import ProfileSession
+from recorder import UpdateRecorder
+from outbound import OutboundScheduler, PRIORITY_BULK, PRIORITY_HIGH, priority as outbound_priority
+from ratelimit import TokenBucket
 
 router = Router()
 BOT_UN = ""  # username бота (без @), подхватим при старте
@@ -32,10 +58,12 @@ def _db_connect():
     conn.execute("PRAGMA foreign_keys=ON;")
     return conn
 
-DB = _db_connect()
+# --- миграции схемы ---
+# Номер последней применённой миграции хранится в PRAGMA user_version.
+# Новая миграция = новая функция в конце MIGRATIONS; старые не меняем.
 
-def _db_init():
-    DB.execute("""
+def _m001_base(conn):
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS users (
             user_id     INTEGER PRIMARY KEY,
             username    TEXT,
@@ -43,7 +71,7 @@ def _db_init():
             created_at  INTEGER NOT NULL
         );
     """)
-    DB.execute("""
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS subscriptions (
             id          INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id     INTEGER NOT NULL,
@@ -55,7 +83,7 @@ def _db_init():
         );
     """)
     # старая схема channels могла быть без owner_id. создадим если нет
-    DB.execute("""
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS channels (
             chat_id     INTEGER PRIMARY KEY,
             title       TEXT,
@@ -65,40 +93,381 @@ def _db_init():
         );
     """)
     # миграции столбцов, если вдруг отсутствуют
-    cols = {r[1] for r in DB.execute("PRAGMA table_info(channels)")}
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(channels)")}
     if "owner_id" not in cols:
-        DB.execute("ALTER TABLE channels ADD COLUMN owner_id INTEGER;")
+        conn.execute("ALTER TABLE channels ADD COLUMN owner_id INTEGER;")
     if "username" not in cols:
-        DB.execute("ALTER TABLE channels ADD COLUMN username TEXT;")
-    DB.commit()
+        conn.execute("ALTER TABLE channels ADD COLUMN username TEXT;")
+
+def _m002_indexes(conn):
+    # индексы под горячие запросы
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_subscriptions_user_exp ON subscriptions(user_id, expires_at);")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_subscriptions_exp ON subscriptions(expires_at);")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_channels_owner ON channels(owner_id, added_at);")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_username_lower ON users(lower(username));")
+
+def _m003_entitlements(conn):
+    # текущее право пользователя одной строкой — поддерживается при каждой выдаче,
+    # чтобы не пересчитывать его по всей истории subscriptions
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS entitlements (
+            user_id      INTEGER PRIMARY KEY,
+            plan         TEXT NOT NULL,
+            active_until INTEGER,          -- NULL = навсегда
+            gifted_by    INTEGER
+        );
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_entitlements_until ON entitlements(active_until);")
+    conn.execute("""
+        INSERT OR REPLACE INTO entitlements(user_id, plan, active_until, gifted_by)
+        SELECT user_id, plan, expires_at, gifted_by FROM (
+            SELECT user_id, plan, expires_at, gifted_by,
+                   ROW_NUMBER() OVER (
+                       PARTITION BY user_id
+                       ORDER BY COALESCE(expires_at, 1<<62) DESC, id DESC
+                   ) AS rn
+            FROM subscriptions
+        ) WHERE rn = 1
+    """)
+
+def _m004_broadcasts(conn):
+    # рассылки с состоянием по каждому получателю; blocked_at — пользователь заблокировал бота
+    conn.execute("ALTER TABLE users ADD COLUMN blocked_at INTEGER;")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id              INTEGER PRIMARY KEY AUTOINCREMENT,
+            text            TEXT NOT NULL,
+            admin_chat_id   INTEGER NOT NULL,
+            progress_msg_id INTEGER,
+            status          TEXT NOT NULL,     -- running | done | cancelled
+            created_at      INTEGER NOT NULL,
+            finished_at     INTEGER
+        );
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            job_id      INTEGER NOT NULL,
+            user_id     INTEGER NOT NULL,
+            state       INTEGER NOT NULL DEFAULT 0,   -- 0 ждёт, 1 отправлено, 2 ошибка, 3 заблокирован
+            attempts    INTEGER NOT NULL DEFAULT 0,
+            error       TEXT,
+            PRIMARY KEY(job_id, user_id)
+        ) WITHOUT ROWID;
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bcast_state ON broadcast_recipients(job_id, state, user_id);")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bcast_jobs_status ON broadcast_jobs(status);")
+
+def _m005_fsm_states(conn):
+    # FSM-состояния мастеров (fsmstore.py); key — "bot:chat:user[...]", data — сжатый JSON
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            key         TEXT PRIMARY KEY,
+            state       TEXT,
+            data        BLOB,
+            touched_at  INTEGER NOT NULL
+        ) WITHOUT ROWID;
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_fsm_touched ON fsm_states(touched_at);")
+
+def _m006_stats_rollups(conn):
+    # свёртки для админской статистики: обновляются в тех же транзакциях, что и сами данные
+    #   stats_daily   — счётчики по дням (UTC): users, grants/<план>, revenue/<план>, purchases/self|gift
+    #   stats_totals  — те же счётчики за всё время
+    #   stats_active  — число текущих прав (entitlements) по плану и дню окончания (-1 = навсегда)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS stats_daily (
+            day     INTEGER NOT NULL,          -- unix-время // 86400
+            metric  TEXT NOT NULL,
+            key     TEXT NOT NULL DEFAULT '',
+            value   INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY(day, metric, key)
+        ) WITHOUT ROWID;
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS stats_totals (
+            metric  TEXT NOT NULL,
+            key     TEXT NOT NULL DEFAULT '',
+            value   INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY(metric, key)
+        ) WITHOUT ROWID;
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS stats_active (
+            until_day  INTEGER NOT NULL,
+            plan       TEXT NOT NULL,
+            n          INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY(until_day, plan)
+        ) WITHOUT ROWID;
+    """)
+    # заполняем по уже накопленным данным (выручку раньше не записывали — она начнётся с нуля)
+    conn.execute("""
+        INSERT INTO stats_daily(day, metric, key, value)
+        SELECT created_at / 86400, 'users', '', COUNT(*) FROM users GROUP BY created_at / 86400
+    """)
+    conn.execute("""
+        INSERT INTO stats_daily(day, metric, key, value)
+        SELECT created_at / 86400, 'grants', plan, COUNT(*) FROM subscriptions GROUP BY created_at / 86400, plan
+    """)
+    conn.execute("""
+        INSERT INTO stats_totals(metric, key, value)
+        SELECT metric, key, SUM(value) FROM stats_daily GROUP BY metric, key
+    """)
+    conn.execute("""
+        INSERT INTO stats_active(until_day, plan, n)
+        SELECT COALESCE(active_until / 86400, -1), plan, COUNT(*) FROM entitlements
+        GROUP BY COALESCE(active_until / 86400, -1), plan
+    """)
+
+def _m007_expiry_reminders(conn):
+    # reminded = active_until, о котором уже напомнили: продление меняет active_until,
+    # и новое напоминание снова становится нужным без отдельного сброса
+    conn.execute("ALTER TABLE entitlements ADD COLUMN reminded INTEGER;")
+
+def _m008_username_norm(conn):
+    # поиск по @username: нормализованная копия (без @, в нижнем регистре) с уникальным индексом.
+    # Username в Telegram переходит от одного пользователя к другому — при дублях в старых данных
+    # оставляем его за тем, кто появился позже.
+    conn.execute("ALTER TABLE users ADD COLUMN username_norm TEXT;")
+    conn.execute("UPDATE users SET username_norm = NULLIF(lower(ltrim(username, '@')), '')")
+    conn.execute("""
+        UPDATE users SET username_norm = NULL WHERE user_id IN (
+            SELECT user_id FROM (
+                SELECT user_id, ROW_NUMBER() OVER (
+                    PARTITION BY username_norm ORDER BY created_at DESC, user_id DESC
+                ) AS rn
+                FROM users WHERE username_norm IS NOT NULL
+            ) WHERE rn > 1
+        )
+    """)
+    conn.execute("DROP INDEX IF EXISTS idx_users_username_lower;")
+    conn.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_users_username_norm
+        ON users(username_norm) WHERE username_norm IS NOT NULL;
+    """)
+
+def _m009_settings(conn):
+    # служебные значения базы; signed_invoices_since — с какого момента счета выставляются
+    # подписанной котировкой (от него отсчитывается срок приёма счетов старого формата)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS settings (
+            key    TEXT PRIMARY KEY,
+            value  INTEGER
+        ) WITHOUT ROWID;
+    """)
+    conn.execute("INSERT OR IGNORE INTO settings(key, value) VALUES('signed_invoices_since', strftime('%s','now'))")
+
+MIGRATIONS = [
+    _m001_base,
+    _m002_indexes,
+    _m003_entitlements,
+    _m004_broadcasts,
+    _m005_fsm_states,
+    _m006_stats_rollups,
+    _m007_expiry_reminders,
+    _m008_username_norm,
+    _m009_settings,
+]
+
+def _db_init():
+    conn = _db_connect()
+    conn.isolation_level = None  # транзакции миграций открываем сами
+    try:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for n in range(version + 1, len(MIGRATIONS) + 1):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # несколько процессов (воркеры) стартуют одновременно: версию перечитываем под блокировкой
+                if conn.execute("PRAGMA user_version").fetchone()[0] >= n:
+                    conn.execute("COMMIT")
+                    continue
+                MIGRATIONS[n - 1](conn)
+                conn.execute(f"PRAGMA user_version={n}")
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+    finally:
+        conn.close()
 
 _db_init()
 
+# хендлеры работают с базой только через шлюз: записи — в одном потоке-писателе
+# (мелкие записи склеиваются в общие транзакции), чтения — из пула WAL-соединений
+DB = DBGateway(
+    config.DB_PATH,
+    readers=getattr(config, "DB_READERS", 4),
+    batch_max_ops=getattr(config, "DB_BATCH_MAX_OPS", 256),
+    batch_window_ms=getattr(config, "DB_BATCH_WINDOW_MS", 5),
+)
+
 def now_ts() -> int:
     return int(datetime.now(timezone.utc).timestamp())
 
-def ensure_user(user_id: int, username: str | None):
-    DB.execute(
-        "INSERT OR IGNORE INTO users(user_id, username, is_admin, created_at) VALUES(?,?,?,?)",
-        (user_id, (username or ""), 1 if user_id == getattr(config, "ADMIN_ID", 0) else 0, now_ts())
-    )
-    if username is not None:
-        DB.execute("UPDATE users SET username=? WHERE user_id=?", (username, user_id))
-    DB.commit()
-
-def has_active_subscription(user_id: int) -> bool:
+# --- статистика: инкрементальные свёртки ---
+# Каждое изменение данных добавляет дельту к счётчикам в той же транзакции,
+# поэтому админская статистика читает готовые числа, а не считает по таблицам.
+
+def _stat_add_tx(conn, metric: str, key: str = "", delta: int = 1, ts: int | None = None):
+    day = (ts if ts is not None else now_ts()) // 86400
+    conn.execute("""
+        INSERT INTO stats_daily(day, metric, key, value) VALUES(?,?,?,?)
+        ON CONFLICT(day, metric, key) DO UPDATE SET value = value + excluded.value
+    """, (day, metric, key, delta))
+    conn.execute("""
+        INSERT INTO stats_totals(metric, key, value) VALUES(?,?,?)
+        ON CONFLICT(metric, key) DO UPDATE SET value = value + excluded.value
+    """, (metric, key, delta))
+
+def _until_day(active_until: int | None) -> int:
+    return -1 if active_until is None else active_until // 86400
+
+def _stat_active_move_tx(conn, old, new):
+    # old/new — (plan, active_until) права пользователя до и после изменения (или None)
+    if old == new:
+        return
+    for row, delta in ((old, -1), (new, 1)):
+        if row is not None:
+            conn.execute("""
+                INSERT INTO stats_active(until_day, plan, n) VALUES(?,?,?)
+                ON CONFLICT(until_day, plan) DO UPDATE SET n = n + excluded.n
+            """, (_until_day(row[1]), row[0], delta))
+
+def _entitlement_row_tx(conn, user_id: int):
+    return conn.execute("SELECT plan, active_until FROM entitlements WHERE user_id=?", (user_id,)).fetchone()
+
+def normalize_username(username: str | None) -> str | None:
+    u = (username or "").strip().lstrip("@").lower()
+    return u or None
+
+def _ensure_user_tx(conn, user_id: int, username: str | None):
+    # -> (прежний username_norm этого пользователя, если сменился; забран ли norm у другого пользователя)
+    ts = now_ts()
+    norm = normalize_username(username)
+    moved = False
+    if norm is not None:
+        # username теперь у этого пользователя — у прежнего владельца (если был) снимаем;
+        # по индексу, и обычно без единой изменённой строки
+        moved = conn.execute("UPDATE users SET username_norm=NULL WHERE username_norm=? AND user_id!=?",
+                             (norm, user_id)).rowcount > 0
+    row = conn.execute("SELECT username, username_norm FROM users WHERE user_id=?", (user_id,)).fetchone()
+    if row is None:
+        conn.execute(
+            "INSERT INTO users(user_id, username, username_norm, is_admin, created_at) VALUES(?,?,?,?,?)",
+            (user_id, (username or ""), norm, 1 if user_id == getattr(config, "ADMIN_ID", 0) else 0, ts)
+        )
+        _stat_add_tx(conn, "users", ts=ts)
+        return None, moved
+    if username is None or (row[0], row[1]) == (username, norm):
+        return None, moved  # пишем, только если что-то изменилось
+    conn.execute("UPDATE users SET username=?, username_norm=? WHERE user_id=?", (username, norm, user_id))
+    return (row[1] if row[1] != norm else None), moved
+
+def _user_saved(user_id: int, norm: str | None, fut: asyncio.Future):
+    # после коммита: устаревшие записи @username -> id убираем здесь и в остальных воркерах
+    if fut.cancelled():
+        return
+    if fut.exception() is not None:
+        logging.error("ensure_user %s failed: %r", user_id, fut.exception())
+        return
+    old, moved = fut.result()
+    if old is not None:
+        invalidate_username(old)
+    if moved:
+        # здесь кэш уже указывает на нового владельца — сбрасываем только у других
+        publish_invalidation("uname", norm)
+
+async def ensure_user(user_id: int, username: str | None):
+    # пишем без ожидания: попадёт в ближайшую пачку — очередь писателя FIFO,
+    # так что последующие записи увидят пользователя
+    norm = normalize_username(username)
+    if norm is not None:
+        if USERNAME_CACHE.get(norm) != user_id:
+            _username_epoch_bump()  # чтение, начатое до этого, не должно перезаписать нового владельца
+        USERNAME_CACHE.set(norm, user_id, time.time() + USERNAME_CACHE_TTL)
+    DB.write_soon(_ensure_user_tx, user_id, username).add_done_callback(
+        partial(_user_saved, user_id, norm))
+
+# --- @username -> user_id ---
+# Положительные ответы кэшируем (ensure_user кладёт их сам); «не найден» — нет:
+# пользователь может написать боту через секунду, в том числе через другой воркер.
+# Смена username (переименование или переход ника к другому аккаунту) сбрасывает запись во всех процессах.
+USERNAME_CACHE = ExpiringLRU(maxsize=getattr(config, "USERNAME_CACHE_SIZE", 20000))
+USERNAME_CACHE_TTL = getattr(config, "USERNAME_CACHE_TTL", 600)
+_username_epoch = 0  # как _sub_epoch: ответ, прочитанный до сброса, в кэш не кладём
+
+def _username_epoch_bump():
+    global _username_epoch
+    _username_epoch += 1
+
+def _drop_username(norm: str):
+    _username_epoch_bump()
+    USERNAME_CACHE.pop(norm)
+
+def invalidate_username(norm: str):
+    _drop_username(norm)
+    publish_invalidation("uname", norm)
+
+async def find_user_by_username(username: str | None) -> int | None:
+    norm = normalize_username(username)
+    if norm is None:
+        return None
+    user_id = USERNAME_CACHE.get(norm)
+    if user_id is not None:
+        return user_id
+    epoch = _username_epoch
+    row = await DB.fetchone("SELECT user_id FROM users WHERE username_norm=?", (norm,))
+    if row is None:
+        return None
+    if epoch == _username_epoch:
+        USERNAME_CACHE.set(norm, int(row[0]), time.time() + USERNAME_CACHE_TTL)
+    return int(row[0])
+
+# --- межпроцессная инвалидация кэшей ---
+# В режиме воркеров (WORKERS > 1) у каждого процесса свои кэши; изменения,
+# сделанные в одном процессе, рассылаются остальным через front-процесс.
+# В обычном режиме publisher не задан и publish_invalidation ничего не делает.
+_invalidation_publisher = None
+
+def publish_invalidation(kind: str, key: int | str):
+    if _invalidation_publisher is not None:
+        _invalidation_publisher(kind, key)
+
+# --- кэш подписок ---
+# user_id -> активна ли подписка. Запись живёт ровно до окончания подписки
+# (для «навсегда» — бессрочно); отрицательный ответ кэшируем ненадолго.
+SUB_CACHE = ExpiringLRU(maxsize=getattr(config, "SUB_CACHE_SIZE", 50000))
+SUB_CACHE_NEGATIVE_TTL = getattr(config, "SUB_CACHE_NEGATIVE_TTL", 60)
+_sub_epoch = 0  # растёт при каждой инвалидации: ответ, прочитанный до неё, в кэш не кладём
+
+def _drop_subscription(user_id: int):
+    global _sub_epoch
+    _sub_epoch += 1
+    SUB_CACHE.pop(user_id)
+
+def invalidate_subscription(user_id: int):
+    _drop_subscription(user_id)
+    publish_invalidation("sub", user_id)
+
+async def has_active_subscription(user_id: int) -> bool:
+    cached = SUB_CACHE.get(user_id)
+    if cached is not None:
+        return cached
+    epoch = _sub_epoch
     ts = now_ts()
-    cur = DB.execute("""
-        SELECT 1 FROM subscriptions
+    row = await DB.fetchone("""
+        SELECT active_until FROM entitlements
         WHERE user_id = ?
-          AND (expires_at IS NULL OR expires_at > ?)
-        ORDER BY COALESCE(expires_at, 1<<62) DESC
-        LIMIT 1
+          AND (active_until IS NULL OR active_until > ?)
     """, (user_id, ts))
-    return cur.fetchone() is not None
+    if epoch != _sub_epoch:
+        return row is not None
+    if row is None:
+        SUB_CACHE.set(user_id, False, ts + SUB_CACHE_NEGATIVE_TTL)
+        return False
+    SUB_CACHE.set(user_id, True, row[0])  # row[0] = «активна до», NULL = навсегда
+    return True
 
-def grant_subscription(user_id: int, plan: str, gifted_by: int | None = None):
-    created = now_ts()
+def plan_expires_at(plan: str, created: int) -> int | None:
     exp = None
     if plan == "week":
         exp = created + 7 * 24 * 3600
@@ -110,43 +479,104 @@ def grant_subscription(user_id: int, plan: str, gifted_by: int | None = None):
         exp = None
     else:
         raise ValueError("Unknown plan")
+    return exp
+
+# --- entitlements: «текущая» подписка пользователя ---
+# Правило то же, что раньше в запросах по subscriptions: побеждает запись с самым
+# поздним сроком (навсегда — старше всех), при равенстве — более новая.
+# Обновляется в той же транзакции, что и вставка в subscriptions.
+
+def _entitlement_offer_tx(conn, user_id: int, plan: str, active_until: int | None, gifted_by: int | None):
+    old = _entitlement_row_tx(conn, user_id)
+    conn.execute("""
+        INSERT INTO entitlements(user_id, plan, active_until, gifted_by) VALUES(?,?,?,?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            plan=excluded.plan, active_until=excluded.active_until, gifted_by=excluded.gifted_by
+        WHERE COALESCE(excluded.active_until, 1<<62) >= COALESCE(entitlements.active_until, 1<<62)
+    """, (user_id, plan, active_until, gifted_by))
+    _stat_active_move_tx(conn, old, _entitlement_row_tx(conn, user_id))
+
+def _entitlement_rebuild_tx(conn, user_id: int):
+    # после удаления из истории (перенос подарка) пересчитываем по оставшимся записям
+    old = _entitlement_row_tx(conn, user_id)
+    conn.execute("DELETE FROM entitlements WHERE user_id=?", (user_id,))
+    conn.execute("""
+        INSERT INTO entitlements(user_id, plan, active_until, gifted_by)
+        SELECT user_id, plan, expires_at, gifted_by FROM subscriptions
+        WHERE user_id=?
+        ORDER BY COALESCE(expires_at, 1<<62) DESC, id DESC
+        LIMIT 1
+    """, (user_id,))
+    _stat_active_move_tx(conn, old, _entitlement_row_tx(conn, user_id))
 
-    DB.execute(
+def _grant_subscription_tx(conn, user_id: int, plan: str, gifted_by: int | None,
+                           purchase: tuple[str, int] | None = None):
+    # purchase — ("self" | "gift", сумма в Stars), если выдача оплачена;
+    # возвращает итоговое право пользователя (plan, active_until)
+    created = now_ts()
+    exp = plan_expires_at(plan, created)
+    conn.execute(
         "INSERT INTO subscriptions(user_id, plan, created_at, expires_at, gifted_by) VALUES(?,?,?,?,?)",
         (user_id, plan, created, exp, gifted_by)
     )
-    DB.commit()
+    _entitlement_offer_tx(conn, user_id, plan, exp, gifted_by)
+    _stat_add_tx(conn, "grants", plan, ts=created)
+    if purchase is not None:
+        _stat_add_tx(conn, "purchases", purchase[0], ts=created)
+        _stat_add_tx(conn, "revenue", plan, purchase[1], ts=created)
+    return _entitlement_row_tx(conn, user_id)
+
+async def get_entitlement(user_id: int):
+    # (plan, active_until, gifted_by) или None
+    return await DB.fetchone(
+        "SELECT plan, active_until, gifted_by FROM entitlements WHERE user_id=?", (user_id,)
+    )
+
+async def grant_subscription(user_id: int, plan: str, gifted_by: int | None = None,
+                             purchase: tuple[str, int] | None = None):
+    _plan, active_until = await DB.write_durable(_grant_subscription_tx, user_id, plan, gifted_by, purchase)
+    invalidate_subscription(user_id)
+    EXPIRY.track(user_id, active_until)
 
 # --- channels helpers (НОВОЕ) ---
-def channels_all_admin():
-    cur = DB.execute("""
+# привязанные каналы держим в памяти: channel_handler получает посты из всех каналов,
+# где есть бот, и непривязанные должны отсекаться без похода в базу
+ALLOWED_CHANNELS: set[int] = set()
+
+async def load_channel_allowlist():
+    rows = await DB.fetchall("SELECT chat_id FROM channels")
+    ALLOWED_CHANNELS.clear()
+    ALLOWED_CHANNELS.update(int(r[0]) for r in rows)
+
+async def channels_all_admin():
+    return await DB.fetchall("""
         SELECT c.chat_id, c.title, c.username, c.owner_id,
                COALESCE(u.username,'') AS owner_username
         FROM channels c
         LEFT JOIN users u ON u.user_id = c.owner_id
         ORDER BY c.added_at DESC
     """)
-    return cur.fetchall()
 
-def channels_by_owner(owner_id: int):
-    cur = DB.execute("""
+async def channels_by_owner(owner_id: int):
+    return await DB.fetchall("""
         SELECT chat_id, COALESCE(title,''), COALESCE(username,'')
         FROM channels
         WHERE owner_id=?
         ORDER BY added_at DESC
     """, (owner_id,))
-    return cur.fetchall()
 
-def channel_add_owned(owner_id: int, chat_id: int, title: str | None, username: str | None):
-    DB.execute("""
+async def channel_add_owned(owner_id: int, chat_id: int, title: str | None, username: str | None):
+    await DB.execute("""
         INSERT OR REPLACE INTO channels(chat_id, title, added_at, owner_id, username)
         VALUES(?,?,?,?,?)
     """, (chat_id, title or "", now_ts(), owner_id, (username or "")))
-    DB.commit()
+    ALLOWED_CHANNELS.add(chat_id)
+    publish_invalidation("chan+", chat_id)
 
-def channel_remove(chat_id: int):
-    DB.execute("DELETE FROM channels WHERE chat_id=?", (chat_id,))
-    DB.commit()
+async def channel_remove(chat_id: int):
+    ALLOWED_CHANNELS.discard(chat_id)
+    publish_invalidation("chan-", chat_id)
+    await DB.execute("DELETE FROM channels WHERE chat_id=?", (chat_id,))
 
 def admin_username_norm() -> str:
     u = getattr(config, "ADMIN_USERNAME", "") or ""
@@ -161,8 +591,7 @@ def is_admin(user_id: int, username: str | None) -> bool:
 
 def is_channel_allowed(chat_id: int) -> bool:
     # теперь работаем ТОЛЬКО в привязанных каналах
-    cur = DB.execute("SELECT 1 FROM channels WHERE chat_id=? LIMIT 1", (chat_id,))
-    return cur.fetchone() is not None
+    return chat_id in ALLOWED_CHANNELS
 
 # ======================== ТЕКСТЫ/КНОПКИ ЛИЧКИ =========================
 
@@ -174,33 +603,60 @@ HOWTO = (
     "Можно несколько кнопок в одном сообщении."
 )
 
-def kb_private(user_id: int | None = None, username: str | None = None) -> ReplyKeyboardMarkup:
+# Клавиатуры собираются один раз: личная — по роли пользователя, меню планов — по текущим ценам.
+# Разметка aiogram не меняется после отправки, поэтому один объект отдаём всем.
+ROLE_GUEST, ROLE_SUBSCRIBER, ROLE_ADMIN = "guest", "subscriber", "admin"
+
+async def user_role(user_id: int | None, username: str | None = None) -> str:
+    if not user_id:
+        return ROLE_GUEST
+    if is_admin(user_id, username):
+        return ROLE_ADMIN
+    # has_active_subscription отвечает из SUB_CACHE, в базу идёт только на промахе
+    return ROLE_SUBSCRIBER if await has_active_subscription(user_id) else ROLE_GUEST
+
+def _build_kb_private(role: str) -> ReplyKeyboardMarkup:
     rows = [
         [KeyboardButton(text="Как подключить")],
         [KeyboardButton(text="Планы и оплата")],
     ]
     # «Создать кнопку» — только подписчики или админ
-    if user_id and (has_active_subscription(user_id) or is_admin(user_id, username)):
+    if role in (ROLE_SUBSCRIBER, ROLE_ADMIN):
         rows.insert(1, [KeyboardButton(text="Создать кнопку")])
         rows.append([KeyboardButton(text="Привязать канал")])
         rows.append([KeyboardButton(text="Мои каналы")])
-    if user_id and is_admin(user_id, username):
+    if role == ROLE_ADMIN:
         rows.append([KeyboardButton(text="Админ панель")])
     return ReplyKeyboardMarkup(keyboard=rows, resize_keyboard=True)
 
+_KB_PRIVATE = {role: _build_kb_private(role) for role in (ROLE_GUEST, ROLE_SUBSCRIBER, ROLE_ADMIN)}
+
+async def kb_private(user_id: int | None = None, username: str | None = None) -> ReplyKeyboardMarkup:
+    return _KB_PRIVATE[await user_role(user_id, username)]
+
+_KB_ADMIN = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🔗 Привязать канал (инструкция ниже)", callback_data="admin:bindinfo")],
+    [InlineKeyboardButton(text="📋 Каналы (все)", callback_data="admin:listch")],
+    [InlineKeyboardButton(text="🗑 Отвязать канал (по ID)", callback_data="admin:unbindask")],
+    [InlineKeyboardButton(text="🎁 Выдать подписку", callback_data="admin:grant")],
+    [InlineKeyboardButton(text="📣 Рассылка", callback_data="admin:broadcast")],
+    [InlineKeyboardButton(text="🧮 Статистика", callback_data="admin:stats")],
+    [InlineKeyboardButton(text="🧩 Сделать кнопку (мастер)", callback_data="admin:makebtn")],
+    [InlineKeyboardButton(text="🩺 Профилирование", callback_data="admin:profile")],
+])
+
+_KB_PROFILE = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="Сэмплинг 30 с", callback_data="admin:prof:sample:sec:30"),
+     InlineKeyboardButton(text="Сэмплинг 120 с", callback_data="admin:prof:sample:sec:120")],
+    [InlineKeyboardButton(text="cProfile 30 с", callback_data="admin:prof:cprofile:sec:30"),
+     InlineKeyboardButton(text="cProfile 200 апдейтов", callback_data="admin:prof:cprofile:upd:200")],
+])
+
 def kb_admin() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔗 Привязать канал (инструкция ниже)", callback_data="admin:bindinfo")],
-        [InlineKeyboardButton(text="📋 Каналы (все)", callback_data="admin:listch")],
-        [InlineKeyboardButton(text="🗑 Отвязать канал (по ID)", callback_data="admin:unbindask")],
-        [InlineKeyboardButton(text="🎁 Выдать подписку", callback_data="admin:grant")],
-        [InlineKeyboardButton(text="📣 Рассылка", callback_data="admin:broadcast")],
-        [InlineKeyboardButton(text="🧮 Статистика", callback_data="admin:stats")],
-        [InlineKeyboardButton(text="🧩 Сделать кнопку (мастер)", callback_data="admin:makebtn")],
-    ])
+    return _KB_ADMIN
 
-def kb_plans_inline() -> InlineKeyboardMarkup:
-    p = config.PRICES_STARS
+def _kb_plans_for(prices: tuple[tuple[str, int], ...]) -> InlineKeyboardMarkup:
+    p = dict(prices)
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text=f"💳 Неделя — {p['week']}⭐", callback_data="buy:week"),
          InlineKeyboardButton(text="🎁 Подарить", callback_data="gift:week")],
@@ -212,6 +668,13 @@ def kb_plans_inline() -> InlineKeyboardMarkup:
          InlineKeyboardButton(text="🎁 Подарить", callback_data="gift:forever")],
     ])
 
+def plan_prices() -> tuple[tuple[str, int], ...]:
+    # цены без скидки из PRICE_TABLE — те же, что попадут в счёт и в проверку pre_checkout
+    return tuple((plan, PRICE_TABLE[(plan, False, False)]) for plan in PLANS)
+
+def kb_plans_inline() -> InlineKeyboardMarkup:
+    return _KB_PLANS  # собирается один раз после PRICE_TABLE
+
 # ======================== СОСТОЯНИЯ =========================
 
 class CreateBtn(StatesGroup):
@@ -239,6 +702,14 @@ class GiftBuy(StatesGroup):
 class ChannelLink(StatesGroup):
     wait_forward = State()
 
+# состояния мастеров живут в базе (переживают перезапуск), активные — в памяти;
+# мастер, брошенный дольше FSM_TTL секунд, забывается
+FSM_STORAGE = SQLiteStorage(
+    DB,
+    ttl=getattr(config, "FSM_TTL", 86400),
+    hot_size=getattr(config, "FSM_HOT_SIZE", 10000),
+)
+
 # ======================== УТИЛИТЫ КНОПОК/ПАРСИНГ =========================
 
 QUOTE_OPEN = ['"', '«', '“']
@@ -258,76 +729,111 @@ def is_allowed_url(url: str) -> bool:
         return True
     return False
 
-def _find_next(text_lower: str, start: int, triggers_lower: list[str]):
-    nxt, tlen = None, 0
-    for t in triggers_lower:
-        j = text_lower.find(t, start)
-        if j != -1 and (nxt is None or j < nxt):
-            nxt, tlen = j, len(t)
-    return nxt, tlen
-
-def parse_buttons_and_clean(text: str, triggers: list[str]):
-    text_lower = text.lower()
-    triggers_lower = [t.lower() for t in triggers]
+_QUOTE_CLOSE = {'«': '»', '“': '”'}
+
+class ButtonMatcher:
+    # Разбор «триггер Название "ссылка"» за один проход слева направо.
+    # Для каждого триггера и каждой открывающей кавычки помним позицию ближайшего
+    # вхождения и ищем следующее, только когда курсор ушёл за неё, — поэтому каждый
+    # участок текста просматривается одним str.find не больше раза на шаблон,
+    # и длинные подписи больше не стоят O(длина × число кнопок).
+    # При совпадении позиций побеждает триггер, стоящий раньше в списке (как и раньше).
+
+    def __init__(self, triggers: list[str]):
+        self.triggers = tuple(triggers)
+        self._lowered = tuple(t.lower() for t in triggers)
+
+    def parse(self, text: str):
+        lowered = self._lowered
+        if not lowered:
+            return text, []
+        text_lower = text.lower()
+        trig_pos = [text_lower.find(t) for t in lowered]
+        if max(trig_pos) == -1:
+            return text, []
+        quote_pos_cache = {q: text.find(q) for q in QUOTE_OPEN}
+        n = len(text)
+
+        i = 0
+        buttons, spans = [], []
+        no_close_from = {}  # закрывающая кавычка -> позиция, начиная с которой её нет
+
+        while True:
+            idx, tlen = -1, 0
+            for k, t in enumerate(lowered):
+                p = trig_pos[k]
+                if p != -1 and p < i:
+                    p = trig_pos[k] = text_lower.find(t, i)
+                if p != -1 and (idx == -1 or p < idx):
+                    idx, tlen = p, len(t)
+            if idx == -1:
+                break
 
-    i = 0
-    buttons, spans = [], []
+            j = idx + tlen
+            while j < n and text[j].isspace():
+                j += 1
+
+            quote_pos, quote_char = -1, None
+            for q, p in quote_pos_cache.items():
+                if p != -1 and p < j:
+                    p = quote_pos_cache[q] = text.find(q, j)
+                if p != -1 and (quote_pos == -1 or p < quote_pos):
+                    quote_pos, quote_char = p, q
+            if quote_pos == -1:
+                break  # дальше открывающих кавычек нет — кнопок больше не будет
+
+            label = text[j:quote_pos].strip()
+            if not label:
+                i = quote_pos + 1
+                continue
+
+            close_char = _QUOTE_CLOSE.get(quote_char, '"')
+            url_start = quote_pos + 1
+            absent_from = no_close_from.get(close_char)
+            url_end = -1 if absent_from is not None and url_start >= absent_from else text.find(close_char, url_start)
+            if url_end == -1:
+                no_close_from[close_char] = url_start
+                i = url_start
+                continue
+
+            url = text[url_start:url_end].strip()
+            if not is_allowed_url(url):
+                i = url_end + 1
+                continue
+
+            buttons.append((label, url))
+            spans.append((idx, url_end + 1))
+            i = url_end + 1
 
-    while True:
-        idx, tlen = _find_next(text_lower, i, triggers_lower)
-        if idx is None:
-            break
-
-        j = idx + tlen
-        while j < len(text) and text[j].isspace():
-            j += 1
-
-        quote_pos, quote_char = None, None
-        k = j
-        while k < len(text):
-            ch = text[k]
-            if ch in QUOTE_OPEN:
-                quote_pos, quote_char = k, ch
+            if len(buttons) >= MAX_BTNS:
                 break
-            k += 1
-        if quote_pos is None:
-            i = j
-            continue
-
-        label = text[j:quote_pos].strip()
-        if not label:
-            i = quote_pos + 1
-            continue
-
-        close_char = {'«': '»', '“': '”'}.get(quote_char, '"')
-        url_start = quote_pos + 1
-        url_end = text.find(close_char, url_start)
-        if url_end == -1:
-            i = url_start
-            continue
-
-        url = text[url_start:url_end].strip()
-        if not is_allowed_url(url):
-            i = url_end + 1
-            continue
 
-        buttons.append((label, url))
-        spans.append((idx, url_end + 1))
-        i = url_end + 1
+        if not buttons:
+            return text, []
 
-        if len(buttons) >= MAX_BTNS:
-            break
+        out, last = [], 0
+        for s, e in spans:  # спаны идут по возрастанию
+            out.append(text[last:s])
+            last = e
+        out.append(text[last:])
+        clean = " ".join("".join(out).split()) or " "
+        return clean, buttons
 
-    if not buttons:
-        return text, []
+@lru_cache(maxsize=16)
+def _matcher_for(triggers: tuple[str, ...]) -> ButtonMatcher:
+    return ButtonMatcher(list(triggers))
+
+def parse_buttons_and_clean(text: str, triggers: list[str]):
+    return _matcher_for(tuple(triggers)).parse(text)
+
+def bot_triggers() -> list[str]:
+    triggers = ["/button"]
+    if BOT_UN:
+        triggers.append(f"@{BOT_UN}")
+    return triggers
 
-    out, last = [], 0
-    for s, e in sorted(spans):
-        out.append(text[last:s])
-        last = e
-    out.append(text[last:])
-    clean = " ".join("".join(out).split()) or " "
-    return clean, buttons
+# пересобирается в main(), когда станет известен username бота
+BUTTON_MATCHER = ButtonMatcher(bot_triggers())
 
 def build_kb_from_pairs(buttons: list[tuple[str, str]]) -> InlineKeyboardMarkup:
     rows = [[InlineKeyboardButton(text=label, url=url)] for label, url in buttons]
@@ -357,25 +863,143 @@ def plan_human(plan: str) -> str:
         "forever": "Навсегда",
     }[plan]
 
-def calc_price_stars(plan: str, *, is_gift: bool, buyer_has_sub: bool) -> int:
+def _price_stars(plan: str, *, is_gift: bool, buyer_has_sub: bool) -> int:
     base = int(config.PRICES_STARS[plan])
     if is_gift and buyer_has_sub:
         return max(1, round(base * (100 - int(config.GIFT_DISCOUNT_PCT)) / 100))
     return base
 
+# все цены считаются один раз при старте: (план, подарок, скидка) -> Stars;
+# кнопки и текст /plans берут цены отсюда же, новые цены из config — только после перезапуска
+PRICE_TABLE: dict[tuple[str, bool, bool], int] = {
+    (plan, is_gift, disc): _price_stars(plan, is_gift=is_gift, buyer_has_sub=disc)
+    for plan in PLANS for is_gift in (False, True) for disc in (False, True)
+}
+
+_KB_PLANS = _kb_plans_for(plan_prices())
+
+def calc_price_stars(plan: str, *, is_gift: bool, buyer_has_sub: bool) -> int:
+    return PRICE_TABLE[(plan, is_gift, is_gift and buyer_has_sub)]
+
+# --- payload счёта: подписанная котировка ---
+# q1|<подпись>|<план>|<s/g>|<скидка 0/1>|<цена>|<время, base36>|<получатель: "", i<id base36>, @username>
+# Подпись — HMAC-SHA256 (обрезанный до 12 байт) по всему, что после неё; ключ — INVOICE_SECRET
+# или производный от токена. pre_checkout проверяет котировку целиком в памяти, без базы.
+# Старые счета с JSON-payload (без времени выписки) принимаются только до LEGACY_INVOICES_UNTIL:
+# INVOICE_LEGACY_UNTIL из config или срок котировки после перехода на подписанный формат.
+QUOTE_VERSION = "q1"
+QUOTE_TTL_SEC = getattr(config, "INVOICE_QUOTE_TTL_SEC", 7 * 24 * 3600)
+
+def _legacy_invoices_until() -> int:
+    until = int(getattr(config, "INVOICE_LEGACY_UNTIL", 0) or 0)
+    if until:
+        return until
+    conn = _db_connect()
+    try:
+        row = conn.execute("SELECT value FROM settings WHERE key='signed_invoices_since'").fetchone()
+    finally:
+        conn.close()
+    return int(row[0]) + QUOTE_TTL_SEC
+
+LEGACY_INVOICES_UNTIL = _legacy_invoices_until()
+_QUOTE_KEY = hashlib.sha256(
+    f"invoice:{getattr(config, 'INVOICE_SECRET', '') or config.BOT_TOKEN}".encode()
+).digest()
+_PLAN_CODE = {"week": "w", "month": "m", "year": "y", "forever": "f"}
+_CODE_PLAN = {v: k for k, v in _PLAN_CODE.items()}
+
+def _quote_sig(body: str) -> str:
+    digest = hmac.new(_QUOTE_KEY, body.encode(), hashlib.sha256).digest()[:12]
+    return base64.urlsafe_b64encode(digest).decode()
+
+def _b36(n: int) -> str:
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    out = ""
+    while True:
+        n, r = divmod(n, 36)
+        out = digits[r] + out
+        if not n:
+            return out
+
+def make_quote(plan: str, *, price: int, discount: bool, gift_to_user_id: int | None = None,
+               gift_to_username: str | None = None, issued: int | None = None) -> str:
+    if gift_to_user_id:
+        target = "i" + _b36(int(gift_to_user_id))
+    elif gift_to_username:
+        target = "@" + gift_to_username
+    else:
+        target = ""
+    is_gift = bool(target)
+    body = "|".join((_PLAN_CODE[plan], "g" if is_gift else "s", "1" if discount else "0", str(price),
+                     _b36(issued if issued is not None else now_ts()), target))
+    return f"{QUOTE_VERSION}|{_quote_sig(body)}|{body}"
+
+def _parse_quote(payload: str) -> dict:
+    parts = payload.split("|", 7)
+    if len(parts) != 8 or parts[0] != QUOTE_VERSION:
+        return {}
+    _v, sig, code, kind, disc, price, issued, target = parts
+    if code not in _CODE_PLAN or kind not in ("s", "g") or not price.isdigit():
+        return {}
+    try:
+        issued_ts = int(issued, 36)
+        to_uid = int(target[1:], 36) if target.startswith("i") else None
+    except ValueError:
+        return {}
+    return {
+        "kind": "subscription",
+        "type": "gift" if kind == "g" else "self",
+        "plan": _CODE_PLAN[code],
+        "gift_to_user_id": to_uid,
+        "gift_to_username": target[1:] if target.startswith("@") else None,
+        "price": int(price),
+        "discount": disc == "1",
+        "issued": issued_ts,
+        "signed": hmac.compare_digest(sig, _quote_sig(payload.split("|", 2)[2])),
+    }
+
 def make_invoice_payload(data: dict) -> str:
+    # старый формат (JSON); новые счета используют make_quote
     return json.dumps(data, separators=(",", ":"), ensure_ascii=False)
 
 def parse_invoice_payload(payload: str) -> dict:
+    if payload.startswith(QUOTE_VERSION + "|"):
+        return _parse_quote(payload)
     try:
         return json.loads(payload)
     except Exception:
         return {}
 
+def check_pre_checkout(payload: str, currency: str, total_amount: int, *, now: int | None = None) -> str | None:
+    # None — можно принимать оплату, иначе текст ошибки для пользователя
+    data = parse_invoice_payload(payload)
+    plan = data.get("plan")
+    if data.get("kind") != "subscription" or plan not in PLANS or currency != "XTR":
+        return "Счёт не распознан. Запроси новый через /buy."
+    is_gift = data.get("type") == "gift"
+    now = now if now is not None else now_ts()
+    if "signed" not in data:
+        # счёт старого формата: срок выписки неизвестен — принимаем только в переходный период,
+        # и цена должна быть одной из допустимых для плана
+        if now > LEGACY_INVOICES_UNTIL:
+            return "Счёт устарел. Запроси новый через /buy."
+        if total_amount in (PRICE_TABLE[(plan, is_gift, False)], PRICE_TABLE[(plan, is_gift, True)]):
+            return None
+        return "Цена изменилась. Запроси новый счёт через /buy."
+    if not data["signed"]:
+        return "Счёт недействителен. Запроси новый через /buy."
+    if now - data["issued"] > QUOTE_TTL_SEC:
+        return "Счёт устарел. Запроси новый через /buy."
+    if total_amount != data["price"] or data["price"] != PRICE_TABLE.get((plan, is_gift, data["discount"])):
+        return "Цена изменилась. Запроси новый счёт через /buy."
+    return None
+
 async def send_subscription_invoice(m: Message, plan: str, *, gift_to_user_id: int | None = None, gift_to_username: str | None = None):
     buyer_id = m.from_user.id
-    buyer_has = has_active_subscription(buyer_id)
-    price = calc_price_stars(plan, is_gift=(gift_to_user_id is not None or gift_to_username is not None), buyer_has_sub=buyer_has)
+    is_gift = gift_to_user_id is not None or gift_to_username is not None
+    # подписка дарителя влияет только на цену подарка
+    buyer_has = is_gift and await has_active_subscription(buyer_id)
+    price = calc_price_stars(plan, is_gift=is_gift, buyer_has_sub=buyer_has)
 
     title = f"Подписка: {plan_human(plan)}"
     if gift_to_user_id or gift_to_username:
@@ -390,13 +1014,8 @@ async def send_subscription_invoice(m: Message, plan: str, *, gift_to_user_id: i
             desc_lines.append("У дарителя нет активной подписки — скидка не применяется.")
     description = "\n".join(desc_lines)
 
-    payload = make_invoice_payload({
-        "kind": "subscription",
-        "type": "gift" if (gift_to_user_id or gift_to_username) else "self",
-        "plan": plan,
-        "gift_to_user_id": gift_to_user_id,
-        "gift_to_username": gift_to_username,
-    })
+    payload = make_quote(plan, price=price, discount=buyer_has,
+                         gift_to_user_id=gift_to_user_id, gift_to_username=gift_to_username)
 
     prices = [LabeledPrice(label=f"{plan_human(plan)}", amount=price)]  # XTR
 
@@ -416,78 +1035,135 @@ async def send_subscription_invoice(m: Message, plan: str, *, gift_to_user_id: i
 
 # ======================== ХЕЛПЕР: ОТПРАВКА/РЕДАКТИРОВАНИЕ С УЧЁТОМ МЕДИА =========================
 
-async def edit_or_send_with_media(m: Message, clean_text: str, buttons: list[tuple[str, str]]):
-    kb = build_kb_from_pairs(buttons)
-    has_photo = bool(m.photo)
-    has_video = bool(m.video)
+# Подпись есть у фото, видео, документов, анимаций, аудио и голосовых: если в сообщении нет text,
+# значит триггер пришёл в подписи — её и правим. Каналы правим на месте (сохраняются просмотры,
+# реакции и ссылка на пост), а удаляем и отправляем заново, только если редактировать нельзя.
 
-    # бизнес-сообщения
-    if m.business_connection_id:
-        if has_photo or has_video:
-            await m.bot.edit_message_caption(
-                business_connection_id=m.business_connection_id,
-                chat_id=m.chat.id,
-                message_id=m.message_id,
-                caption=clean_text,
-                reply_markup=kb
-            )
-        else:
-            await m.bot.edit_message_text(
-                business_connection_id=m.business_connection_id,
-                chat_id=m.chat.id,
-                message_id=m.message_id,
-                text=clean_text,
-                reply_markup=kb
-            )
-        return
+async def _edit_in_place(m: Message, clean_text: str, kb: InlineKeyboardMarkup, **extra):
+    if m.text is not None:
+        await m.bot.edit_message_text(chat_id=m.chat.id, message_id=m.message_id,
+                                      text=clean_text, reply_markup=kb, **extra)
+    else:
+        await m.bot.edit_message_caption(chat_id=m.chat.id, message_id=m.message_id,
+                                         caption=clean_text, reply_markup=kb, **extra)
 
-    # каналы/чаты
+async def _bot_can_edit(m: Message) -> bool:
+    try:
+        member = await cached_bot_member(m.bot, m.chat.id)
+    except Exception:
+        return True  # права неизвестны — пробуем, при ошибке будет повторная отправка
+    return bool(getattr(member, "can_edit_messages", False))
+
+async def _resend(m: Message, clean_text: str, kb: InlineKeyboardMarkup):
+    # сначала новая копия, потом удаление — если отправка не удалась, пост не пропадёт
+    if m.text is not None:
+        await m.bot.send_message(chat_id=m.chat.id, text=clean_text, reply_markup=kb)
+    else:
+        # copy_message переносит любое медиа с новой подписью
+        await m.bot.copy_message(chat_id=m.chat.id, from_chat_id=m.chat.id, message_id=m.message_id,
+                                 caption=clean_text, reply_markup=kb)
     try:
         await m.bot.delete_message(m.chat.id, m.message_id)
     except Exception:
         pass
 
-    if has_photo:
-        await m.bot.send_photo(
-            chat_id=m.chat.id,
-            photo=m.photo[-1].file_id,
-            caption=clean_text,
-            reply_markup=kb
-        )
-    elif has_video:
-        vid = getattr(m.video, "file_id", None) or (m.video[-1].file_id if isinstance(m.video, list) else None)
-        await m.bot.send_video(
-            chat_id=m.chat.id,
-            video=vid,
-            caption=clean_text,
-            reply_markup=kb
-        )
-    else:
-        await m.bot.send_message(chat_id=m.chat.id, text=clean_text, reply_markup=kb)
+async def edit_or_send_with_media(m: Message, clean_text: str, buttons: list[tuple[str, str]]):
+    kb = build_kb_from_pairs(buttons)
+
+    # бизнес-сообщения — только редактирование
+    if m.business_connection_id:
+        await _edit_in_place(m, clean_text, kb, business_connection_id=m.business_connection_id)
+        return
+
+    # каналы/чаты
+    if await _bot_can_edit(m):
+        try:
+            await _edit_in_place(m, clean_text, kb)
+            return
+        except TelegramBadRequest as e:
+            if "not modified" in e.message:
+                return
+            logging.info("edit in %s failed (%s), resending", m.chat.id, e.message)
+    await _resend(m, clean_text, kb)
+
+# ======================== КЭШ BOT API =========================
+# get_me не меняется за время жизни процесса — берём один раз.
+# Права бота в канале, список админов и разрешение @username -> chat живут CHAT_CACHE_TTL секунд;
+# смена статуса бота в чате (my_chat_member) сбрасывает записи этого чата во всех процессах.
+
+BOT_ME: User | None = None
+CHAT_CACHE = ExpiringLRU(getattr(config, "CHAT_CACHE_SIZE", 2000))
+CHAT_CACHE_TTL = getattr(config, "CHAT_CACHE_TTL", 300)
+
+async def bot_me(bot: Bot) -> User:
+    global BOT_ME
+    if BOT_ME is None:
+        BOT_ME = await bot.get_me()
+    return BOT_ME
+
+async def cached_bot_member(bot: Bot, chat_id: int):
+    key = ("me", chat_id)
+    member = CHAT_CACHE.get(key)
+    if member is None:
+        member = await bot.get_chat_member(chat_id, (await bot_me(bot)).id)
+        CHAT_CACHE.set_ttl(key, member, CHAT_CACHE_TTL)
+    return member
+
+async def cached_chat_admins(bot: Bot, chat_id: int):
+    key = ("admins", chat_id)
+    admins = CHAT_CACHE.get(key)
+    if admins is None:
+        admins = await bot.get_chat_administrators(chat_id)
+        CHAT_CACHE.set_ttl(key, admins, CHAT_CACHE_TTL)
+    return admins
+
+async def cached_get_chat(bot: Bot, ref: int | str):
+    # ref — chat_id или "@username"; id по username не зависит от прав бота, хватает TTL
+    key = ("chat", ref.lower() if isinstance(ref, str) else ref)
+    chat = CHAT_CACHE.get(key)
+    if chat is None:
+        chat = await bot.get_chat(ref)
+        CHAT_CACHE.set_ttl(key, chat, CHAT_CACHE_TTL)
+    return chat
+
+def _drop_chat(chat_id: int):
+    CHAT_CACHE.pop(("me", chat_id))
+    CHAT_CACHE.pop(("admins", chat_id))
+    CHAT_CACHE.pop(("chat", chat_id))
+
+def invalidate_chat(chat_id: int):
+    _drop_chat(chat_id)
+    publish_invalidation("chat", chat_id)
+
+@router.my_chat_member()
+async def on_my_chat_member(upd: ChatMemberUpdated):
+    # бота добавили/сняли с админки/выгнали — кэшированные права больше не верны
+    invalidate_chat(upd.chat.id)
 
 # ======================== ЛИЧКА: БАЗОВОЕ =========================
 
 @router.message(CommandStart(), (F.chat.type == ChatType.PRIVATE))
 async def start_private(m: Message):
-    ensure_user(m.from_user.id, m.from_user.username)
+    await ensure_user(m.from_user.id, m.from_user.username)
+    DB.write_behind(_user_unblocked_tx, m.from_user.id)
     await m.answer(
         "Привет! Я помогу подключить бота к Telegram Business.\n"
         "Чтобы пользоваться в бизнес-чатах и каналах — нужна подписка.\n"
         "Команды: /plans, /buy, /gift, /status, /howto, /admin\n",
-        reply_markup=kb_private(m.from_user.id, m.from_user.username)
+        reply_markup=await kb_private(m.from_user.id, m.from_user.username)
     )
 
 @router.message(Command("howto"), (F.chat.type == ChatType.PRIVATE))
 @router.message(F.text.lower() == "как подключить", (F.chat.type == ChatType.PRIVATE))
 async def howto_private(m: Message):
-    await m.answer(HOWTO, reply_markup=kb_private(m.from_user.id, m.from_user.username))
+    await m.answer(HOWTO, reply_markup=await kb_private(m.from_user.id, m.from_user.username))
 
 # ======================== ЛИЧКА: ПЛАНЫ/СТАТУС/ПОКУПКА/ПОДАРОК =========================
 
 @router.message(F.text.lower() == "планы и оплата", (F.chat.type == ChatType.PRIVATE))
 @router.message(Command("plans"), (F.chat.type == ChatType.PRIVATE))
 async def plans_cmd(m: Message):
-    prices = config.PRICES_STARS
+    prices = dict(plan_prices())
     lines = [
         "<b>Подписки (Telegram Stars)</b>",
         f"• Неделя — {prices['week']}⭐",
@@ -502,27 +1178,20 @@ async def plans_cmd(m: Message):
 
 @router.message(Command("status"), (F.chat.type == ChatType.PRIVATE))
 async def status_cmd(m: Message):
-    ensure_user(m.from_user.id, m.from_user.username)
-    active = has_active_subscription(m.from_user.id)
+    await ensure_user(m.from_user.id, m.from_user.username)
+    active = await has_active_subscription(m.from_user.id)
     if not active:
         await m.answer("У тебя нет активной подписки. /plans — посмотреть тарифы.",
-                       reply_markup=kb_private(m.from_user.id, m.from_user.username))
+                       reply_markup=await kb_private(m.from_user.id, m.from_user.username))
         return
 
-    cur = DB.execute("""
-        SELECT plan, expires_at, gifted_by, created_at
-        FROM subscriptions
-        WHERE user_id=?
-        ORDER BY COALESCE(expires_at, 1<<62) DESC, id DESC
-        LIMIT 1
-    """, (m.from_user.id,))
-    row = cur.fetchone()
+    row = await get_entitlement(m.from_user.id)
     if not row:
         await m.answer("У тебя нет активной подписки. /plans",
-                       reply_markup=kb_private(m.from_user.id, m.from_user.username))
+                       reply_markup=await kb_private(m.from_user.id, m.from_user.username))
         return
 
-    plan, expires_at, gifted_by, created_at = row
+    plan, expires_at, gifted_by = row
     if expires_at is None:
         exp_str = "никогда (навсегда)"
     else:
@@ -535,39 +1204,39 @@ async def status_cmd(m: Message):
     ]
     if gifted_by:
         s.append(f"Получена в подарок (от ID {gifted_by}).")
-    await m.answer("\n".join(s), reply_markup=kb_private(m.from_user.id, m.from_user.username))
+    await m.answer("\n".join(s), reply_markup=await kb_private(m.from_user.id, m.from_user.username))
 
 @router.message(Command("buy"), (F.chat.type == ChatType.PRIVATE))
 async def buy_cmd(m: Message):
-    ensure_user(m.from_user.id, m.from_user.username)
+    await ensure_user(m.from_user.id, m.from_user.username)
     parts = (m.text or "").split(maxsplit=1)
     if len(parts) < 2:
         await m.answer("Формат: /buy <week|month|year|forever>",
-                       reply_markup=kb_private(m.from_user.id, m.from_user.username))
+                       reply_markup=await kb_private(m.from_user.id, m.from_user.username))
         return
     plan = normalize_plan(parts[1])
     if plan is None:
         await m.answer("Не понял план. Используй: week, month, year, forever.",
-                       reply_markup=kb_private(m.from_user.id, m.from_user.username))
+                       reply_markup=await kb_private(m.from_user.id, m.from_user.username))
         return
     await send_subscription_invoice(m, plan)
 
 @router.message(Command("gift"), (F.chat.type == ChatType.PRIVATE))
 async def gift_cmd(m: Message):
-    ensure_user(m.from_user.id, m.from_user.username)
-    if not has_active_subscription(m.from_user.id):
+    await ensure_user(m.from_user.id, m.from_user.username)
+    if not await has_active_subscription(m.from_user.id):
         await m.answer("Дарить можно только если у тебя уже есть активная подписка. Сначала оформи /buy.",
-                       reply_markup=kb_private(m.from_user.id, m.from_user.username))
+                       reply_markup=await kb_private(m.from_user.id, m.from_user.username))
         return
     parts = (m.text or "").split()
     if len(parts) < 2:
         await m.answer("Формат: в ответ на сообщение получателя — /gift <plan>\nили /gift <plan> @username",
-                       reply_markup=kb_private(m.from_user.id, m.from_user.username))
+                       reply_markup=await kb_private(m.from_user.id, m.from_user.username))
         return
     plan = normalize_plan(parts[1])
     if plan is None:
         await m.answer("Не понял план. Используй: week, month, year, forever.",
-                       reply_markup=kb_private(m.from_user.id, m.from_user.username))
+                       reply_markup=await kb_private(m.from_user.id, m.from_user.username))
         return
 
     gift_to_user_id = None
@@ -575,13 +1244,14 @@ async def gift_cmd(m: Message):
 
     if m.reply_to_message and m.reply_to_message.from_user:
         gift_to_user_id = m.reply_to_message.from_user.id
-        ensure_user(gift_to_user_id, m.reply_to_message.from_user.username)
+        await ensure_user(gift_to_user_id, m.reply_to_message.from_user.username)
     else:
         if len(parts) >= 3 and parts[2].startswith("@"):
-            gift_to_username = parts[2][1:]
+            gift_to_user_id = await find_user_by_username(parts[2])
+            gift_to_username = None if gift_to_user_id else parts[2][1:]
         else:
             await m.answer("Укажи получателя: ответь на его сообщение или добавь @username.",
-                           reply_markup=kb_private(m.from_user.id, m.from_user.username))
+                           reply_markup=await kb_private(m.from_user.id, m.from_user.username))
             return
 
     await send_subscription_invoice(m, plan, gift_to_user_id=gift_to_user_id, gift_to_username=gift_to_username)
@@ -603,7 +1273,7 @@ async def cb_gift(cq: CallbackQuery, state: FSMContext):
     if cq.message.chat.type != ChatType.PRIVATE:
         await cq.answer("Открой меня в личке, там оформим подарок.", show_alert=True)
         return
-    if not has_active_subscription(cq.from_user.id):
+    if not await has_active_subscription(cq.from_user.id):
         await cq.answer("Сначала оформи свою подписку — тогда будет скидка −25% на подарок.", show_alert=True)
         return
     plan = normalize_plan(cq.data.split(":", 1)[1])
@@ -628,11 +1298,13 @@ async def gift_target_step(m: Message, state: FSMContext):
 
     if m.reply_to_message and m.reply_to_message.from_user:
         gift_to_user_id = m.reply_to_message.from_user.id
-        ensure_user(gift_to_user_id, m.reply_to_message.from_user.username)
+        await ensure_user(gift_to_user_id, m.reply_to_message.from_user.username)
     else:
         t = (m.text or "").strip()
         if t.startswith("@"):
-            gift_to_username = t[1:]
+            # уже писал боту — дарим сразу по id, без /activategift после оплаты
+            gift_to_user_id = await find_user_by_username(t)
+            gift_to_username = None if gift_to_user_id else t[1:]
         else:
             await m.answer("Укажи получателя: ответь на его сообщение или пришли @username.")
             return
@@ -648,22 +1320,22 @@ async def gift_target_step(m: Message, state: FSMContext):
 
 @router.message((F.chat.type == ChatType.PRIVATE) & (F.text == "Создать кнопку"))
 async def create_btn_start(m: Message, state: FSMContext):
-    if not (has_active_subscription(m.from_user.id) or is_admin(m.from_user.id, m.from_user.username)):
+    if not (await has_active_subscription(m.from_user.id) or is_admin(m.from_user.id, m.from_user.username)):
         await m.answer("Эта функция доступна по подписке. Оформи /plans и возвращайся 🙌",
-                       reply_markup=kb_private(m.from_user.id, m.from_user.username))
+                       reply_markup=await kb_private(m.from_user.id, m.from_user.username))
         return
     await state.set_state(CreateBtn.text)
     await m.answer(
         "Ок! Отправь текст сообщения, который я опубликую с кнопкой.\n\n"
         "Можно использовать HTML (<b>жирный</b>, <i>курсив</i> и т.д.).\n\n"
         "Для отмены — /cancel",
-        reply_markup=kb_private(m.from_user.id, m.from_user.username)
+        reply_markup=await kb_private(m.from_user.id, m.from_user.username)
     )
 
 @router.message(Command("cancel"), (F.chat.type == ChatType.PRIVATE))
 async def create_btn_cancel(m: Message, state: FSMContext):
     await state.clear()
-    await m.answer("Отменил. Что дальше?", reply_markup=kb_private(m.from_user.id, m.from_user.username))
+    await m.answer("Отменил. Что дальше?", reply_markup=await kb_private(m.from_user.id, m.from_user.username))
 
 @router.message(CreateBtn.text, (F.chat.type == ChatType.PRIVATE))
 async def create_btn_got_text(m: Message, state: FSMContext):
@@ -698,16 +1370,27 @@ async def create_btn_got_url(m: Message, state: FSMContext):
     await m.answer(text, reply_markup=kb)
     await state.clear()
     await m.answer("Готово! Хочешь ещё одну? Нажми «Создать кнопку».",
-                   reply_markup=kb_private(m.from_user.id, m.from_user.username))
+                   reply_markup=await kb_private(m.from_user.id, m.from_user.username))
 
 # ======================== PAYMENTS CALLBACKS =========================
 
 @router.pre_checkout_query()
 async def on_pre_checkout(q: PreCheckoutQuery, bot: Bot):
-    await bot.answer_pre_checkout_query(q.id, ok=True)
+    # у Telegram на ответ считанные секунды: проверяем только по payload и таблице цен
+    error = check_pre_checkout(q.invoice_payload, q.currency, q.total_amount)
+    with outbound_priority(PRIORITY_HIGH):
+        if error is None:
+            await bot.answer_pre_checkout_query(q.id, ok=True)
+        else:
+            await bot.answer_pre_checkout_query(q.id, ok=False, error_message=error)
 
 @router.message(F.successful_payment)
 async def on_success_payment(m: Message):
+    # ответы об оплате идут вне очереди исходящих
+    with outbound_priority(PRIORITY_HIGH):
+        await _handle_success_payment(m)
+
+async def _handle_success_payment(m: Message):
     sp = m.successful_payment
     data = parse_invoice_payload(sp.invoice_payload)
     kind = data.get("kind")
@@ -721,65 +1404,72 @@ async def on_success_payment(m: Message):
         return
 
     buyer_id = m.from_user.id
-    ensure_user(buyer_id, m.from_user.username)
+    await ensure_user(buyer_id, m.from_user.username)
 
     if data.get("type") == "gift":
+        purchase = ("gift", sp.total_amount)
         to_uid = data.get("gift_to_user_id")
         to_un = data.get("gift_to_username")
         if to_uid:
-            ensure_user(to_uid, None)
-            grant_subscription(to_uid, plan, gifted_by=buyer_id)
+            await ensure_user(to_uid, None)
+            await grant_subscription(to_uid, plan, gifted_by=buyer_id, purchase=purchase)
             await m.answer(f"Подарочная подписка «{plan_human(plan)}» активирована для ID {to_uid}.")
             try:
                 await m.bot.send_message(to_uid, f"Тебе подарили подписку: {plan_human(plan)} 🎁")
             except Exception:
                 pass
         else:
-            grant_subscription(buyer_id, plan, gifted_by=buyer_id)  # временно у дарителя
+            await grant_subscription(buyer_id, plan, gifted_by=buyer_id, purchase=purchase)  # временно у дарителя
             await m.answer(
                 "Оплата прошла. Я временно привязал подписку к тебе. "
                 "Как только получатель напишет боту, перешлю — пришли команду /activategift @username"
             )
     else:
-        grant_subscription(buyer_id, plan)
+        await grant_subscription(buyer_id, plan, purchase=("self", sp.total_amount))
         await m.answer(f"Подписка активирована: {plan_human(plan)} ✅")
 
+def _move_last_subscription_tx(conn, from_id: int, to_id: int) -> str | None:
+    last = conn.execute("""
+        SELECT id, plan, created_at, expires_at FROM subscriptions
+        WHERE user_id=? ORDER BY id DESC LIMIT 1
+    """, (from_id,)).fetchone()
+    if not last:
+        return None
+    sid, plan, created_at, expires_at = last
+    conn.execute("DELETE FROM subscriptions WHERE id=?", (sid,))
+    conn.execute(
+        "INSERT INTO subscriptions(user_id, plan, created_at, expires_at, gifted_by) VALUES(?,?,?,?,?)",
+        (to_id, plan, created_at, expires_at, from_id)
+    )
+    _entitlement_rebuild_tx(conn, from_id)
+    _entitlement_offer_tx(conn, to_id, plan, expires_at, from_id)
+    return plan
+
 @router.message(Command("activategift"), (F.chat.type == ChatType.PRIVATE))
 async def activate_gift(m: Message):
     parts = (m.text or "").split(maxsplit=1)
     if len(parts) < 2 or not parts[1].startswith("@"):
         await m.answer("Формат: /activategift @username",
-                       reply_markup=kb_private(m.from_user.id, m.from_user.username))
+                       reply_markup=await kb_private(m.from_user.id, m.from_user.username))
         return
     username = parts[1][1:]
 
-    cur = DB.execute("SELECT user_id FROM users WHERE lower(username)=lower(?)", (username.lower(),))
-    row = cur.fetchone()
-    if not row:
+    target_id = await find_user_by_username(username)
+    if not target_id:
         await m.answer("Этот пользователь ещё не писал боту. Попроси его нажать /start.",
-                       reply_markup=kb_private(m.from_user.id, m.from_user.username))
+                       reply_markup=await kb_private(m.from_user.id, m.from_user.username))
         return
-    target_id = int(row[0])
 
-    cur2 = DB.execute("""
-        SELECT id, plan, created_at, expires_at FROM subscriptions
-        WHERE user_id=? ORDER BY id DESC LIMIT 1
-    """, (m.from_user.id,))
-    last = cur2.fetchone()
-    if not last:
+    plan = await DB.write_durable(_move_last_subscription_tx, m.from_user.id, target_id)
+    if not plan:
         await m.answer("У тебя нет подписки для переноса.",
-                       reply_markup=kb_private(m.from_user.id, m.from_user.username))
+                       reply_markup=await kb_private(m.from_user.id, m.from_user.username))
         return
-    sid, plan, created_at, expires_at = last
-
-    DB.execute("DELETE FROM subscriptions WHERE id=?", (sid,))
-    DB.commit()
-
-    DB.execute(
-        "INSERT INTO subscriptions(user_id, plan, created_at, expires_at, gifted_by) VALUES(?,?,?,?,?)",
-        (target_id, plan, created_at, expires_at, m.from_user.id)
-    )
-    DB.commit()
+    invalidate_subscription(m.from_user.id)
+    invalidate_subscription(target_id)
+    row = await get_entitlement(target_id)
+    if row:
+        EXPIRY.track(target_id, row[1])
 
     await m.answer(f"Подарок активирован для @{username} ({plan_human(plan)}).")
     try:
@@ -791,9 +1481,9 @@ async def activate_gift(m: Message):
 
 @router.message((F.chat.type == ChatType.PRIVATE) & (F.text == "Привязать канал"))
 async def user_link_channel(m: Message, state: FSMContext):
-    if not (has_active_subscription(m.from_user.id) or is_admin(m.from_user.id, m.from_user.username)):
+    if not (await has_active_subscription(m.from_user.id) or is_admin(m.from_user.id, m.from_user.username)):
         await m.answer("Привязка канала доступна только по подписке.",
-                       reply_markup=kb_private(m.from_user.id, m.from_user.username))
+                       reply_markup=await kb_private(m.from_user.id, m.from_user.username))
         return
     await m.answer("Перешли сюда любое сообщение из канала, который хочешь привязать.\n"
                    "Ты должен быть владельцем (creator) канала, а бот — админом канала.")
@@ -810,7 +1500,7 @@ async def user_link_channel_step(m: Message, state: FSMContext):
     chat_id = ch.id
     # проверка прав бота в канале
     try:
-        me_member = await m.bot.get_chat_member(chat_id, (await m.bot.get_me()).id)
+        me_member = await cached_bot_member(m.bot, chat_id)
         if me_member.status not in ("administrator", "creator"):
             await m.answer("Бот должен быть администратором канала. Добавь его админом и повтори.")
             return
@@ -820,7 +1510,7 @@ async def user_link_channel_step(m: Message, state: FSMContext):
 
     # проверка, что пользователь — владелец (creator)
     try:
-        admins = await m.bot.get_chat_administrators(chat_id)
+        admins = await cached_chat_admins(m.bot, chat_id)
         creator = next((a for a in admins if a.status == "creator"), None)
         if not creator or creator.user.id != m.from_user.id:
             await m.answer("Ты не являешься владельцем (creator) этого канала.")
@@ -829,14 +1519,14 @@ async def user_link_channel_step(m: Message, state: FSMContext):
         await m.answer("Не удалось получить администраторов канала.")
         return
 
-    channel_add_owned(m.from_user.id, chat_id, ch.title, ch.username)
+    await channel_add_owned(m.from_user.id, chat_id, ch.title, ch.username)
     await state.clear()
     await m.answer(f"Канал <b>{ch.title}</b> привязан ✅",
-                   reply_markup=kb_private(m.from_user.id, m.from_user.username))
+                   reply_markup=await kb_private(m.from_user.id, m.from_user.username))
 
 @router.message((F.chat.type == ChatType.PRIVATE) & (F.text == "Мои каналы"))
 async def my_channels_list(m: Message):
-    rows = channels_by_owner(m.from_user.id)
+    rows = await channels_by_owner(m.from_user.id)
     if not rows:
         await m.answer("У тебя нет привязанных каналов.")
         return
@@ -855,8 +1545,7 @@ async def unlink_channel_cb(cq: CallbackQuery):
 
     # если не админ — можно отвязать только свой канал
     if not is_admin(cq.from_user.id, cq.from_user.username):
-        cur = DB.execute("SELECT owner_id FROM channels WHERE chat_id=?", (chat_id,))
-        row = cur.fetchone()
+        row = await DB.fetchone("SELECT owner_id FROM channels WHERE chat_id=?", (chat_id,))
         if not row or int(row[0]) != cq.from_user.id:
             await cq.answer("Ты не можешь отвязать этот канал.", show_alert=True)
             return
@@ -866,13 +1555,409 @@ async def unlink_channel_cb(cq: CallbackQuery):
         await cq.bot.leave_chat(chat_id)
     except Exception:
         pass
-    channel_remove(chat_id)
+    await channel_remove(chat_id)
     await cq.answer("Канал отвязан.", show_alert=True)
     try:
         await cq.message.delete()
     except Exception:
         pass
 
+# ======================== РАССЫЛКА =========================
+# Задание рассылки хранится в базе вместе с состоянием каждого получателя,
+# поэтому перезапуск процесса (в т.ч. автообновление) не теряет прогресс:
+# незавершённые задания подхватываются в main().
+
+BCAST_PENDING, BCAST_SENT, BCAST_FAILED, BCAST_BLOCKED = 0, 1, 2, 3
+BROADCAST_CONCURRENCY = getattr(config, "BROADCAST_CONCURRENCY", 8)
+BROADCAST_RATE = getattr(config, "BROADCAST_RATE", 25)              # сообщений в секунду на всю рассылку
+BROADCAST_MAX_ATTEMPTS = getattr(config, "BROADCAST_MAX_ATTEMPTS", 5)
+BROADCAST_PROGRESS_SEC = getattr(config, "BROADCAST_PROGRESS_SEC", 5)
+_BCAST_PAGE = 500
+
+def _broadcast_create_tx(conn, text: str, admin_chat_id: int) -> int:
+    cur = conn.execute(
+        "INSERT INTO broadcast_jobs(text, admin_chat_id, status, created_at) VALUES(?,?,'running',?)",
+        (text, admin_chat_id, now_ts())
+    )
+    job_id = cur.lastrowid
+    conn.execute("""
+        INSERT INTO broadcast_recipients(job_id, user_id)
+        SELECT ?, user_id FROM users WHERE blocked_at IS NULL
+    """, (job_id,))
+    return job_id
+
+def _broadcast_result_tx(conn, job_id: int, user_id: int, state: int, attempts: int, error: str | None):
+    conn.execute(
+        "UPDATE broadcast_recipients SET state=?, attempts=?, error=? WHERE job_id=? AND user_id=?",
+        (state, attempts, error, job_id, user_id)
+    )
+    if state == BCAST_BLOCKED:
+        conn.execute("UPDATE users SET blocked_at=? WHERE user_id=?", (now_ts(), user_id))
+
+def _broadcast_finish_tx(conn, job_id: int, status: str):
+    conn.execute(
+        "UPDATE broadcast_jobs SET status=?, finished_at=? WHERE id=? AND status='running'",
+        (status, now_ts(), job_id)
+    )
+
+def _user_unblocked_tx(conn, user_id: int):
+    conn.execute("UPDATE users SET blocked_at=NULL WHERE user_id=? AND blocked_at IS NOT NULL", (user_id,))
+
+def kb_broadcast(job_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⏹ Остановить", callback_data=f"bcast:cancel:{job_id}")],
+    ])
+
+class BroadcastJob:
+    def __init__(self, job_id: int, text: str, admin_chat_id: int, progress_msg_id: int | None):
+        self.id = job_id
+        self.text = text
+        self.admin_chat_id = admin_chat_id
+        self.progress_msg_id = progress_msg_id
+        self.counts = {BCAST_PENDING: 0, BCAST_SENT: 0, BCAST_FAILED: 0, BCAST_BLOCKED: 0}
+        self.cancelled = False
+        self.last_progress = ""
+
+    def progress_text(self, final_status: str | None = None) -> str:
+        c = self.counts
+        total = sum(c.values())
+        done = total - c[BCAST_PENDING]
+        head = {
+            None: f"📣 Рассылка #{self.id}: {done}/{total}",
+            "done": f"📣 Рассылка #{self.id} завершена",
+            "cancelled": f"📣 Рассылка #{self.id} остановлена: {done}/{total}",
+        }[final_status]
+        return (f"{head}\n"
+                f"Успехов: {c[BCAST_SENT]}, ошибок: {c[BCAST_FAILED]}, заблокировали бота: {c[BCAST_BLOCKED]}")
+
+class BroadcastEngine:
+    # Ограниченная параллельность + общий бюджет сообщений в секунду.
+    # 429 (RetryAfter) ставит на паузу весь бюджет — лимит у Telegram общий на бота.
+    def __init__(self, *, concurrency: int = BROADCAST_CONCURRENCY, rate: float = BROADCAST_RATE,
+                 max_attempts: int = BROADCAST_MAX_ATTEMPTS, progress_sec: float = BROADCAST_PROGRESS_SEC):
+        self.concurrency = max(1, int(concurrency))
+        self.bucket = TokenBucket(rate, burst=max(1, int(rate)))
+        self.max_attempts = max(1, int(max_attempts))
+        self.progress_sec = progress_sec
+        self.jobs: dict[int, BroadcastJob] = {}
+        self._tasks: dict[int, asyncio.Task] = {}
+
+    async def create(self, bot: Bot, text: str, admin_chat_id: int) -> BroadcastJob:
+        job_id = await DB.write_durable(_broadcast_create_tx, text, admin_chat_id)
+        job = BroadcastJob(job_id, text, admin_chat_id, None)
+        job.counts[BCAST_PENDING] = (await DB.fetchone(
+            "SELECT COUNT(*) FROM broadcast_recipients WHERE job_id=?", (job_id,)))[0]
+        try:
+            job.last_progress = job.progress_text()
+            msg = await bot.send_message(admin_chat_id, job.last_progress, reply_markup=kb_broadcast(job_id))
+            job.progress_msg_id = msg.message_id
+            await DB.execute("UPDATE broadcast_jobs SET progress_msg_id=? WHERE id=?", (msg.message_id, job_id))
+        except Exception:
+            pass
+        self._start(bot, job)
+        return job
+
+    async def resume_all(self, bot: Bot, owns=None):
+        # owns(admin_chat_id) — в режиме воркеров задание подхватывает процесс, которому
+        # принадлежит чат админа (туда же придёт нажатие «Остановить»)
+        rows = await DB.fetchall(
+            "SELECT id, text, admin_chat_id, progress_msg_id FROM broadcast_jobs WHERE status='running'"
+        )
+        for job_id, text, admin_chat_id, progress_msg_id in rows:
+            if job_id in self._tasks or (owns is not None and not owns(admin_chat_id)):
+                continue
+            job = BroadcastJob(job_id, text, admin_chat_id, progress_msg_id)
+            for state, n in await DB.fetchall(
+                "SELECT state, COUNT(*) FROM broadcast_recipients WHERE job_id=? GROUP BY state", (job_id,)
+            ):
+                job.counts[state] = n
+            self._start(bot, job)
+
+    async def suspend(self):
+        # остановка процесса: задачи снимаем, статус в базе не трогаем (resume_all подхватит)
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def cancel(self, job_id: int) -> bool:
+        job = self.jobs.get(job_id)
+        if not job:
+            return False
+        job.cancelled = True
+        return True
+
+    def _start(self, bot: Bot, job: BroadcastJob):
+        self.jobs[job.id] = job
+        task = asyncio.create_task(self._run(bot, job))
+        self._tasks[job.id] = task
+        task.add_done_callback(lambda _t, jid=job.id: (self._tasks.pop(jid, None), self.jobs.pop(jid, None)))
+
+    async def wait(self, job_id: int):
+        task = self._tasks.get(job_id)
+        if task:
+            await task
+
+    async def _send_one(self, bot: Bot, job: BroadcastJob, user_id: int) -> tuple[int, int, str | None]:
+        error = None
+        for attempt in range(1, self.max_attempts + 1):
+            await self.bucket.acquire()
+            try:
+                with outbound_priority(PRIORITY_BULK):
+                    await bot.send_message(user_id, job.text)
+                return BCAST_SENT, attempt, None
+            except TelegramRetryAfter as e:
+                self.bucket.pause(e.retry_after)
+                error = f"retry_after {e.retry_after}"
+            except TelegramForbiddenError as e:
+                return BCAST_BLOCKED, attempt, e.message
+            except TelegramBadRequest as e:
+                return BCAST_FAILED, attempt, e.message  # повтор не поможет
+            except (TelegramNetworkError, TelegramServerError) as e:
+                error = str(e)
+                await asyncio.sleep(min(30, 2 ** attempt))
+            except Exception as e:
+                return BCAST_FAILED, attempt, repr(e)
+        return BCAST_FAILED, self.max_attempts, error
+
+    async def _worker(self, bot: Bot, job: BroadcastJob, queue: asyncio.Queue):
+        while True:
+            user_id = await queue.get()
+            try:
+                if user_id is None:
+                    return
+                if job.cancelled:
+                    continue
+                try:
+                    state, attempts, error = await self._send_one(bot, job, user_id)
+                    await DB.write(_broadcast_result_tx, job.id, user_id, state, attempts, error)
+                except Exception:
+                    # воркер не должен умереть: иначе раздатчик навсегда встанет на полной очереди
+                    logging.exception("broadcast %d: recipient %s failed", job.id, user_id)
+                    state = BCAST_FAILED
+                job.counts[BCAST_PENDING] -= 1
+                job.counts[state] += 1
+            finally:
+                queue.task_done()
+
+    async def _update_progress(self, bot: Bot, job: BroadcastJob, final_status: str | None = None):
+        text = job.progress_text(final_status)
+        if not job.progress_msg_id or text == job.last_progress:
+            return
+        job.last_progress = text
+        try:
+            await bot.edit_message_text(
+                chat_id=job.admin_chat_id, message_id=job.progress_msg_id,
+                text=text,
+                reply_markup=None if final_status else kb_broadcast(job.id),
+            )
+        except Exception:
+            pass  # «message is not modified» и т.п.
+
+    async def _progress_loop(self, bot: Bot, job: BroadcastJob):
+        while True:
+            await asyncio.sleep(self.progress_sec)
+            await self._update_progress(bot, job)
+
+    async def _run(self, bot: Bot, job: BroadcastJob):
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 4)
+        workers = [asyncio.create_task(self._worker(bot, job, queue)) for _ in range(self.concurrency)]
+        ticker = asyncio.create_task(self._progress_loop(bot, job))
+        try:
+            last_uid = None
+            while not job.cancelled:
+                # keyset-пагинация: результаты пишутся асинхронно, поэтому не полагаемся на state
+                rows = await DB.fetchall("""
+                    SELECT user_id FROM broadcast_recipients
+                    WHERE job_id=? AND state=? AND (? IS NULL OR user_id > ?)
+                    ORDER BY user_id LIMIT ?
+                """, (job.id, BCAST_PENDING, last_uid, last_uid, _BCAST_PAGE))
+                if not rows:
+                    break
+                for (uid,) in rows:
+                    await queue.put(int(uid))
+                last_uid = rows[-1][0]
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            ticker.cancel()
+            for w in workers:
+                w.cancel()
+        status = "cancelled" if job.cancelled else "done"
+        await DB.write(_broadcast_finish_tx, job.id, status)
+        await self._update_progress(bot, job, status)
+
+BROADCASTS = BroadcastEngine()
+
+# ======================== ИСТЕЧЕНИЕ ПОДПИСОК =========================
+# Куча событий (время, вид, user_id, active_until): «expire» — сбросить кэши ровно в момент
+# окончания, «remind» — напомнить о продлении за EXPIRY_REMIND_DAYS дней.
+# В памяти держим только ближайшее окно: при старте и раз в horizon/2 подгружаем права,
+# кончающиеся в пределах окна (+ срок напоминания), диапазоном по индексу entitlements(active_until).
+# Выдачи в этом процессе добавляются сразу; выдачи в других процессах окно подхватит заранее —
+# самый короткий план длиннее окна. Устаревшие события (продлили, перенесли) проверяются при срабатывании.
+# Работает в одном процессе: в обычном режиме — в основном, в режиме воркеров — в воркере 0.
+
+EXPIRY_REMIND_DAYS = getattr(config, "EXPIRY_REMIND_DAYS", 3)
+EXPIRY_HORIZON_SEC = getattr(config, "EXPIRY_HORIZON_SEC", 6 * 3600)
+EXPIRY_REMIND_BATCH = getattr(config, "EXPIRY_REMIND_BATCH", 30)
+EXPIRY_REMIND_PAUSE_SEC = getattr(config, "EXPIRY_REMIND_PAUSE_SEC", 1.0)
+
+_EV_EXPIRE, _EV_REMIND = 0, 1
+
+def _reminders_due_read(conn, due: list[tuple[int, int]]):
+    # (user_id, active_until) из пачки, о которых ещё не напоминали (заблокировавших бота пропускаем);
+    # право, продлённое после постановки события, сюда не попадает — о нём напомнит событие нового срока
+    marks = ",".join("(?,?)" for _ in due)
+    return conn.execute(f"""
+        SELECT e.user_id, e.plan, e.active_until FROM entitlements e
+        JOIN users u ON u.user_id = e.user_id
+        WHERE (e.user_id, e.active_until) IN (VALUES {marks}) AND u.blocked_at IS NULL
+          AND e.active_until > ? AND (e.reminded IS NULL OR e.reminded != e.active_until)
+    """, (*(v for pair in due for v in pair), now_ts())).fetchall()
+
+def _reminders_sent_tx(conn, sent: list[tuple[int, int]], blocked: list[int]):
+    conn.executemany("UPDATE entitlements SET reminded=? WHERE user_id=? AND active_until=?",
+                     [(until, uid, until) for uid, until in sent])
+    conn.executemany("UPDATE users SET blocked_at=? WHERE user_id=?", [(now_ts(), uid) for uid in blocked])
+
+class ExpiryScheduler:
+    def __init__(self, *, remind_days: float = EXPIRY_REMIND_DAYS, horizon: float = EXPIRY_HORIZON_SEC,
+                 batch: int = EXPIRY_REMIND_BATCH, pause: float = EXPIRY_REMIND_PAUSE_SEC):
+        self.remind_sec = max(0.0, float(remind_days)) * 86400
+        self.horizon = max(60.0, float(horizon))
+        self.batch = max(1, int(batch))
+        self.pause = pause
+        self.expired = 0
+        self.reminded = 0
+        self._heap: list[tuple[int, int, int, int]] = []
+        self._queued: set[tuple[int, int, int, int]] = set()
+        self._window_end = 0       # события с временем до этой границы уже загружены
+        self._reminders: asyncio.Queue = asyncio.Queue()
+        self._wake = asyncio.Event()
+        self._tasks: list[asyncio.Task] = []
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def _push(self, when: int, kind: int, user_id: int, active_until: int):
+        ev = (when, kind, user_id, active_until)
+        if ev in self._queued:
+            return
+        self._queued.add(ev)
+        heapq.heappush(self._heap, ev)
+        if self._heap[0] is ev:
+            self._wake.set()
+
+    def track(self, user_id: int, active_until: int | None, reminded: int | None = None):
+        # новое право; «навсегда» и всё, что за окном, подхватит следующая загрузка
+        if active_until is None or not self._tasks:
+            return
+        now = now_ts()
+        if active_until <= now:
+            return
+        if active_until <= self._window_end:
+            self._push(active_until, _EV_EXPIRE, user_id, active_until)
+        if self.remind_sec and reminded != active_until:
+            remind_at = max(now, int(active_until - self.remind_sec))
+            if remind_at <= self._window_end:
+                self._push(remind_at, _EV_REMIND, user_id, active_until)
+
+    async def _load_window(self):
+        now = now_ts()
+        end = now + int(self.horizon)
+        self._window_end = end
+        rows = await DB.fetchall("""
+            SELECT user_id, active_until, reminded FROM entitlements
+            WHERE active_until > ? AND active_until <= ?
+        """, (now, end + int(self.remind_sec)))
+        for user_id, active_until, reminded in rows:
+            self.track(user_id, active_until, reminded)
+
+    def _fire_due(self):
+        now = now_ts()
+        while self._heap and self._heap[0][0] <= now:
+            ev = heapq.heappop(self._heap)
+            self._queued.discard(ev)
+            _when, kind, user_id, until = ev
+            if kind == _EV_EXPIRE:
+                # даже если право уже продлили, сброс кэша безвреден
+                invalidate_subscription(user_id)
+                self.expired += 1
+            else:
+                self._reminders.put_nowait((user_id, until))
+
+    async def _timer_loop(self):
+        loop = asyncio.get_running_loop()
+        next_load = 0.0
+        while True:
+            if loop.time() >= next_load:
+                try:
+                    await self._load_window()
+                except Exception:
+                    logging.exception("expiry: window load failed")
+                next_load = loop.time() + self.horizon / 2
+            self._fire_due()
+            delay = next_load - loop.time()
+            if self._heap:
+                delay = min(delay, self._heap[0][0] - now_ts())
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), max(0.05, delay))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _send_reminder(self, bot: Bot, user_id: int, plan: str, active_until: int) -> str:
+        until = datetime.fromtimestamp(active_until, timezone.utc).strftime("%d.%m.%Y %H:%M UTC")
+        try:
+            with outbound_priority(PRIORITY_BULK):
+                await bot.send_message(
+                    user_id,
+                    f"⏳ Подписка «{plan_human(plan)}» закончится {until}.\nПродлить можно здесь:",
+                    reply_markup=kb_plans_inline(),
+                )
+            return "sent"
+        except TelegramForbiddenError:
+            return "blocked"
+        except Exception as e:
+            logging.warning("expiry: reminder to %s failed: %r", user_id, e)
+            return "failed"
+
+    async def _remind_loop(self, bot: Bot):
+        # пачками: сколько накопилось (до batch), проверка по базе одним запросом,
+        # отправка через общий планировщик исходящих и пауза между пачками
+        while True:
+            due = {await self._reminders.get()}
+            while len(due) < self.batch and not self._reminders.empty():
+                due.add(self._reminders.get_nowait())
+            try:
+                rows = await DB.read(_reminders_due_read, list(due))
+                results = await asyncio.gather(*(self._send_reminder(bot, *row) for row in rows))
+                sent = [(row[0], row[2]) for row, res in zip(rows, results) if res != "failed"]
+                blocked = [row[0] for row, res in zip(rows, results) if res == "blocked"]
+                if sent:
+                    await DB.write(_reminders_sent_tx, sent, blocked)
+                self.reminded += len(sent) - len(blocked)
+            except Exception:
+                logging.exception("expiry: reminder batch failed")
+            await asyncio.sleep(self.pause)
+
+    def start(self, bot: Bot):
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._timer_loop())]
+        if self.remind_sec:
+            self._tasks.append(asyncio.create_task(self._remind_loop(bot)))
+
+    async def stop(self):
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+EXPIRY = ExpiryScheduler()
+
 # ======================== АДМИН-ПАНЕЛЬ =========================
 
 @router.message((F.chat.type == ChatType.PRIVATE) & (F.text.lower() == "админ панель"))
@@ -881,7 +1966,7 @@ async def admin_panel(m: Message, state: FSMContext):
     if not is_admin(m.from_user.id, m.from_user.username):
         return
     await state.clear()
-    await m.answer("Админ панель:", reply_markup=kb_private(m.from_user.id, m.from_user.username))
+    await m.answer("Админ панель:", reply_markup=await kb_private(m.from_user.id, m.from_user.username))
     await m.answer("Выбери действие:", reply_markup=kb_admin())
 
 def _parse_chat_ref(text: str) -> tuple[int | None, str | None]:
@@ -896,6 +1981,55 @@ def _parse_chat_ref(text: str) -> tuple[int | None, str | None]:
     except Exception:
         return None, None
 
+# --- статистика ---
+# Всё читается из свёрток (stats_*), одним заходом в поток-читатель:
+# время ответа не зависит от размера users/subscriptions.
+STATS_DAYS = 14
+
+def _stats_snapshot_read(conn, ts: int) -> dict:
+    today = ts // 86400
+    totals = {(m, k): v for m, k, v in conn.execute("SELECT metric, key, value FROM stats_totals")}
+    daily: dict[int, dict] = {}
+    for day, metric, key, value in conn.execute(
+        "SELECT day, metric, key, value FROM stats_daily WHERE day > ?", (today - STATS_DAYS,)
+    ):
+        d = daily.setdefault(day, {})
+        d[metric] = d.get(metric, 0) + value
+    active = dict(conn.execute("""
+        SELECT plan, SUM(n) FROM stats_active WHERE until_day = -1 OR until_day > ? GROUP BY plan
+    """, (today,)).fetchall())
+    # права, истекающие сегодня, досчитываем точно — это узкий диапазон индекса по active_until
+    for plan, n in conn.execute("""
+        SELECT plan, COUNT(*) FROM entitlements WHERE active_until > ? AND active_until < ? GROUP BY plan
+    """, (ts, (today + 1) * 86400)):
+        active[plan] = active.get(plan, 0) + n
+    return {"today": today, "totals": totals, "daily": daily, "active": active}
+
+async def stats_dashboard() -> str:
+    snap = await DB.read(_stats_snapshot_read, now_ts())
+    today, totals, daily, active = snap["today"], snap["totals"], snap["daily"], snap["active"]
+    week_new = sum(daily.get(d, {}).get("users", 0) for d in range(today - 6, today + 1))
+    revenue = sum(totals.get(("revenue", p), 0) for p in PLANS)
+    lines = [
+        "📊 <b>Статистика</b>",
+        f"Пользователей: {totals.get(('users', ''), 0)} "
+        f"(+{daily.get(today, {}).get('users', 0)} сегодня, +{week_new} за 7 дней)",
+        f"Активных подписок: {sum(active.values())}",
+    ]
+    lines += [f"  • {plan_human(p)}: {active.get(p, 0)}" for p in PLANS]
+    lines.append(f"Выручка: {revenue} ⭐")
+    lines += [f"  • {plan_human(p)}: {totals.get(('revenue', p), 0)} ⭐" for p in PLANS]
+    lines.append(f"Покупки: себе {totals.get(('purchases', 'self'), 0)}, "
+                 f"в подарок {totals.get(('purchases', 'gift'), 0)}")
+    rows = [f"{'день':<6}{'новые':>7}{'выдачи':>8}{'покупки':>9}{'⭐':>8}"]
+    for day in range(today - STATS_DAYS + 1, today + 1):
+        d = daily.get(day, {})
+        label = datetime.fromtimestamp(day * 86400, timezone.utc).strftime("%d.%m")
+        rows.append(f"{label:<6}{d.get('users', 0):>7}{d.get('grants', 0):>8}"
+                    f"{d.get('purchases', 0):>9}{d.get('revenue', 0):>8}")
+    lines.append(f"\nПо дням (UTC), последние {STATS_DAYS}:\n<pre>" + "\n".join(rows) + "</pre>")
+    return "\n".join(lines)
+
 @router.callback_query(F.data.startswith("admin:"))
 async def admin_callbacks(cq: CallbackQuery, state: FSMContext):
     if not is_admin(cq.from_user.id, cq.from_user.username):
@@ -913,7 +2047,7 @@ async def admin_callbacks(cq: CallbackQuery, state: FSMContext):
         )
         await cq.answer()
     elif action == "listch":
-        rows = channels_all_admin()
+        rows = await channels_all_admin()
         if not rows:
             await cq.message.answer("Нет привязанных каналов.")
             await cq.answer()
@@ -940,15 +2074,13 @@ async def admin_callbacks(cq: CallbackQuery, state: FSMContext):
         await cq.message.answer("Текст рассылки? (HTML разрешён). Отправь сообщением.")
         await cq.answer()
     elif action == "stats":
-        cur = DB.execute("SELECT COUNT(*) FROM users")
-        users = cur.fetchone()[0]
-        cur = DB.execute("""
-            SELECT COUNT(DISTINCT user_id)
-            FROM subscriptions
-            WHERE expires_at IS NULL OR expires_at > ?
-        """, (now_ts(),))
-        active = cur.fetchone()[0]
-        await cq.message.answer(f"Пользователей: {users}\nАктивных подписок: {active}")
+        sc = SUB_CACHE.stats()
+        ob = OUTBOUND.stats()
+        await cq.message.answer(
+            f"{await stats_dashboard()}\n\n"
+            f"Кэш подписок: {sc['size']}/{sc['maxsize']}, попаданий {sc['hits']}, промахов {sc['misses']}\n"
+            f"Исходящие: придержано {ob['delayed']}, повторов после 429 {ob['retried']}, в очереди {ob['waiting']}"
+        )
         await cq.answer()
     elif action == "makebtn":
         await state.set_state(CreateBtn.text)
@@ -957,6 +2089,54 @@ async def admin_callbacks(cq: CallbackQuery, state: FSMContext):
             "Для отмены — /cancel"
         )
         await cq.answer()
+    elif action == "profile":
+        await cq.message.answer(
+            "🩺 Профилирование этого процесса. Сэмплинг почти не нагружает бота, "
+            "cProfile точнее, но замедляет обработку на время замера.",
+            reply_markup=_KB_PROFILE,
+        )
+        await cq.answer()
+    elif action.startswith("prof:"):
+        await start_profiling(cq, action)
+
+# --- профилирование по запросу ---
+# Одна сессия на процесс; отчёт приходит админу документом. В режиме воркеров
+# профилируется воркер, который обработал нажатие (воркер чата админа).
+
+PROFILE_SESSION: ProfileSession | None = None
+
+async def start_profiling(cq: CallbackQuery, action: str):
+    global PROFILE_SESSION
+    try:
+        _prof, mode, unit, n = action.split(":")
+        n = max(1, int(n))
+        session = ProfileSession(mode, seconds=n if unit == "sec" else None, updates=n if unit == "upd" else None)
+    except ValueError:
+        await cq.answer("Неизвестный режим", show_alert=True)
+        return
+    if PROFILE_SESSION is not None:
+        await cq.answer("Профилирование уже идёт", show_alert=True)
+        return
+    PROFILE_SESSION = session
+    await cq.answer("Запущено")
+    what = f"{n} с" if unit == "sec" else f"{n} апдейтов (не дольше {int(session.seconds)} с)"
+    await cq.message.answer(f"🩺 {mode}: собираю профиль, {what}…")
+    asyncio.create_task(_profile_and_report(cq.bot, cq.message.chat.id, session))
+
+async def _profile_and_report(bot: Bot, chat_id: int, session: ProfileSession):
+    global PROFILE_SESSION
+    try:
+        report = await session.run(router)
+    finally:
+        PROFILE_SESSION = None
+    name = f"profile-{session.mode}-{datetime.now(timezone.utc):%Y%m%d-%H%M%S}.txt"
+    try:
+        await bot.send_document(
+            chat_id, BufferedInputFile(report.encode("utf-8"), filename=name),
+            caption=f"🩺 Готово: {session.handled} апдейтов",
+        )
+    except Exception:
+        logging.exception("profile report was not delivered")
 
 @router.message(AdminUnbind.wait, (F.chat.type == ChatType.PRIVATE))
 async def admin_unbind_receive(m: Message, state: FSMContext):
@@ -966,7 +2146,7 @@ async def admin_unbind_receive(m: Message, state: FSMContext):
     target_chat_id = None
     if uname:
         try:
-            chat = await m.bot.get_chat("@"+uname)
+            chat = await cached_get_chat(m.bot, "@"+uname)
             target_chat_id = chat.id
         except Exception:
             await m.answer("Не нашёл канал по @username.")
@@ -981,7 +2161,7 @@ async def admin_unbind_receive(m: Message, state: FSMContext):
         await m.bot.leave_chat(target_chat_id)
     except Exception:
         pass
-    channel_remove(target_chat_id)
+    await channel_remove(target_chat_id)
     await state.clear()
     await m.answer(f"Канал <code>{target_chat_id}</code> отвязан.")
 
@@ -990,17 +2170,21 @@ async def admin_broadcast_send(m: Message, state: FSMContext):
     if not is_admin(m.from_user.id, m.from_user.username):
         return
     text = m.html_text or (m.text or "")
-    cur = DB.execute("SELECT user_id FROM users")
-    ids = [int(r[0]) for r in cur.fetchall()]
-    ok, fail = 0, 0
-    for uid in ids:
-        try:
-            await m.bot.send_message(uid, text)
-            ok += 1
-        except Exception:
-            fail += 1
     await state.clear()
-    await m.answer(f"Рассылка завершена. Успехов: {ok}, ошибок: {fail}.")
+    job = await BROADCASTS.create(m.bot, text, m.chat.id)
+    if not job.progress_msg_id:
+        await m.answer(f"Рассылка #{job.id} запущена.")
+
+@router.callback_query(F.data.startswith("bcast:cancel:"))
+async def broadcast_cancel_cb(cq: CallbackQuery):
+    if not is_admin(cq.from_user.id, cq.from_user.username):
+        await cq.answer("Только для админа", show_alert=True)
+        return
+    job_id = int(cq.data.rsplit(":", 1)[1])
+    if BROADCASTS.cancel(job_id):
+        await cq.answer("Останавливаю рассылку…")
+    else:
+        await cq.answer("Рассылка уже завершена.", show_alert=True)
 
 @router.message(AdminGrant.user, (F.chat.type == ChatType.PRIVATE))
 async def admin_grant_user(m: Message, state: FSMContext):
@@ -1010,15 +2194,11 @@ async def admin_grant_user(m: Message, state: FSMContext):
     target_id = None
     if m.reply_to_message and m.reply_to_message.from_user:
         target_id = m.reply_to_message.from_user.id
-        ensure_user(target_id, m.reply_to_message.from_user.username)
+        await ensure_user(target_id, m.reply_to_message.from_user.username)
     else:
         t = (m.text or "").strip()
         if t.startswith("@"):
-            uname = t[1:]
-            cur = DB.execute("SELECT user_id FROM users WHERE lower(username)=lower(?)", (uname.lower(),))
-            row = cur.fetchone()
-            if row:
-                target_id = int(row[0])
+            target_id = await find_user_by_username(t)
         elif t.isdigit():
             target_id = int(t)
 
@@ -1040,7 +2220,7 @@ async def admin_grant_plan(m: Message, state: FSMContext):
         return
     data = await state.get_data()
     target_id = int(data["target_id"])
-    grant_subscription(target_id, plan, gifted_by=m.from_user.id)
+    await grant_subscription(target_id, plan, gifted_by=m.from_user.id)
     await state.clear()
     await m.answer(f"Выдал подписку {plan_human(plan)} пользователю <code>{target_id}</code> ✅")
     try:
@@ -1052,7 +2232,7 @@ async def admin_grant_plan(m: Message, state: FSMContext):
 
 @router.business_message(F.text | F.caption)
 async def business_handler(m: Message):
-    if not (m.from_user and has_active_subscription(m.from_user.id)):
+    if not (m.from_user and await has_active_subscription(m.from_user.id)):
         try:
             await m.bot.send_message(
                 m.from_user.id,
@@ -1062,13 +2242,7 @@ async def business_handler(m: Message):
             pass
         return
 
-    triggers = ["/button"]
-    if BOT_UN:
-        triggers.append(f"@{BOT_UN}")
-    text = m.text or m.caption or ""
-    if not any(t.lower() in text.lower() for t in triggers):
-        return
-    clean_text, buttons = parse_buttons_and_clean(text, triggers)
+    clean_text, buttons = BUTTON_MATCHER.parse(m.text or m.caption or "")
     if not buttons:
         return
     await edit_or_send_with_media(m, clean_text, buttons)
@@ -1078,21 +2252,32 @@ async def channel_handler(m: Message):
     if not is_channel_allowed(m.chat.id):
         return
 
-    triggers = ["/button"]
-    if BOT_UN:
-        triggers.append(f"@{BOT_UN}")
-    text = m.text or m.caption or ""
-    if not any(t.lower() in text.lower() for t in triggers):
-        return
-    clean_text, buttons = parse_buttons_and_clean(text, triggers)
+    clean_text, buttons = BUTTON_MATCHER.parse(m.text or m.caption or "")
     if not buttons:
         return
     await edit_or_send_with_media(m, clean_text, buttons)
 
 # ======================== АВТО-ОБНОВЛЕНИЕ ИЗ GIT =========================
 
-def _git(cmd: list[str]) -> str:
-    out = subprocess.check_output(cmd, cwd=os.getcwd())
+# git запускается асинхронно и с таймаутом: медленный fetch не должен стопорить обработку апдейтов.
+# Найдено обновление — просим main() о плавной остановке (см. ПЛАВНАЯ ОСТАНОВКА), systemd перезапустит.
+
+GIT_TIMEOUT_SEC = getattr(config, "GIT_TIMEOUT_SEC", 60)
+
+async def _git(*args: str, timeout: float = GIT_TIMEOUT_SEC) -> str:
+    proc = await asyncio.create_subprocess_exec(
+        "git", *args, cwd=os.getcwd(),
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        env={**os.environ, "GIT_TERMINAL_PROMPT": "0"},  # не ждать ввода пароля
+    )
+    try:
+        out, err = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        raise RuntimeError(f"git {args[0]}: timeout {timeout}s")
+    if proc.returncode != 0:
+        raise RuntimeError(f"git {args[0]}: {err.decode('utf-8', 'ignore').strip()}")
     return out.decode("utf-8", "ignore").strip()
 
 def _has_git_repo() -> bool:
@@ -1107,26 +2292,418 @@ async def git_autoupdate_loop():
     while True:
         try:
             if _has_git_repo():
-                _git(["git", "fetch", remote, branch])
-                local = _git(["git", "rev-parse", "HEAD"])
-                remote_head = _git(["git", "rev-parse", f"{remote}/{branch}"])
+                await _git("fetch", remote, branch)
+                local = await _git("rev-parse", "HEAD")
+                remote_head = await _git("rev-parse", f"{remote}/{branch}")
                 if local != remote_head:
-                    _git(["git", "pull", "--ff-only", remote, branch])
-                    os._exit(0)  # systemd перезапустит
-        except Exception:
-            pass
+                    await _git("pull", "--ff-only", remote, branch)
+                    logging.info("auto-update: %s -> %s, restarting", local[:8], remote_head[:8])
+                    request_stop(restart=True)
+                    return
+        except Exception as e:
+            logging.warning("auto-update failed: %s", e)
         await asyncio.sleep(max(1, int(interval)) * 60)
 
+# ======================== ПЛАВНАЯ ОСТАНОВКА =========================
+# Перед выходом (рестарт после обновления, SIGTERM): перестаём принимать апдейты,
+# ждём уже начатые обработчики и запись в базу — не дольше DRAIN_TIMEOUT_SEC.
+
+DRAIN_TIMEOUT_SEC = getattr(config, "DRAIN_TIMEOUT_SEC", 30)
+STOP_EVENT = asyncio.Event()
+RESTART_REQUESTED = False
+
+def request_stop(restart: bool = False):
+    global RESTART_REQUESTED
+    RESTART_REQUESTED = RESTART_REQUESTED or restart
+    STOP_EVENT.set()
+
+class InFlightMiddleware(BaseMiddleware):
+    # считает апдейты, которые сейчас в обработке
+    def __init__(self):
+        self.active = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    async def __call__(self, handler, event: Update, data: dict):
+        self.active += 1
+        self._idle.clear()
+        try:
+            return await handler(event, data)
+        finally:
+            self.active -= 1
+            if not self.active:
+                self._idle.set()
+
+    async def wait_idle(self, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(self._idle.wait(), max(0.0, timeout))
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+INFLIGHT = InFlightMiddleware()
+
+async def drain(timeout: float = DRAIN_TIMEOUT_SEC) -> bool:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    # рассылки прерываем: задания остаются running и продолжатся после рестарта
+    await BROADCASTS.suspend()
+    await EXPIRY.stop()  # неотправленные напоминания уйдут после рестарта
+    await asyncio.sleep(0)  # дать стартовать задачам апдейтов, созданным последним getUpdates
+    idle = await INFLIGHT.wait_idle(deadline - loop.time())
+    if not idle:
+        logging.warning("drain: %d updates still in progress after %ss", INFLIGHT.active, timeout)
+    try:
+        await asyncio.wait_for(DB.flush(), max(1.0, deadline - loop.time()))
+    except asyncio.TimeoutError:
+        logging.warning("drain: DB writer did not flush in time (%d queued)", DB.queue_size())
+        return False
+    return idle
+
+# ======================== МЕТРИКИ =========================
+# METRICS_ENABLED = True: время хендлеров, запросов к SQLite и вызовов Bot API + глубины очередей,
+# в формате Prometheus на http://METRICS_HOST:METRICS_PORT/metrics (воркер i — на METRICS_PORT+1+i).
+# Выключено — хуки не подключаются вовсе.
+
+METRICS_ENABLED = getattr(config, "METRICS_ENABLED", False)
+_metrics_ready = False
+
+def setup_metrics():
+    global _metrics_ready
+    if not METRICS_ENABLED or _metrics_ready:
+        return
+    _metrics_ready = True
+    DB.observer = metrics.db_observer
+    metrics.instrument_router(router)
+    r = metrics.REGISTRY
+    r.gauge("bot_updates_in_flight", "updates being handled right now", lambda: INFLIGHT.active)
+    r.gauge("bot_db_write_queue", "operations waiting for the DB writer", DB.queue_size)
+    r.gauge("bot_db_batches_total", "committed writer batches", lambda: DB.batches, kind="counter")
+    r.gauge("bot_db_batched_ops_total", "writes committed in batches", lambda: DB.batched_ops, kind="counter")
+    r.gauge("bot_outbound_waiting", "Bot API requests waiting for the global bucket", OUTBOUND.gate.waiting)
+    r.gauge("bot_outbound_delayed_total", "Bot API requests held by rate limits", lambda: OUTBOUND.delayed, kind="counter")
+    r.gauge("bot_outbound_retried_total", "Bot API requests retried after 429", lambda: OUTBOUND.retried, kind="counter")
+    r.gauge("bot_cache_entries", "entries in process caches", lambda: {
+        "sub": len(SUB_CACHE), "chat": len(CHAT_CACHE), "fsm": len(FSM_STORAGE.hot),
+    }, labels=("cache",))
+    r.gauge("bot_cache_hits_total", "process cache hits", lambda: {
+        "sub": SUB_CACHE.hits, "chat": CHAT_CACHE.hits, "fsm": FSM_STORAGE.hot.hits,
+    }, labels=("cache",), kind="counter")
+    r.gauge("bot_cache_misses_total", "process cache misses", lambda: {
+        "sub": SUB_CACHE.misses, "chat": CHAT_CACHE.misses, "fsm": FSM_STORAGE.hot.misses,
+    }, labels=("cache",), kind="counter")
+    r.gauge("bot_expiry_scheduled", "expiry events queued in the scheduler", lambda: len(EXPIRY))
+    r.gauge("bot_broadcast_pending", "recipients left in running broadcasts", lambda: {
+        str(job_id): job.counts[BCAST_PENDING] for job_id, job in BROADCASTS.jobs.items()
+    }, labels=("job",))
+
+async def start_metrics_server(port_offset: int = 0) -> web.AppRunner | None:
+    port = getattr(config, "METRICS_PORT", 9108)
+    if not METRICS_ENABLED or not port:
+        return None
+    host = getattr(config, "METRICS_HOST", "127.0.0.1")
+    return await metrics.serve(host, int(port) + port_offset)
+
+# ======================== ЗАПИСЬ АПДЕЙТОВ =========================
+# RECORD_UPDATES_DIR — писать входящие апдейты в сжатый JSONL (recorder.py), чтобы потом
+# прогнать тот же трафик через replay.py. Пишет только front-процесс, до раздачи воркерам.
+
+def start_recorder(dp: Dispatcher) -> UpdateRecorder | None:
+    directory = getattr(config, "RECORD_UPDATES_DIR", "")
+    if not directory:
+        return None
+    recorder = UpdateRecorder(
+        directory,
+        bot_username=BOT_UN,
+        max_bytes=int(getattr(config, "RECORD_MAX_MB", 64)) << 20,
+        keep=getattr(config, "RECORD_KEEP_FILES", 20),
+    )
+    dp.update.outer_middleware(recorder)
+    return recorder
+
+# ======================== ВЕБХУК =========================
+# Альтернатива long polling: Telegram сам присылает апдейты на локальный aiohttp-сервер
+# (обычно за reverse proxy с TLS). Ответ 200 отдаётся сразу, обработка идёт в фоне.
+
+WEBHOOK_PATH = getattr(config, "WEBHOOK_PATH", "/tg/webhook")
+
+def webhook_secret() -> str:
+    # если секрет не задан — стабильно выводим его из токена (допустимы только [A-Za-z0-9_-])
+    secret = getattr(config, "WEBHOOK_SECRET", "") or ""
+    if secret:
+        return secret
+    return hashlib.sha256(f"webhook:{config.BOT_TOKEN}".encode()).hexdigest()[:48]
+
+def build_webhook_app(dp: Dispatcher, bot: Bot, *, path: str = WEBHOOK_PATH, secret: str | None = None) -> web.Application:
+    app = web.Application()
+    handler = SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=secret, handle_in_background=True)
+    # маршрут без register(): тот вешает на остановку приложения закрытие сессии бота, а сессия
+    # нужна обработчикам до конца drain — её закрывает main(), как и в режиме polling
+    app.router.add_route("POST", path, handler.handle)
+    setup_application(app, dp, bot=bot)
+    return app
+
+async def run_webhook(dp: Dispatcher, bot: Bot):
+    secret = webhook_secret()
+    app = build_webhook_app(dp, bot, path=WEBHOOK_PATH, secret=secret)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(
+        runner,
+        getattr(config, "WEBHOOK_HOST", "127.0.0.1"),
+        int(getattr(config, "WEBHOOK_PORT", 8080)),
+    )
+    await site.start()
+    try:
+        await bot.set_webhook(
+            url=config.WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=secret,
+            allowed_updates=dp.resolve_used_update_types(),
+            max_connections=int(getattr(config, "WEBHOOK_MAX_CONNECTIONS", 40)),
+            drop_pending_updates=True,
+        )
+        await STOP_EVENT.wait()  # работаем до плавной остановки
+    finally:
+        await runner.cleanup()  # сессию бота не трогает (см. build_webhook_app)
+
+# ======================== РЕЖИМ ВОРКЕРОВ =========================
+# WORKERS = N (N > 1): front-процесс только принимает апдейты (polling или вебхук)
+# и раздаёт их N процессам-воркерам по chat_id. Апдейты одного чата всегда попадают
+# в один воркер и обрабатываются там строго по очереди; разные чаты — параллельно
+# и на разных ядрах. Инвалидации кэшей воркеры шлют в общую шину, front раздаёт их остальным.
+
+WORKERS = int(getattr(config, "WORKERS", 0) or 0)
+_CHAT_KEYS = ("message", "edited_message", "channel_post", "edited_channel_post",
+              "business_message", "edited_business_message", "my_chat_member", "chat_member",
+              "chat_join_request", "message_reaction", "message_reaction_count", "chat_boost",
+              "removed_chat_boost")
+_USER_KEYS = ("pre_checkout_query", "shipping_query", "inline_query", "chosen_inline_result", "poll_answer")
+
+def update_chat_id(raw: dict) -> int:
+    for key in _CHAT_KEYS:
+        obj = raw.get(key)
+        if obj and obj.get("chat"):
+            return int(obj["chat"]["id"])
+    cq = raw.get("callback_query")
+    if cq:
+        msg = cq.get("message")
+        return int(msg["chat"]["id"] if msg else cq["from"]["id"])
+    for key in _USER_KEYS:
+        obj = raw.get(key)
+        if obj:
+            who = obj.get("from") or obj.get("user") or {}
+            return int(who.get("id", 0))
+    return int(raw.get("update_id", 0))
+
+def chat_partition(chat_id: int, workers: int) -> int:
+    return chat_id % workers
+
+def apply_invalidation(kind: str, key: int | str):
+    # пришло от другого процесса — применяем только локально, дальше не рассылаем
+    if kind == "sub":
+        _drop_subscription(key)
+    elif kind == "chan+":
+        ALLOWED_CHANNELS.add(key)
+    elif kind == "chan-":
+        ALLOWED_CHANNELS.discard(key)
+    elif kind == "chat":
+        _drop_chat(key)
+    elif kind == "uname":
+        _drop_username(key)
+
+class WorkerPool:
+    def __init__(self, count: int, bot_username: str):
+        self.ctx = multiprocessing.get_context("spawn")
+        self.count = count
+        self.bot_username = bot_username
+        self.bus = self.ctx.Queue()
+        self.inboxes = [self.ctx.Queue() for _ in range(count)]
+        self.procs: list = [None] * count
+        self._bus_thread = threading.Thread(target=self._bus_loop, name="worker-bus", daemon=True)
+        self._stopping = False
+
+    def _spawn(self, index: int):
+        proc = self.ctx.Process(
+            target=_worker_entry,
+            args=(index, self.count, self.inboxes[index], self.bus, self.bot_username),
+            name=f"bot-worker-{index}",
+            daemon=True,
+        )
+        proc.start()
+        self.procs[index] = proc
+
+    def start(self):
+        for i in range(self.count):
+            self._spawn(i)
+        self._bus_thread.start()
+
+    def forward(self, raw: dict):
+        self.inboxes[chat_partition(update_chat_id(raw), self.count)].put(("update", raw))
+
+    def _bus_loop(self):
+        while True:
+            msg = self.bus.get()
+            if msg is None:
+                return
+            kind, key, origin = msg
+            for i, inbox in enumerate(self.inboxes):
+                if i != origin:
+                    inbox.put(("inval", kind, key))
+
+    async def supervise(self, interval: float = 2.0):
+        # упавший воркер перезапускаем; его очередь сохраняется
+        while not self._stopping:
+            await asyncio.sleep(interval)
+            for i, proc in enumerate(self.procs):
+                if not self._stopping and proc is not None and not proc.is_alive():
+                    logging.warning("worker %d exited with %s, restarting", i, proc.exitcode)
+                    self._spawn(i)
+
+    def stop(self, timeout: float = 30.0):
+        self._stopping = True
+        for inbox in self.inboxes:
+            inbox.put(None)
+        deadline = time.monotonic() + timeout
+        for proc in self.procs:
+            if proc is not None:
+                proc.join(max(0.1, deadline - time.monotonic()))
+        self.bus.put(None)
+
+class ForwardToWorkersMiddleware(BaseMiddleware):
+    # outer-middleware front-процесса: апдейт не обрабатывается здесь, а уходит воркеру
+    def __init__(self, pool: WorkerPool):
+        self.pool = pool
+
+    async def __call__(self, handler, event: Update, data: dict):
+        self.pool.forward(event.model_dump(mode="json", exclude_none=True, by_alias=True))
+        return None
+
+def _worker_entry(index: int, count: int, inbox, bus, bot_username: str):
+    # systemctl stop / Ctrl+C шлют сигнал всей группе процессов — воркер его пропускает:
+    # front-процесс сначала перестаёт принимать апдейты, потом останавливает воркеров через
+    # очередь (None после всех уже переданных), и воркер доделывает их в drain
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_worker_main(index, count, inbox, bus, bot_username))
+
+async def _worker_main(index: int, count: int, inbox, bus, bot_username: str):
+    global _invalidation_publisher
+    loop = asyncio.get_running_loop()
+    _invalidation_publisher = lambda kind, key: bus.put((kind, key, index))
+
+    setup_metrics()
+    metrics_runner = await start_metrics_server(1 + index)
+    bot = make_bot()
+    await bot_me(bot)
+    set_bot_username(bot_username)
+    await load_channel_allowlist()
+    dp = build_dispatcher()
+    await BROADCASTS.resume_all(bot, owns=lambda chat_id: chat_partition(chat_id, count) == index)
+    if index == 0:
+        EXPIRY.start(bot)  # истечения и напоминания — в одном процессе
+
+    chat_locks: dict[int, asyncio.Lock] = {}
+    chat_pending: dict[int, int] = {}
+    tasks: set[asyncio.Task] = set()
+    stopped = asyncio.Event()
+
+    async def handle(raw: dict):
+        chat_id = update_chat_id(raw)
+        chat_pending[chat_id] = chat_pending.get(chat_id, 0) + 1
+        lock = chat_locks.setdefault(chat_id, asyncio.Lock())
+        try:
+            async with lock:  # asyncio.Lock честный — порядок апдейтов чата сохраняется
+                await dp.feed_raw_update(bot, raw)
+        except Exception:
+            logging.exception("worker %d: update %s failed", index, raw.get("update_id"))
+        finally:
+            chat_pending[chat_id] -= 1
+            if not chat_pending[chat_id]:
+                del chat_pending[chat_id]
+                chat_locks.pop(chat_id, None)
+
+    def on_item(item):
+        if item is None:
+            stopped.set()
+        elif item[0] == "update":
+            task = asyncio.create_task(handle(item[1]))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        elif item[0] == "inval":
+            apply_invalidation(item[1], item[2])
+
+    parent = multiprocessing.parent_process()
+
+    def reader():
+        while True:
+            try:
+                item = inbox.get(timeout=1.0)
+            except queue.Empty:
+                if parent is None or parent.is_alive():
+                    continue
+                item = None  # front-процесс погиб, не остановив нас, — доделываем своё и выходим
+            loop.call_soon_threadsafe(on_item, item)
+            if item is None:
+                return
+
+    threading.Thread(target=reader, name=f"worker-{index}-inbox", daemon=True).start()
+    try:
+        await stopped.wait()
+        if tasks:  # включая апдейты, ещё ждущие очереди своего чата
+            await asyncio.wait(tasks, timeout=DRAIN_TIMEOUT_SEC)
+        await drain(DRAIN_TIMEOUT_SEC)
+    finally:
+        await bot.session.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        DB.close()
+
 # ======================== ТОЧКА ВХОДА =========================
 
-async def main():
-    global BOT_UN
-    bot = Bot(token=config.BOT_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
-    me = await bot.get_me()
-    BOT_UN = (me.username or "").lower()
+def set_bot_username(username: str | None):
+    global BOT_UN, BUTTON_MATCHER
+    BOT_UN = (username or "").lower()
+    BUTTON_MATCHER = ButtonMatcher(bot_triggers())
+
+# все исходящие запросы процесса идут через один планировщик (outbound.py);
+# в режиме воркеров глобальный лимит бота делится между процессами
+OUTBOUND = OutboundScheduler(
+    rate=getattr(config, "OUTBOUND_RATE", 30) / max(1, WORKERS),
+    private_rate=getattr(config, "OUTBOUND_PRIVATE_RATE", 1),
+    private_burst=getattr(config, "OUTBOUND_PRIVATE_BURST", 3),
+    group_per_min=getattr(config, "OUTBOUND_GROUP_PER_MIN", 20),
+    max_retries=getattr(config, "OUTBOUND_MAX_RETRIES", 3),
+)
 
-    dp = Dispatcher()
+def make_bot() -> Bot:
+    # BOT_API_SERVER — свой Bot API сервер (локальный telegram-bot-api или фейковый для тестов)
+    session = None
+    api_server = getattr(config, "BOT_API_SERVER", "")
+    if api_server:
+        session = AiohttpSession(api=TelegramAPIServer.from_base(api_server))
+    bot = Bot(token=config.BOT_TOKEN, session=session, default=DefaultBotProperties(parse_mode="HTML"))
+    bot.session.middleware(OUTBOUND)
+    if METRICS_ENABLED:
+        # после планировщика: меряем сам запрос, без ожидания в очереди лимитов
+        bot.session.middleware(metrics.BotAPIMetricsMiddleware())
+    return bot
+
+def build_dispatcher() -> Dispatcher:
+    dp = Dispatcher(storage=FSM_STORAGE)
+    dp.update.outer_middleware(INFLIGHT)
     dp.include_router(router)
+    return dp
+
+async def main():
+    setup_metrics()
+    metrics_runner = await start_metrics_server()
+    bot = make_bot()
+    me = await bot_me(bot)
+    set_bot_username(me.username)
+    await load_channel_allowlist()
+
+    dp = build_dispatcher()
+    recorder = start_recorder(dp)
 
     await bot.set_my_commands([
         BotCommand(command="start", description="Запуск"),
@@ -1140,9 +2717,63 @@ async def main():
 
     # авто-обновление из git
     asyncio.create_task(git_autoupdate_loop())
+    # брошенные мастера (FSM) чистим из базы раз в час
+    asyncio.create_task(FSM_STORAGE.purge_loop())
+    pool = None
+    if WORKERS > 1:
+        pool = WorkerPool(WORKERS, BOT_UN)
+        pool.start()
+        dp.update.outer_middleware(ForwardToWorkersMiddleware(pool))
+        asyncio.create_task(pool.supervise())
+    else:
+        # недоделанные рассылки (процесс мог перезапуститься посреди);
+        # в режиме воркеров их подхватывают сами воркеры
+        await BROADCASTS.resume_all(bot)
+        EXPIRY.start(bot)
 
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, request_stop)  # в режиме polling aiogram ставит свои
+        except NotImplementedError:
+            pass
+
+    webhook = getattr(config, "WEBHOOK_ENABLED", False)
+    if webhook:
+        intake = asyncio.create_task(run_webhook(dp, bot))
+    else:
+        await bot.delete_webhook(drop_pending_updates=True)
+        # сессию закрываем сами — после того как отработают начатые обработчики
+        intake = asyncio.create_task(dp.start_polling(
+            bot, allowed_updates=dp.resolve_used_update_types(), close_bot_session=False
+        ))
+    stop = asyncio.create_task(STOP_EVENT.wait())
+    try:
+        await asyncio.wait({intake, stop}, return_when=asyncio.FIRST_COMPLETED)
+        # 1) перестаём принимать апдейты
+        if not intake.done():
+            if webhook:
+                STOP_EVENT.set()
+            else:
+                try:
+                    await dp.stop_polling()
+                except RuntimeError:
+                    intake.cancel()
+        await asyncio.gather(intake, return_exceptions=True)
+        # 2) доделываем начатое
+        await drain(DRAIN_TIMEOUT_SEC)
+    finally:
+        stop.cancel()
+        if pool is not None:
+            pool.stop(DRAIN_TIMEOUT_SEC)
+        await bot.session.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        if recorder is not None:
+            recorder.close()
+        DB.close()
+    if RESTART_REQUESTED:
+        os._exit(0)  # systemd перезапустит уже с новым кодом
 
 if __name__ == "__main__":
     asyncio.run(main())
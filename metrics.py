@@ -0,0 +1,220 @@
+# metrics.py — метрики процесса в формате Prometheus (без внешних зависимостей)
+#
+#   REGISTRY.render()  -> текст для /metrics
+#   serve(host, port)  -> локальный aiohttp-сервер с /metrics
+#
+# Что собирается (подключается в main.py, только если METRICS_ENABLED):
+#   bot_handler_seconds{handler}           — время хендлеров aiogram, ошибки — bot_handler_errors_total
+#   bot_db_seconds{kind,op}                — чтения/записи через DBGateway и коммиты пачек
+#   bot_api_seconds{method}                — вызовы Bot API, ошибки — bot_api_errors_total{method,error}
+#   плюс «снимки» очередей (gauge с функцией-источником).
+import threading
+import time
+from functools import lru_cache
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _fmt_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(v: str) -> str:
+    return v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _num(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class Counter:
+    def __init__(self, name: str, help_: str, labels: tuple = ()):
+        self.name, self.help, self.labels = name, help_, labels
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, value: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + value
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for lv, v in items:
+            out.append(f"{self.name}{_fmt_labels(self.labels, lv)} {_num(v)}")
+        return out
+
+
+class Histogram:
+    def __init__(self, name: str, help_: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name, self.help, self.labels = name, help_, labels
+        self.buckets = tuple(sorted(buckets))
+        self._series: dict[tuple, list] = {}   # labels -> [counts по бакетам..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float, *label_values):
+        with self._lock:
+            s = self._series.get(label_values)
+            if s is None:
+                s = self._series[label_values] = [0] * len(self.buckets) + [0.0, 0]
+            for i, b in enumerate(self.buckets):
+                if seconds <= b:
+                    s[i] += 1
+                    break
+            s[-2] += seconds
+            s[-1] += 1
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._series.items())
+        n = len(self.buckets)
+        for lv, s in items:
+            acc = 0
+            for b, c in zip(self.buckets, s[:n]):
+                acc += c
+                le = _fmt_labels(self.labels, lv, 'le="%s"' % _num(b))
+                out.append(f"{self.name}_bucket{le} {acc}")
+            le = _fmt_labels(self.labels, lv, 'le="+Inf"')
+            out.append(f"{self.name}_bucket{le} {s[-1]}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labels, lv)} {_num(s[-2])}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labels, lv)} {s[-1]}")
+        return out
+
+
+class Gauge:
+    # значение берётся в момент отдачи: fn() -> число или {label_values: число}
+    def __init__(self, name: str, help_: str, fn, labels: tuple = (), kind: str = "gauge"):
+        self.name, self.help, self.fn, self.labels, self.kind = name, help_, fn, labels, kind
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            value = self.fn()
+        except Exception:
+            return out
+        if isinstance(value, dict):
+            for lv, v in sorted(value.items()):
+                lv = lv if isinstance(lv, tuple) else (lv,)
+                out.append(f"{self.name}{_fmt_labels(self.labels, lv)} {_num(v)}")
+        else:
+            out.append(f"{self.name} {_num(value)}")
+        return out
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, object] = {}
+
+    def add(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help_: str, labels: tuple = ()) -> Counter:
+        return self._metrics.get(name) or self.add(Counter(name, help_, labels))
+
+    def histogram(self, name: str, help_: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._metrics.get(name) or self.add(Histogram(name, help_, labels, buckets))
+
+    def gauge(self, name: str, help_: str, fn, labels: tuple = (), kind: str = "gauge") -> Gauge:
+        return self.add(Gauge(name, help_, fn, labels, kind))
+
+    def render(self) -> str:
+        lines = []
+        for m in self._metrics.values():
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HANDLER_SECONDS = REGISTRY.histogram("bot_handler_seconds", "aiogram handler latency", ("handler",))
+HANDLER_ERRORS = REGISTRY.counter("bot_handler_errors_total", "exceptions raised by handlers", ("handler", "error"))
+DB_SECONDS = REGISTRY.histogram("bot_db_seconds", "SQLite operation time in gateway threads", ("kind", "op"))
+DB_ERRORS = REGISTRY.counter("bot_db_errors_total", "failed SQLite operations", ("kind", "op"))
+API_SECONDS = REGISTRY.histogram("bot_api_seconds", "Bot API request latency", ("method",))
+API_ERRORS = REGISTRY.counter("bot_api_errors_total", "failed Bot API requests", ("method", "error"))
+
+# ---------- хуки ----------
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    # inner-middleware: в data уже есть выбранный хендлер
+    async def __call__(self, handler, event, data: dict):
+        h = data.get("handler")
+        name = getattr(getattr(h, "callback", None), "__name__", "unknown")
+        t0 = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            HANDLER_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - t0, name)
+
+
+def instrument_router(router, middleware: HandlerMetricsMiddleware | None = None):
+    mw = middleware or HandlerMetricsMiddleware()
+    for observer in router.observers.values():
+        observer.middleware(mw)
+    return mw
+
+
+class BotAPIMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        t0 = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            API_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            API_SECONDS.observe(time.perf_counter() - t0, name)
+
+
+@lru_cache(maxsize=1024)
+def op_label(name: str) -> str:
+    # для сырого SQL — сжатая первая часть запроса, иначе имя функции
+    return " ".join(name.split())[:80]
+
+
+def db_observer(kind: str, name: str, seconds: float, ok: bool):
+    # DBGateway.observer; вызывается из потоков шлюза
+    op = op_label(name)
+    DB_SECONDS.observe(seconds, kind, op)
+    if not ok:
+        DB_ERRORS.inc(kind, op)
+
+# ---------- HTTP ----------
+
+
+# текстовый формат экспозиции Prometheus; content_type= в aiohttp не принимает параметр version
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def app(registry: Registry = REGISTRY) -> web.Application:
+    async def handle(_request: web.Request) -> web.Response:
+        return web.Response(body=registry.render().encode(),
+                            headers={"Content-Type": CONTENT_TYPE, "X-Content-Type-Options": "nosniff"})
+
+    a = web.Application()
+    a.router.add_get("/metrics", handle)
+    return a
+
+
+async def serve(host: str = "127.0.0.1", port: int = 9108, registry: Registry = REGISTRY) -> web.AppRunner:
+    runner = web.AppRunner(app(registry))
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,174 @@
+# outbound.py — планировщик исходящих запросов к Bot API
+#
+# Request-middleware сессии aiogram: все вызовы бота (ответы хендлеров, платежи,
+# подарки, рассылка) проходят через общий бюджет бота и бюджет конкретного чата.
+#   - глобальный token bucket (~30 сообщений/сек на бота) с классами приоритета:
+#     пока ждут платёжные ответы, обычные и массовые отправки стоят в очереди;
+#   - bucket на чат: личка ~1 сообщение/сек (с небольшим запасом), группы и каналы ~20/мин —
+#     только для новых сообщений (Send*/Copy*/Forward*); правки (Edit*: меню, прогресс рассылки,
+#     кнопки в постах канала) идут лишь через глобальный бюджет, иначе навигация по меню
+#     в канале ждала бы минутами; 429 на правку тормозит этот чат как обычно;
+#   - 429 RetryAfter не уходит в хендлер: запрос ставится на паузу и повторяется
+#     с прежним местом в очереди своего класса.
+import asyncio
+import contextlib
+import contextvars
+import heapq
+import itertools
+import time
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import AnswerPreCheckoutQuery, SendInvoice
+
+from caches import ExpiringLRU
+from ratelimit import TokenBucket
+
+PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_BULK = 0, 1, 2
+PRIORITY_NAMES = {PRIORITY_HIGH: "high", PRIORITY_NORMAL: "normal", PRIORITY_BULK: "bulk"}
+
+_priority: contextvars.ContextVar[int | None] = contextvars.ContextVar("outbound_priority", default=None)
+
+# методы, которые создают/меняют сообщения — на них действуют флуд-лимиты Telegram
+_LIMITED_PREFIXES = ("Send", "Copy", "Forward", "Edit")
+# из них новые сообщения — только на них действует лимит чата
+_NEW_MESSAGE_PREFIXES = ("Send", "Copy", "Forward")
+# платёжные методы идут вне очереди, если класс не задан явно
+_HIGH_METHODS = (SendInvoice, AnswerPreCheckoutQuery)
+
+
+@contextlib.contextmanager
+def priority(level: int):
+    # with outbound.priority(PRIORITY_BULK): await bot.send_message(...)
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class PriorityGate:
+    # Обёртка над TokenBucket: свободный токен получает ожидающий с наименьшим
+    # (priority, seq). seq сохраняется при повторе после 429 — запрос не уходит в хвост.
+
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        self._heap: list = []
+        self._seq = itertools.count()
+        self._task: asyncio.Task | None = None
+
+    def next_seq(self) -> int:
+        return next(self._seq)
+
+    def waiting(self) -> int:
+        return len(self._heap)
+
+    async def acquire(self, level: int, seq: int):
+        if not self._heap and self.bucket.try_acquire() <= 0:
+            return
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (level, seq, fut))
+        if self._task is None:
+            self._task = asyncio.create_task(self._dispatch())
+        await fut
+
+    async def _dispatch(self):
+        try:
+            while self._heap:
+                fut = self._heap[0][2]
+                if fut.done():  # ожидающий отменён
+                    heapq.heappop(self._heap)
+                    continue
+                wait = self.bucket.try_acquire()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    continue
+                heapq.heappop(self._heap)
+                fut.set_result(None)
+        finally:
+            self._task = None
+
+
+class OutboundScheduler(BaseRequestMiddleware):
+    def __init__(self, *, rate: float = 30, private_rate: float = 1, private_burst: int = 3,
+                 group_per_min: float = 20, max_retries: int = 3, max_retry_after: float = 60,
+                 chats: int = 10000, idle_ttl: float = 600):
+        self.gate = PriorityGate(TokenBucket(rate, burst=max(1, int(rate))))
+        self.private_rate = private_rate
+        self.private_burst = private_burst
+        self.group_rate = group_per_min / 60
+        self.max_retries = max(0, int(max_retries))
+        self.max_retry_after = max_retry_after
+        self.idle_ttl = idle_ttl
+        self.chats = ExpiringLRU(chats, clock=time.monotonic)
+        self.sent = {level: 0 for level in PRIORITY_NAMES}
+        self.delayed = 0
+        self.retried = 0
+
+    @staticmethod
+    def classify(method) -> int:
+        level = _priority.get()
+        if level is not None:
+            return level
+        return PRIORITY_HIGH if isinstance(method, _HIGH_METHODS) else PRIORITY_NORMAL
+
+    @staticmethod
+    def is_limited(method) -> bool:
+        return type(method).__name__.startswith(_LIMITED_PREFIXES) or isinstance(method, _HIGH_METHODS)
+
+    @staticmethod
+    def is_new_message(method) -> bool:
+        return type(method).__name__.startswith(_NEW_MESSAGE_PREFIXES)
+
+    def chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            private = isinstance(chat_id, int) and chat_id > 0
+            if private:
+                bucket = TokenBucket(self.private_rate, burst=self.private_burst)
+            else:
+                bucket = TokenBucket(self.group_rate, burst=1)
+        self.chats.set_ttl(chat_id, bucket, self.idle_ttl)
+        return bucket
+
+    async def __call__(self, make_request, bot, method):
+        if not self.is_limited(method):
+            return await make_request(bot, method)
+
+        level = self.classify(method)
+        chat_id = getattr(method, "chat_id", None)
+        per_chat = chat_id is not None and self.is_new_message(method)
+        seq = self.gate.next_seq()
+        attempt = 0
+        while True:
+            t0 = time.monotonic()
+            if per_chat:
+                await self.chat_bucket(chat_id).acquire()
+            await self.gate.acquire(level, seq)
+            if time.monotonic() - t0 > 0.001:
+                self.delayed += 1
+            try:
+                response = await make_request(bot, method)
+                self.sent[level] += 1
+                return response
+            except TelegramRetryAfter as e:
+                attempt += 1
+                if attempt > self.max_retries or e.retry_after > self.max_retry_after:
+                    raise
+                self.retried += 1
+                # 429 по конкретному чату тормозит только этот чат, без чата — весь бот
+                if chat_id is not None:
+                    self.chat_bucket(chat_id).pause(e.retry_after)
+                    if not per_chat:
+                        await asyncio.sleep(e.retry_after)  # правка через bucket чата не ходит — ждём сами
+                else:
+                    self.gate.bucket.pause(e.retry_after)
+
+    def stats(self) -> dict:
+        return {
+            "sent": {PRIORITY_NAMES[k]: v for k, v in self.sent.items()},
+            "delayed": self.delayed,
+            "retried": self.retried,
+            "waiting": self.gate.waiting(),
+            "chats": len(self.chats),
+        }
@@ -0,0 +1,208 @@
+# profiling.py — профилирование по запросу (из админ-панели), без перезапуска процесса
+#
+# Два режима:
+#   cprofile — cProfile на потоке event loop: точные cumulative-времена, заметный оверхед;
+#   sample   — раз в interval процессорного времени (SIGPROF) снимается стек event loop:
+#              оверхед ~0, цифры статистические (доля сэмплов, где функция была в стеке).
+#              Простой в select не попадает в сэмплы — видно, куда уходит CPU.
+#              Если loop не в главном потоке (сигналы недоступны) — поток-сэмплер по стене.
+# Пока сессии нет, ни профайлер, ни middleware не подключены — накладных расходов ноль.
+import asyncio
+import cProfile
+import io
+import pstats
+import signal
+import sys
+import threading
+import time
+
+from aiogram import BaseMiddleware
+
+MODES = ("cprofile", "sample")
+
+
+class _HandlerTimer(BaseMiddleware):
+    # время хендлеров за сессию; подключается к роутеру только на время профилирования
+    def __init__(self, session: "ProfileSession"):
+        self.session = session
+
+    async def __call__(self, handler, event, data: dict):
+        h = data.get("handler")
+        name = getattr(getattr(h, "callback", None), "__name__", "unknown")
+        t0 = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            self.session.record(name, time.perf_counter() - t0)
+
+
+class _Samples:
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.samples = 0
+        self.self_counts: dict[tuple, int] = {}
+        self.cum_counts: dict[tuple, int] = {}
+
+    def add(self, frame):
+        self.samples += 1
+        seen = set()
+        top = True
+        while frame is not None:
+            code = frame.f_code
+            key = (code.co_filename, code.co_firstlineno, code.co_name)
+            if top:
+                self.self_counts[key] = self.self_counts.get(key, 0) + 1
+                top = False
+            if key not in seen:
+                seen.add(key)
+                self.cum_counts[key] = self.cum_counts.get(key, 0) + 1
+            frame = frame.f_back
+
+
+class _SignalSampler(_Samples):
+    # ITIMER_PROF тикает по процессорному времени; обработчик исполняется в главном потоке
+    # и получает кадр, который выполнялся в момент сигнала
+    kind = "cpu"
+
+    @staticmethod
+    def available() -> bool:
+        return hasattr(signal, "setitimer") and threading.current_thread() is threading.main_thread()
+
+    def start(self):
+        self._prev = signal.signal(signal.SIGPROF, lambda _sig, frame: self.add(frame))
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._prev or signal.SIG_DFL)
+
+
+class _ThreadSampler(_Samples):
+    # запасной вариант: снимок стека потока loop по стене из отдельного потока
+    # (смещён к местам, где loop отпускает GIL, например к select)
+    kind = "wall"
+
+    def __init__(self, interval: float):
+        super().__init__(interval)
+        self.target = threading.get_ident()
+        self._halt = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+
+    def _run(self):
+        while not self._halt.wait(self.interval):
+            frame = sys._current_frames().get(self.target)
+            if frame is not None:
+                self.add(frame)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._halt.set()
+        self._thread.join()
+
+
+class ProfileSession:
+    # seconds — длительность; updates — остановиться после N обработанных апдейтов
+    # (что наступит раньше; без seconds действует потолок max_seconds)
+
+    def __init__(self, mode: str, *, seconds: float | None = None, updates: int | None = None,
+                 interval: float = 0.005, max_seconds: float = 600, top: int = 40):
+        if mode not in MODES:
+            raise ValueError(f"unknown profiling mode {mode!r}")
+        self.mode = mode
+        self.seconds = min(seconds or max_seconds, max_seconds)
+        self.updates = updates
+        self.interval = interval
+        self.top = top
+        self.handled = 0
+        self.handlers: dict[str, list] = {}   # name -> [count, total, max]
+        self.done = asyncio.Event()
+        self._router = None
+        self._timer = _HandlerTimer(self)
+        self._profile: cProfile.Profile | None = None
+        self._sampler: _Samples | None = None
+        self._started = 0.0
+        self._elapsed = 0.0
+
+    def record(self, name: str, seconds: float):
+        s = self.handlers.get(name)
+        if s is None:
+            s = self.handlers[name] = [0, 0.0, 0.0]
+        s[0] += 1
+        s[1] += seconds
+        s[2] = max(s[2], seconds)
+        self.handled += 1
+        if self.updates and self.handled >= self.updates:
+            self.done.set()
+
+    def start(self, router):
+        # вызывать из потока event loop (cProfile профилирует текущий поток)
+        self._router = router
+        for observer in router.observers.values():
+            observer.middleware(self._timer)
+        self._started = time.perf_counter()
+        if self.mode == "cprofile":
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            cls = _SignalSampler if _SignalSampler.available() else _ThreadSampler
+            self._sampler = cls(self.interval)
+            self._sampler.start()
+
+    def stop(self) -> str:
+        try:
+            if self._profile is not None:
+                self._profile.disable()
+            if self._sampler is not None:
+                self._sampler.stop()
+        finally:
+            self._elapsed = time.perf_counter() - self._started
+            for observer in self._router.observers.values():
+                observer.middleware.unregister(self._timer)
+        return self.report()
+
+    async def run(self, router) -> str:
+        self.start(router)
+        try:
+            await asyncio.wait_for(self.done.wait(), self.seconds)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            report = self.stop()  # и при отмене задачи (остановка процесса) — снять хуки
+        return report
+
+    # ---------- отчёт ----------
+
+    def _handlers_report(self) -> list[str]:
+        out = ["== Хендлеры (время на стене) ==",
+               f"{'handler':<32} {'count':>7} {'total ms':>10} {'mean ms':>9} {'max ms':>9}"]
+        for name, (n, total, mx) in sorted(self.handlers.items(), key=lambda kv: -kv[1][1]):
+            out.append(f"{name:<32} {n:>7} {total * 1000:>10.1f} {total / n * 1000:>9.2f} {mx * 1000:>9.2f}")
+        if not self.handlers:
+            out.append("(за сессию хендлеры не вызывались)")
+        return out
+
+    def _cprofile_report(self) -> list[str]:
+        buf = io.StringIO()
+        stats = pstats.Stats(self._profile, stream=buf)
+        stats.strip_dirs().sort_stats("cumulative").print_stats(self.top)
+        return ["== cProfile: топ по cumulative ==", buf.getvalue()]
+
+    def _sample_report(self) -> list[str]:
+        s = self._sampler
+        total = max(1, s.samples)
+        clock = "CPU" if s.kind == "cpu" else "по стене"
+        out = [f"== Сэмплы: {s.samples} (раз в {self.interval * 1000:.0f} мс {clock}) ==",
+               f"{'cum %':>7} {'self %':>7}  функция"]
+        for key, n in sorted(s.cum_counts.items(), key=lambda kv: -kv[1])[:self.top]:
+            filename, line, name = key
+            short = filename.rsplit("/", 1)[-1]
+            out.append(f"{n / total * 100:>6.1f}% {s.self_counts.get(key, 0) / total * 100:>6.1f}%  "
+                       f"{name} ({short}:{line})")
+        return out
+
+    def report(self) -> str:
+        head = [f"Профиль: {self.mode}, {self._elapsed:.1f} с, обработано апдейтов: {self.handled}", ""]
+        body = self._cprofile_report() if self._profile is not None else self._sample_report()
+        return "\n".join(head + self._handlers_report() + [""] + body) + "\n"
@@ -0,0 +1,45 @@
+# ratelimit.py — асинхронный token bucket
+import asyncio
+import time
+
+
+class TokenBucket:
+    # rate токенов в секунду, не больше burst в запасе.
+    # pause(sec) — принудительная пауза (например, после 429 RetryAfter).
+
+    def __init__(self, rate: float, burst: float | None = None, clock=time.monotonic):
+        self.rate = max(0.001, float(rate))
+        self.burst = float(burst if burst is not None else max(1.0, rate))
+        self.clock = clock
+        self._tokens = self.burst
+        self._updated = clock()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        if now > self._updated:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, self.clock() + max(0.0, seconds))
+
+    def try_acquire(self, tokens: float = 1.0) -> float:
+        # 0 — токены взяты; иначе сколько секунд подождать
+        now = self.clock()
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._refill(now)
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return 0.0
+        return (tokens - self._tokens) / self.rate
+
+    async def acquire(self, tokens: float = 1.0):
+        # lock сохраняет очередность ожидающих (FIFO)
+        async with self._lock:
+            while True:
+                wait = self.try_acquire(tokens)
+                if wait <= 0:
+                    return
+                await asyncio.sleep(wait)
@@ -0,0 +1,142 @@
+# recorder.py — запись входящих апдейтов в сжатый JSONL для последующего воспроизведения (replay.py)
+#
+# Файлы: <dir>/updates-YYYYmmdd-HHMMSS-NNN.jsonl.gz (NNN — номер файла в процессе), новый файл — когда текущий дорос до max_bytes
+# (сжатого размера); хранятся последние keep файлов.
+# Первая строка файла — заголовок {"header": {"bot_username": ..., "started": ...}},
+# дальше по строке на апдейт: {"ts": unix-время получения, "update": {...как прислал Telegram}}.
+#
+# Сериализация — в потоке event loop (дёшево), сжатие и запись на диск — в отдельном потоке.
+# Файл, оборванный аварийной остановкой, читается до последней целой строки (read_log).
+import glob
+import gzip
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import zlib
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+
+log = logging.getLogger("recorder")
+
+_FLUSH_SEC = 1.0
+
+
+def _dumps(obj) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode() + b"\n"
+
+
+class UpdateRecorder(BaseMiddleware):
+    # outer-middleware на dp.update: пишет апдейт и передаёт его дальше без изменений
+
+    def __init__(self, directory: str, *, bot_username: str = "", max_bytes: int = 64 << 20,
+                 keep: int = 20, level: int = 6):
+        self.directory = directory
+        self.bot_username = bot_username
+        self.max_bytes = max(1 << 16, int(max_bytes))
+        self.keep = max(1, int(keep))
+        self.level = level
+        self.recorded = 0
+        self.dropped = 0
+        self._q: queue.Queue = queue.Queue(maxsize=100_000)
+        self._raw = None
+        self._seq = 0
+        self._gz: gzip.GzipFile | None = None
+        os.makedirs(directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="update-recorder", daemon=True)
+        self._thread.start()
+
+    async def __call__(self, handler, event: Update, data: dict):
+        self.record(event)
+        return await handler(event, data)
+
+    def record(self, update: Update):
+        line = _dumps({"ts": round(time.time(), 3),
+                       "update": update.model_dump(mode="json", exclude_none=True, by_alias=True)})
+        try:
+            self._q.put_nowait(line)
+            self.recorded += 1
+        except queue.Full:
+            self.dropped += 1  # диск не успевает — теряем запись, но не тормозим бота
+
+    # ---------- поток записи ----------
+
+    def _open(self):
+        # имя сортируется в порядке записи: время + номер файла (ротация может случиться в ту же секунду)
+        self._seq += 1
+        name = time.strftime("updates-%Y%m%d-%H%M%S", time.gmtime()) + f"-{self._seq:03d}.jsonl.gz"
+        self._raw = open(os.path.join(self.directory, name), "xb")
+        self._gz = gzip.GzipFile(fileobj=self._raw, mode="wb", compresslevel=self.level)
+        self._gz.write(_dumps({"header": {"bot_username": self.bot_username, "started": round(time.time(), 3)}}))
+        self._prune()
+
+    def _close_file(self):
+        if self._gz is not None:
+            self._gz.close()
+            self._raw.close()
+            self._gz = self._raw = None
+
+    def _prune(self):
+        files = sorted(glob.glob(os.path.join(self.directory, "updates-*.jsonl.gz")))
+        for path in files[:-self.keep]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _run(self):
+        last_flush = time.monotonic()
+        while True:
+            try:
+                line = self._q.get(timeout=_FLUSH_SEC)
+            except queue.Empty:
+                line = b""
+            if line is None:
+                break
+            try:
+                if line:
+                    if self._gz is None:
+                        self._open()
+                    self._gz.write(line)
+                    # размер на диске растёт блоками сжатия — для ротации этого достаточно
+                    if self._raw.tell() >= self.max_bytes:
+                        self._close_file()
+                if self._gz is not None and time.monotonic() - last_flush >= _FLUSH_SEC:
+                    self._gz.flush()
+                    last_flush = time.monotonic()
+            except OSError:
+                log.exception("update recorder: write failed")
+                self._close_file()
+        self._close_file()
+
+    def close(self):
+        self._q.put(None)
+        self._thread.join()
+
+
+def log_files(path: str) -> list[str]:
+    # файл или каталог с логами -> файлы по порядку записи
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, "updates-*.jsonl.gz")))
+    return [path]
+
+
+def read_log(paths: list[str]):
+    # -> (header | None, ts, update dict) по всем файлам; обрыв в конце файла не ошибка
+    for path in paths:
+        header = None
+        with gzip.open(path, "rb") as f:
+            try:
+                for raw in f:
+                    if not raw.endswith(b"\n"):
+                        break
+                    rec = json.loads(raw)
+                    if "header" in rec:
+                        header = rec["header"]
+                        continue
+                    yield header, rec["ts"], rec["update"]
+            except (EOFError, gzip.BadGzipFile, zlib.error, json.JSONDecodeError):
+                log.warning("%s: truncated, replaying what was read", path)
@@ -0,0 +1,168 @@
+# replay.py — воспроизведение записанного трафика (recorder.py) против локального фейкового Bot API
+#
+#   python replay.py recordings/                           # как можно быстрее
+#   python replay.py recordings/updates-...jsonl.gz --speed 1   # с исходными интервалами
+#   python replay.py recordings/ --speed 10 --api-latency 0.05 --flood-rate 0.02
+#   python replay.py recordings/ --db snapshot.sqlite3     # на копии боевой базы (подписки, каналы)
+#
+# Апдейты идут через Dispatcher.feed_update с настоящим роутером; исходящие запросы — в
+# fake_botapi.py (задержка ответа и доля 429 настраиваются), через планировщик outbound.py
+# с лимитами из config, как в бою; --no-limits оставляет только повторы после 429.
+# Для сравнения оптимизаций гоняйте один и тот же лог с одинаковым --seed.
+# База — всегда временная: --db копируется, исходный файл не меняется.
+import argparse
+import asyncio
+import json
+import os
+import resource
+import sqlite3
+import sys
+import tempfile
+import time
+
+import config
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Воспроизведение записанных апдейтов")
+    ap.add_argument("log", help="файл updates-*.jsonl.gz или каталог с ними")
+    ap.add_argument("--speed", type=float, default=0.0,
+                    help="1 — исходная скорость, 10 — в 10 раз быстрее, 0 — без пауз (по умолчанию)")
+    ap.add_argument("--concurrency", type=int, default=64, help="максимум одновременно обрабатываемых апдейтов")
+    ap.add_argument("--limit", type=int, default=0, help="воспроизвести только первые N апдейтов")
+    ap.add_argument("--db", help="снимок базы бота, на копии которого идёт прогон")
+    ap.add_argument("--bot-username", help="по умолчанию — из заголовка лога")
+    ap.add_argument("--api-latency", type=float, default=0.0, help="задержка ответа фейкового API, сек")
+    ap.add_argument("--flood-rate", type=float, default=0.0, help="доля запросов, получающих 429")
+    ap.add_argument("--retry-after", type=int, default=1)
+    ap.add_argument("--no-limits", action="store_true",
+                    help="снять лимиты Telegram в outbound.py (повторы после 429 остаются) — меряем сам бот")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--json", help="сохранить итог в файл")
+    return ap.parse_args()
+
+
+ARGS = parse_args() if __name__ == "__main__" else None
+_tmp = tempfile.mkdtemp(prefix="replay-")
+config.DB_PATH = os.path.join(_tmp, "bot.sqlite3")
+if ARGS and ARGS.db:
+    # копия через backup API — корректна и для базы в WAL-режиме
+    with sqlite3.connect(f"file:{ARGS.db}?mode=ro", uri=True) as src, sqlite3.connect(config.DB_PATH) as dst:
+        src.backup(dst)
+
+import main  # noqa: E402
+from aiogram import Bot  # noqa: E402
+from aiogram.client.default import DefaultBotProperties  # noqa: E402
+from aiogram.client.session.aiohttp import AiohttpSession  # noqa: E402
+from aiogram.client.telegram import TelegramAPIServer  # noqa: E402
+from aiogram.types import Update  # noqa: E402
+
+from fake_botapi import FakeBotAPI  # noqa: E402
+from outbound import OutboundScheduler  # noqa: E402
+from recorder import log_files, read_log  # noqa: E402
+
+
+def _pct(sorted_vals: list[float], q: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    return sorted_vals[min(len(sorted_vals) - 1, max(0, round(q * (len(sorted_vals) - 1))))]
+
+
+def update_kind(raw: dict) -> str:
+    return next((k for k in raw if k != "update_id"), "unknown")
+
+
+async def run(args) -> int:
+    records = list(read_log(log_files(args.log)))
+    if args.limit:
+        records = records[:args.limit]
+    if not records:
+        print("лог пуст")
+        return 1
+    header = next((h for h, _ts, _u in records if h), None) or {}
+    username = args.bot_username or header.get("bot_username") or "replay_bot"
+
+    api = FakeBotAPI(latency=args.api_latency, flood_rate=args.flood_rate, retry_after=args.retry_after,
+                     bot_username=username, seed=args.seed)
+    api_url = await api.start()
+    bot = Bot("42:replay", session=AiohttpSession(api=TelegramAPIServer.from_base(api_url)),
+              default=DefaultBotProperties(parse_mode="HTML"))
+    outbound = main.OUTBOUND
+    if args.no_limits:
+        outbound = OutboundScheduler(rate=1e6, private_rate=1e6, private_burst=10**6, group_per_min=6e7,
+                                     max_retries=getattr(config, "OUTBOUND_MAX_RETRIES", 3))
+    bot.session.middleware(outbound)
+    main.set_bot_username(username)
+    await main.load_channel_allowlist()
+    dp = main.build_dispatcher()
+
+    lat: dict[str, list[float]] = {}
+    errors: dict[str, int] = {}
+    sem = asyncio.Semaphore(max(1, args.concurrency))
+    tasks = []
+
+    async def handle(kind: str, update: Update):
+        t0 = time.perf_counter()
+        try:
+            await dp.feed_update(bot, update)
+        except Exception as e:
+            key = f"{kind}: {type(e).__name__}"
+            errors[key] = errors.get(key, 0) + 1
+        finally:
+            lat.setdefault(kind, []).append(time.perf_counter() - t0)
+            sem.release()
+
+    first_ts = records[0][1]
+    started = time.perf_counter()
+    behind = 0.0
+    for _h, ts, raw in records:
+        if args.speed > 0:
+            delay = (ts - first_ts) / args.speed - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                behind = max(behind, -delay)
+        await sem.acquire()
+        update = Update.model_validate(raw, context={"bot": bot})
+        tasks.append(asyncio.create_task(handle(update_kind(raw), update)))
+    await asyncio.gather(*tasks)
+    handled = time.perf_counter() - started
+    await main.DB.flush()
+    await asyncio.sleep(0.05)
+
+    n = len(records)
+    all_lat = sorted(x for v in lat.values() for x in v)
+    rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    summary = api.summary()
+    span = records[-1][1] - first_ts
+    print(f"updates: {n}  recorded span: {span:.1f} s  replayed in: {handled:.2f} s  speed: {args.speed or 'max'}")
+    print(f"throughput: {n / handled:,.0f} upd/s  latency: p50 {_pct(all_lat, .5) * 1000:.2f} ms  "
+          f"p99 {_pct(all_lat, .99) * 1000:.2f} ms  max {all_lat[-1] * 1000:.2f} ms")
+    if args.speed > 0 and behind:
+        print(f"max lag behind schedule: {behind * 1000:.0f} ms")
+    print(f"peak RSS: {rss_kb / 1024:.1f} MiB")
+    print(f"\n{'update':<24} {'count':>7} {'p50 ms':>8} {'p99 ms':>8}")
+    for kind, v in sorted(lat.items(), key=lambda kv: -len(kv[1])):
+        v.sort()
+        print(f"{kind:<24} {len(v):>7} {_pct(v, .5) * 1000:>8.2f} {_pct(v, .99) * 1000:>8.2f}")
+    if errors:
+        print("\nerrors: " + ", ".join(f"{k}={v}" for k, v in sorted(errors.items())))
+    print(f"\nBot API: {summary['calls']} calls, {summary['floods']} x 429 injected, "
+          f"outbound retried {outbound.retried}")
+    print("  " + ", ".join(f"{k}={v}" for k, v in sorted(summary["by_method"].items())))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({
+                "updates": n, "speed": args.speed, "seconds": handled, "throughput": n / handled,
+                "p50_ms": _pct(all_lat, .5) * 1000, "p99_ms": _pct(all_lat, .99) * 1000,
+                "peak_rss_mib": rss_kb / 1024, "errors": errors, "api": summary,
+            }, f, ensure_ascii=False, indent=2)
+
+    await bot.session.close()
+    await api.stop()
+    main.DB.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(run(ARGS)))